@@ -0,0 +1,69 @@
+"""Per-frame ND2 read latency with and without the shared reader cache.
+
+Writes a synthetic multi-FOV file, then reads every frame of a few FOVs the
+way `Track.segment` does (one `read_nd2` call per frame), once opening a new
+ND2Reader per call as before and once through `lisca.nd2_io`.
+
+    python benchmarks/bench_nd2_cache.py --fov 25 --frames 180
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from lisca import nd2_io  # noqa: E402
+from lisca.functions import read_nd2  # noqa: E402
+from synthetic_nd2 import write_synthetic_nd2  # noqa: E402
+
+
+def read_uncached(file, v, t, c):
+    f = nd2_io.open_reader(file)
+    try:
+        return f.get_frame_2D(v=v, t=t, c=c)
+    finally:
+        f.close()
+
+
+def time_reads(read, file, fovs, n_frames, c):
+    t0 = time.perf_counter()
+    for v in fovs:
+        for t in range(n_frames):
+            read(file, v, t, c)
+    return (time.perf_counter() - t0) / (len(fovs) * n_frames)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--fov', type=int, default=25)
+    parser.add_argument('--frames', type=int, default=180)
+    parser.add_argument('--channels', type=int, default=3)
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--read-fovs', type=int, default=3, help='number of FOVs read in each run')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        file = os.path.join(tmp, 'synthetic.nd2')
+        data = write_synthetic_nd2(file, args.fov, args.frames, args.channels, args.size, args.size)
+        print(f'{file}: {os.path.getsize(file)/1e6:.1f} MB, '
+              f'{args.fov} FOVs x {args.frames} frames x {args.channels} channels')
+
+        fovs = np.linspace(0, args.fov-1, min(args.read_fovs, args.fov)).astype(int)
+        assert np.array_equal(read_nd2(file, fovs[-1], 1, c=0), data[1, fovs[-1], 0])
+
+        nd2_io.clear_cache()
+        uncached = time_reads(read_uncached, file, fovs, args.frames, 0)
+        nd2_io.clear_cache()
+        cached = time_reads(lambda *a: read_nd2(*a[:3], c=a[3]), file, fovs, args.frames, 0)
+        nd2_io.clear_cache()
+
+    print(f'new reader per frame: {1e3*uncached:8.3f} ms/frame')
+    print(f'shared reader cache:  {1e3*cached:8.3f} ms/frame')
+    print(f'speedup:              {uncached/cached:8.1f}x')
+
+
+if __name__ == '__main__':
+    main()
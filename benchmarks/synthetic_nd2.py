@@ -0,0 +1,80 @@
+"""Write small synthetic ND2 files for benchmarking the readers.
+
+The files follow the layout understood by `nd2reader` (version 3 chunk map,
+channel-interleaved uint16 image groups ordered t -> v), which is all the
+lisca readers rely on.
+"""
+import struct
+
+import numpy as np
+
+CHUNK_HEADER = 0xabeceda
+
+
+def _pack_metadata(items):
+    """Serialize a (nested) dict the way `nd2reader.common.read_metadata` parses it."""
+    raw = b''
+    for name, value in items.items():
+        name = (name + '\0').encode('utf-16-le')
+        if isinstance(value, dict):
+            children = _pack_metadata(value)
+            head = struct.pack('BB', 11, len(name) // 2) + name
+            raw += head + struct.pack('<IQ', len(value), len(head) + 12 + len(children))
+            raw += children + bytes(8*len(value))
+        elif isinstance(value, str):
+            raw += struct.pack('BB', 8, len(name) // 2) + name + (value + '\0').encode('utf-16-le')
+        else:
+            raw += struct.pack('BB', 2, len(name) // 2) + name + struct.pack('I', value)
+    return raw
+
+
+def _chunk(payload):
+    return struct.pack('IIQ', CHUNK_HEADER, 0, len(payload)) + payload
+
+
+def write_synthetic_nd2(path, n_fov=25, n_frames=180, n_channels=3, height=256, width=256, seed=0):
+    """Write a multi-FOV, multi-channel ND2 file with random uint16 pixels.
+
+    Returns the (n_frames, n_fov, n_channels, height, width) array that was written,
+    so callers can check what the readers return.
+    """
+    if not 1 <= n_channels <= 4:
+        raise ValueError('n_channels must be between 1 and 4')
+    rng = np.random.default_rng(seed)
+    data = rng.integers(0, 2**12, size=(n_frames, n_fov, n_channels, height, width), dtype='uint16')
+
+    attributes = {'SLxImageAttributes': {
+        'uiWidth': width, 'uiWidthBytes': 2*width*n_channels, 'uiHeight': height,
+        'uiComp': n_channels, 'uiBpcInMemory': 16, 'uiBpcSignificant': 12,
+        'uiSequenceCount': n_frames*n_fov, 'uiTileWidth': width, 'uiTileHeight': height,
+        'uiVirtualComponents': n_channels}}
+    text_info = {'SLxImageTextInfo': {'TextInfoItem_5': f'Dimensions: T({n_frames}) x XY({n_fov})'}}
+    planes = {f'a{c}': {'sDescription': f'C{c}'} for c in range(n_channels)}
+    # nd2reader pairs the channel list with one validity flag per entry of
+    # sPicturePlanes, so the usual sibling keys must be present as well.
+    picture_planes = {'sPlaneNew': planes, 'uiCount': n_channels, 'uiCompCount': n_channels, 'uiSampleCount': 1}
+    sequence = {'SLxPictureMetadata': {'sPicturePlanes': picture_planes}}
+
+    chunks = [
+        (b'ImageAttributesLV!', _chunk(_pack_metadata(attributes))),
+        (b'ImageTextInfoLV!', _chunk(_pack_metadata(text_info))),
+        (b'ImageMetadataSeqLV|0!', _chunk(_pack_metadata(sequence))),
+    ]
+    timestamp = struct.pack('d', 0.)
+    for t in range(n_frames):
+        for v in range(n_fov):
+            group = np.ascontiguousarray(data[t, v].transpose(1, 2, 0))
+            chunks.append((f'ImageDataSeq|{t*n_fov + v}!'.encode(), _chunk(timestamp + group.tobytes())))
+
+    with open(path, 'wb') as fh:
+        fh.write(bytearray(16))
+        fh.write(b'ND2 FILE SIGNATURE CHUNK NAME01!Ver3.0')
+        label_map = b''
+        for label, chunk in chunks:
+            label_map += label + struct.pack('QQ', fh.tell(), len(chunk))
+            fh.write(chunk)
+        label_map_start = fh.tell()
+        fh.write(label_map)
+        fh.write(struct.pack('Q', label_map_start))
+
+    return data
@@ -0,0 +1,146 @@
+"""Overlap reading, computing and writing of per-frame work.
+
+`run_pipelined` runs a reader thread, the compute stage (in the calling
+thread, so GPU models stay on the thread that created them) and a writer
+thread, connected by bounded queues. While frame t is segmented, frame t+1
+is decoded and the mask of frame t-1 is encoded.
+"""
+import queue
+import threading
+import time
+
+from tqdm import tqdm
+
+_DONE = object()
+
+
+class _Stage:
+    """Busy time and frame count of one stage."""
+
+    def __init__(self):
+        self.busy = 0.
+        self.count = 0
+
+    def timed(self, fun, *args, n=1):
+        t0 = time.perf_counter()
+        result = fun(*args)
+        self.busy += time.perf_counter() - t0
+        self.count += n
+        return result
+
+    @property
+    def rate(self):
+        return self.count / self.busy if self.busy > 0 else float('inf')
+
+
+def _put(q, item, failed):
+    #Give up instead of blocking forever if another stage failed
+    while not failed.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(q, failed):
+    while not failed.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return _DONE
+
+
+def _rates(stages):
+    return ' '.join(f'{name} {stage.rate:.1f}/s' for name, stage in stages.items())
+
+
+def run_pipelined(frames, read, compute, write, depth=2, desc=None, weight=None):
+    """
+    Run read -> compute -> write for every frame, with the three stages running concurrently.
+
+    Parameters
+    ----------
+    frames : iterable
+        Frames to process, in order; an item may also be a batch of frames (see `weight`).
+    read : callable
+        read(t) returns the input of frame t. Runs in the reader thread; must return a new array.
+    compute : callable
+        compute(x) returns the result for input x. Runs in the calling thread.
+    write : callable
+        write(t, result) stores the result of frame t. Runs in the writer thread, in frame order.
+    depth : int, optional
+        Number of frames that can wait between two stages. The default is 2.
+    desc : string, optional
+        Description of the progress bar.
+    weight : callable, optional
+        weight(item) returns the number of frames in an item of `frames`, e.g. `len` for batches; used
+        for the progress bar and the rates. The default is None, which counts every item as one frame.
+
+    Returns
+    -------
+    stats : dict
+        Frames per second of busy time of the 'read', 'compute' and 'write' stages.
+        The slowest stage is the bottleneck.
+    """
+    frames = list(frames)
+    sizes = [1] * len(frames) if weight is None else [weight(t) for t in frames]
+    stages = {'read': _Stage(), 'compute': _Stage(), 'write': _Stage()}
+    read_q, write_q = queue.Queue(maxsize=depth), queue.Queue(maxsize=depth)
+    failed = threading.Event()
+    errors = []
+
+    def reader():
+        try:
+            for i, t in enumerate(frames):
+                if not _put(read_q, (i, t, stages['read'].timed(read, t, n=sizes[i])), failed):
+                    return
+            _put(read_q, _DONE, failed)
+        except BaseException as e:
+            errors.append(e)
+            failed.set()
+
+    def writer():
+        try:
+            while True:
+                item = _get(write_q, failed)
+                if item is _DONE:
+                    return
+                i, t, result = item
+                stages['write'].timed(write, t, result, n=sizes[i])
+        except BaseException as e:
+            errors.append(e)
+            failed.set()
+
+    threads = [threading.Thread(target=reader, daemon=True), threading.Thread(target=writer, daemon=True)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        with tqdm(total=sum(sizes), desc=desc) as pbar:
+            while True:
+                item = _get(read_q, failed)
+                if item is _DONE:
+                    break
+                i, t, x = item
+                result = stages['compute'].timed(compute, x, n=sizes[i])
+                if not _put(write_q, (i, t, result), failed):
+                    break
+                pbar.update(sizes[i])
+                pbar.set_postfix_str(_rates(stages), refresh=False)
+            _put(write_q, _DONE, failed)
+            threads[1].join()
+            pbar.set_postfix_str(_rates(stages))
+    except BaseException:
+        failed.set()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+
+    return {name: stage.rate for name, stage in stages.items()}
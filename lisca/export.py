@@ -0,0 +1,55 @@
+"""Streaming export of stacks to TIFF files.
+
+Frames are written page by page as they come in, so exporting a movie only
+holds the frame being written in memory.
+"""
+import numpy as np
+
+from .stacks import iter_frames
+
+
+def _frames(x, dtype, frame_shape):
+    for _, frame in iter_frames(x):
+        if frame.shape != frame_shape:
+            raise ValueError(f'Frame has shape {frame.shape}, expected {frame_shape}')
+        #Copied, since streamed frames may reuse their buffer and tifffile can hold on to several pages
+        yield np.array(frame, dtype=dtype)
+
+
+def write_tiff(file, x, shape=None, dtype=None, compression=None, n_threads=None):
+    """
+    Write a (frames, height, width) stack to `file` page by page.
+
+    Parameters
+    ----------
+    file : string
+        Output path.
+    x : array, LazyStack or iterable of (frame index, frame)
+        The frames. Arrays and LazyStacks are read one frame at a time.
+    shape : tuple, optional
+        (frames, height, width); required if `x` is a stream.
+    dtype : dtype, optional
+        Pixel type of the file. The default is the dtype of `x` (required if `x` is a stream).
+    compression : string, optional
+        Compression codec, e.g. 'zlib' or 'zstd'. ImageJ cannot read compressed files, so compressed
+        stacks are written as plain BigTIFF. The default is None, which writes an uncompressed ImageJ
+        hyperstack that can be memory-mapped (see `stacks.TiffStack`).
+    n_threads : int, optional
+        Number of threads compressing the strips of each page. The default is None, which lets
+        tifffile decide.
+    """
+    from tifffile import TiffWriter
+
+    n_frames, height, width = x.shape if shape is None else shape
+    dtype = np.dtype(x.dtype if dtype is None else dtype)
+    pages = _frames(x, dtype, (height, width))
+
+    if compression is None:
+        tiff_shape = (n_frames, 1, 1, height, width, 1)
+        with TiffWriter(file, imagej=True) as tif:
+            tif.write(pages, shape=tiff_shape, dtype=dtype)
+    else:
+        #Small strips let several threads compress one page
+        with TiffWriter(file, bigtiff=True) as tif:
+            tif.write(pages, shape=(n_frames, height, width), dtype=dtype, compression=compression,
+                      maxworkers=n_threads, rowsperstrip=max(1, min(height, 64)))
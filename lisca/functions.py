@@ -60,7 +60,7 @@ p.copy(x)
 
     """
     
-    from tifffile import imread, TiffFile
+    from tifffile import imread
     
     if cytoplasm_file is None and nucleus_file is None:
         raise TypeError('cytoplasm_file and nucleus_file cannot be both empty')
@@ -71,16 +71,12 @@ p.copy(x)
     if data_path is None:
         data_path = os.getcwd() + '/../data/'
     
-    if cytoplasm_file is not None:
-        #This is quite slow but is not memory hungry, should become faster with OMERO
-        tif = TiffFile(data_path + cytoplasm_file)
-        n_images = len(tif.pages)
-        height, width = tif.pages[0].shape
- 
-    else:
-        tif = TiffFile(data_path + nucleus_file)
-        n_images = len(tif.pages)
-        height, width = tif.pages[0]
+    from .stacks import TiffStack
+
+    stack = TiffStack(os.path.join(data_path, cytoplasm_file if cytoplasm_file is not None else nucleus_file))
+    n_images, height, width = stack.shape
+    stack.close()
+
     if image_indices is not None:
         i_0, i_f = image_indices
     else:
@@ -88,30 +84,31 @@ p.copy(x)
     
     if x_range is not None:
         x_0, x_f = x_range
-        y_0, y_f = y_range[0.0, 1022, 268.663662644234, 232.974636223668]
+        y_0, y_f = y_range
 
     else:
         x_0, x_f = [0, width]
         y_0, y_f = [0, height]
-     
-    if x_range is not None:
-        x_0, x_f = x_range
-        y_0, y_f = y_range
         
+    #Only the rows of the zoom are read from uncompressed tifs
     if cytoplasm_file is not None:
-        cytoplasm = imread(os.path.join(data_path, cytoplasm_file), key=range(i_0, i_f))#[:][y_0:y_f, x_0:x_f]
+        stack = TiffStack(os.path.join(data_path, cytoplasm_file))
+        cytoplasm = stack[i_0:i_f, y_0:y_f, x_0:x_f]
+        stack.close()
             
     else:
         cytoplasm=None
         
     if nucleus_file is not None:
-        nucleus = imread(data_path + nucleus_file, key=range(i_0, i_f))#[:][y_0:y_f, x_0:x_f]
+        stack = TiffStack(os.path.join(data_path, nucleus_file))
+        nucleus = stack[i_0:i_f, y_0:y_f, x_0:x_f]
+        stack.close()
     
     else:
         nucleus=None    
     
     if lanes_file is not None:
-        lanes = imread(data_path + lanes_file)[y_0:y_f, x_0:x_f]
+        lanes = imread(os.path.join(data_path, lanes_file))[y_0:y_f, x_0:x_f]
     else:
         lanes=None
         
@@ -459,7 +456,13 @@ def get_kymograph(image_stack, coordinates, line_width, nuc_track=None):
     height, width = image_stack.shape[1:]
     x_lane, y_lane = get_lanes_for_kymograph(coordinates, line_width, [height,width])
  
-    kymograph = image_stack[:, y_lane, x_lane]
+    if y_lane.min()>=0 and x_lane.min()>=0:
+        #Only the bounding box of the lane is read, which for lazy stacks avoids reading full frames
+        y_0, x_0 = y_lane.min(), x_lane.min()
+        box = np.asarray(image_stack[:, y_0:y_lane.max()+1, x_0:x_lane.max()+1])
+        kymograph = box[:, y_lane-y_0, x_lane-x_0]
+    else:
+        kymograph = np.asarray(image_stack[:])[:, y_lane, x_lane]
     #del image_stack
     kymograph = np.max(kymograph, axis=1).T
     
@@ -479,30 +482,15 @@ def get_edges(kymo):
 def np_to_mp4(x, out, crf=0, rate=10, vf=None):
     
     
-    import skvideo.io
+    from .video_writer import Mp4writer
     from tqdm import tqdm    
 
-    outputdict={
-      '-vcodec': 'libx264',  #use the h.264 codec
-      '-crf': str(crf),           #set the constant rate factor to 0, which is lossless
-      #'-preset':'faster'   #the slower the better compression, in princple, try 
-      '-r': str(rate)
-      #other options see https://trac.ffmpeg.org/wiki/Encode/H.264
-    }
-
-    if vf is not None:
-        outputdict['vf']=vf
-
-    writer = skvideo.io.FFmpegWriter(out, 
-        inputdict={
-      '-r': str(rate)
-      #other options see https://trac.ffmpeg.org/wiki/Encode/H.264
-    },
-        outputdict=outputdict)
+    #Frames are encoded in a background thread while the next ones are prepared
+    writer = Mp4writer(out, rate=rate, crf=crf, vf=vf, queue_size=8)
 
     print(f'Encoding array to {os.path.basename(out)}...')
     for frame in tqdm(x):
-        writer.writeFrame(frame)
+        writer.write_frame(frame, copy=False)
     writer.close()
 
     return
@@ -527,27 +515,35 @@ def tifs_to_mp4(dir, crf=0):
         video_file = file.split('.')[0] + '.mp4'
         np_to_mp4(x, video_file, crf=crf)    
 
-def mp4_to_np(file, frames=None, as_grey=True):
+def mp4_to_np(file, frames=None, as_grey=True, out=None, roi=None):
+    """
+    Read frames of an mp4 movie.
 
-    #print(f'Reading {os.path.basename(file)} ...')
-    import skvideo.io
+    Only the requested frames are decoded: the decoder seeks to the keyframe before each
+    far away frame instead of decoding the whole movie, so reading a few frames is cheap.
 
-    if frames is not None:
-        if as_grey:
-            x = skvideo.io.vread(file, as_grey=True)[frames,:,:,0]
-   
-        else:
-            x = skvideo.io.vread(file, as_grey=False)[frames,:,:,:]
-   
-    else:
-        if as_grey:
-            x = skvideo.io.vread(file, as_grey=True)[:,:,:,0]
-   
-        else:
-            x = skvideo.io.vread(file, as_grey=False)[:,:,:,:]
-          
-    #print('Done Reading')
-    return x
+    Parameters
+    ----------
+    file : string
+        Path to the movie.
+    frames : int, slice or array of int, optional
+        Frames to read. The default is None, which reads all frames.
+    as_grey : bool, optional
+        Return grey frames (t, h, w) instead of RGB frames (t, h, w, 3). The default is True.
+    out : np.ndarray, optional
+        uint8 array to decode into.
+    roi : tuple, optional
+        (y0, y1, x0, x1) region to keep of every frame. The default is None, which keeps full frames.
+
+    Returns
+    -------
+    x : np.ndarray
+        The frames, in the order requested.
+
+    """
+    from .stacks import read_mp4
+
+    return read_mp4(file, frames, as_grey=as_grey, out=out, roi=roi)
     
 def remove_peaks(x, max_step=5, max_peak_width=5):
 
@@ -1029,28 +1025,20 @@ def get_lane_mask(image, delta_y_max=20, kernel_width=5, line_distance=30, thres
 
 def get_foot_print(masks, out=None, crf=0, rate=10, write=False):
     print('Getting footprint...')
-    from skvideo.io import FFmpegWriter
+    from .video_writer import Mp4writer
 
     masks = masks>0
     if write:
         if out is None:
             raise ValueError('An output path is needed if write=True is passed!')
 
-        writer = FFmpegWriter(out, 
-            outputdict={
-        '-vcodec': 'libx264',  #use the h.264 codec
-        '-crf': str(crf),           #set the constant rate factor to 0, which is lossless
-        #'-preset':'faster'   #the slower the better compression, in princple, try 
-        '-r': str(rate)
-        #other options see https://trac.ffmpeg.org/wiki/Encode/H.264
-        })
+        writer = Mp4writer(out, rate=rate, crf=crf, queue_size=8)
 
-        
-        # foot_print = np.zeros(masks.shape, dtype='uint16')
+        #Running sum of the masks before frame i, saturated at 255 for the 8 bit video
+        foot_print = np.zeros(masks.shape[1:], dtype='uint16')
         for i in tqdm(range(0, masks.shape[0])):
-            # foot_print[i] = np.sum(masks[:i], axis=0)
-
-            writer.writeFrame(np.sum(masks[:i], axis=0), dtype='uint16')
+            writer.write_frame(np.minimum(foot_print, 255).astype(np.uint8))
+            foot_print += masks[i]
         writer.close()
 
         return
@@ -1064,36 +1052,15 @@ def get_foot_print(masks, out=None, crf=0, rate=10, write=False):
         return footprint
 
 
-def read_nd2(file, v, frames=None, c=None, manual=False):
+def read_nd2(file, v, frames=None, c=None, manual=False, out=None, roi=None):
 
-    from nd2reader import ND2Reader
+    from .nd2_io import read_block
     #print('Reading nd2...')
-    f = ND2Reader(file)
-    if manual:
-            nfov, nframes = 288, 179
-            f.sizes['v']= nfov
-            f.sizes['t']=nframes
-            f.metadata['fields_of_view']=list(range(nfov))
-    
-    if isinstance(frames,int):
-        x = f.get_frame_2D(v=v, c=c, t=frames)
-        return x
-    
-    if frames is None:
-        if c is None:
-            x = f.get_frame_2D(v=v)
-            return x
-        else:
-            x = f.get_frame_2D(v=v, c=c)
-            return x
 
-    x = np.zeros((
-        frames.size, f.sizes['y'], f.sizes['x']), dtype='uint16')
-
-    i=0
-    for frame in frames:
-        x[i] = f.get_frame_2D(v=v, t=frame, c=c)
-        i+=1
+    #Frames are read straight from the offsets in the sidecar index; a list of channels
+    #is read from each (v, t) image group at once. frames=None reads the first frame.
+    #With roi=(y0, y1, x0, x1) only the rows of the region are read.
+    x = read_block(file, v, 0 if frames is None else frames, c=c, out=out, manual=manual, roi=roi)
     
     #print('Done reading.')
     return x
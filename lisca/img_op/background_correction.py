@@ -17,7 +17,7 @@ from .. import util
 
 def _make_tiles(n, div, name='center'):
     borders = np.rint(np.linspace(0, n, 2*div-1)).astype(np.uint16)
-    tiles = np.empty(len(borders)-2, dtype=[(name, np.float), ('slice', object)])
+    tiles = np.empty(len(borders)-2, dtype=[(name, np.float64), ('slice', object)])
     for i, (b1, b2) in enumerate(zip(borders[:-2], borders[2:])):
         tiles[i] = (b1 + b2) / 2, slice(b1, b2)
     return tiles
@@ -88,8 +88,8 @@ def background_schwarzfischer(fluor_chan, bin_chan, div_horiz=7, div_vert=5, mem
     """Perform background correction according to Schwarzfischer et al.
 
     Arguments:
-        fluor_chan -- (frames x height x width) numpy array; the fluorescence channel to be corrected
-        bin_chan -- boolean numpy array of same shape as `fluor_chan`; segmentation map (background=False, cell=True)
+        fluor_chan -- (frames x height x width) numpy array or LazyStack; the fluorescence channel to be corrected
+        bin_chan -- boolean numpy array or label stack of same shape as `fluor_chan`; segmentation map (background=False, cell=True)
         div_horiz -- int; number of (non-overlapping) tiles in horizontal direction
         div_vert -- int; number of (non-overlapping) tiles in vertical direction
         mem_lim -- max number of bytes for temporary data before switching to memmap;
@@ -103,9 +103,9 @@ def background_schwarzfischer(fluor_chan, bin_chan, div_horiz=7, div_vert=5, mem
     n_frames, height, width = fluor_chan.shape
 
     # Allocate arrays
-    if np.can_cast(fluor_chan, np.float16):
+    if np.can_cast(fluor_chan.dtype, np.float16):
         dtype_interp = np.float16
-    elif np.can_cast(fluor_chan, np.float32):
+    elif np.can_cast(fluor_chan.dtype, np.float32):
         dtype_interp = np.float32
     else:
         dtype_interp = np.float64
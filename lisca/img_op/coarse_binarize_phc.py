@@ -1,3 +1,6 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+
 import scipy.ndimage as smg
 import numpy as np
 import numba as nb
@@ -6,13 +9,13 @@ STRUCT3 = np.ones((3,3), dtype=np.bool_)
 STRUCT5 = np.ones((5,5), dtype=np.bool_)
 STRUCT5[[0,0,-1,-1], [0,-1,0,-1]] = False
 
-@nb.njit
+@nb.njit(nogil=True, cache=True)
 def window_std(img):
     """Calculate unnormed variance of 'img'"""
     return np.sum((img - np.mean(img))**2)
 
 
-@nb.njit
+@nb.njit(nogil=True, cache=True)
 def generic_filter(img, fun, size=3, reflect=False):
     """Apply filter to image.
 
@@ -53,14 +56,76 @@ def generic_filter(img, fun, size=3, reflect=False):
     return filtered_img
 
 
-def binarize_frame(img, mask_size=3):
-    """Coarse segmentation of phase-contrast image frame
+@nb.njit(nogil=True, cache=True)
+def _box_variance(padded, size, out):
+    """Unnormed variance of each size x size window of 'padded' (which has a border of size//2), via summed-area tables."""
+    n = size * size
+    sat1 = np.zeros((padded.shape[0]+1, padded.shape[1]+1), dtype=padded.dtype)
+    sat2 = np.zeros_like(sat1)
+    for y in range(padded.shape[0]):
+        row1 = padded[y, 0] * 0
+        row2 = padded[y, 0] * 0
+        for x in range(padded.shape[1]):
+            v = padded[y, x]
+            row1 += v
+            row2 += v * v
+            sat1[y+1, x+1] = sat1[y, x+1] + row1
+            sat2[y+1, x+1] = sat2[y, x+1] + row2
 
-    Returns binarized image of frame
+    height, width = out.shape
+    for y in range(height):
+        for x in range(width):
+            s_1 = sat1[y+size, x+size] - sat1[y, x+size] - sat1[y+size, x] + sat1[y, x]
+            s_2 = sat2[y+size, x+size] - sat2[y, x+size] - sat2[y+size, x] + sat2[y, x]
+            var = (n * s_2 - s_1 * s_1) / n
+            out[y, x] = var if var > 0 else 0.
+    return out
+
+
+def window_variance(img, size=3, reflect=False):
+    """Unnormed variance (as 'window_std') of the size x size window around every pixel.
+
+    img -- (height, width) image or (frames, height, width) stack
+    size -- the size (side length) of the mask; must be an odd integer
+    reflect -- switch for border mode: True for 'reflect', False for 'mirror'
+
+    Returns a np.float64 array with same shape as 'img'; equivalent to
+    generic_filter(img, window_std, size, reflect), but with O(1) work per pixel
+    for any 'size'. Integer images up to 16 bit are summed exactly in int64.
+    The kernel releases the GIL, so frames can be processed in parallel threads.
     """
-    # Get logarithmic standard deviation at each pixel
-    std_log = generic_filter(img, window_std, size=mask_size)
+    if size % 2 != 1:
+        raise ValueError("'size' must be an odd integer")
+    img = np.asarray(img)
+    if img.ndim == 3:
+        out = np.empty(img.shape, dtype=np.float64)
+        for t in range(img.shape[0]):
+            out[t] = window_variance(img[t], size=size, reflect=reflect)
+        return out
+
+    s2 = size // 2
+    exact = img.dtype.kind == 'b' or (img.dtype.kind in 'iu' and img.dtype.itemsize <= 2)
+    if exact:
+        work = img.astype(np.int64)
+    else:
+        # Centering reduces cancellation in n*sum(x**2) - sum(x)**2
+        work = img.astype(np.float64)
+        work -= work.mean()
+    # numpy's 'reflect' is scipy's 'mirror', numpy's 'symmetric' is scipy's 'reflect'
+    padded = np.pad(work, s2, mode='symmetric' if reflect else 'reflect')
+
+    return _box_variance(padded, size, np.empty(img.shape, dtype=np.float64))
+
+
+def log_std(img, mask_size=3):
+    """Logarithmic standard deviation of the mask_size x mask_size window around each pixel"""
+    std_log = window_variance(img, size=mask_size)
     std_log[std_log>0] = (np.log(std_log[std_log>0]) - np.log(mask_size**2 - 1)) / 2
+    return std_log
+
+
+def histogram_threshold(std_log):
+    """Threshold on the logarithmic standard deviation: histogram mode plus three widths of the mode"""
 
     # Get width of histogram modulus
     counts, edges = np.histogram(std_log, bins=200)
@@ -68,13 +133,127 @@ def binarize_frame(img, mask_size=3):
     hist_max = bins[np.argmax(counts)]
     sigma = np.std(std_log[std_log <= hist_max])
 
-    # Apply histogram-based threshold
-    img_bin = std_log >= hist_max + 3 * sigma
+    return hist_max + 3 * sigma
 
-    # Remove noise
+
+def clean_mask(img_bin):
+    """Remove noise from a thresholded frame"""
     img_bin = smg.binary_dilation(img_bin, structure=STRUCT3)
     img_bin = smg.binary_fill_holes(img_bin)
     img_bin &= smg.binary_opening(img_bin, iterations=2, structure=STRUCT5)
     img_bin = smg.binary_erosion(img_bin, border_value=1)
-
     return img_bin
+
+
+def binarize_frame(img, mask_size=3, threshold=None):
+    """Coarse segmentation of phase-contrast image frame
+
+    If 'threshold' is None, it is taken from the histogram of the frame (see `histogram_threshold`).
+
+    Returns binarized image of frame
+    """
+    # Get logarithmic standard deviation at each pixel
+    std_log = log_std(img, mask_size=mask_size)
+
+    # Apply histogram-based threshold
+    if threshold is None:
+        threshold = histogram_threshold(std_log)
+    img_bin = std_log >= threshold
+
+    # Remove noise
+    return clean_mask(img_bin)
+
+
+def label_frame(img, mask_size=3, threshold=None):
+    """Threshold segmentation of phase-contrast image frame
+
+    Returns the connected (connectivity 1) regions of the binarized frame as labels
+    """
+    from skimage.measure import label
+    return label(binarize_frame(img, mask_size=mask_size, threshold=threshold), connectivity=1)
+
+
+def binarize_stack(stack, mask_size=3, n_threads=None, labels=False):
+    """Coarse segmentation of a stack of phase-contrast frames, in parallel threads
+
+    stack -- (frames, height, width) array or LazyStack
+    mask_size -- like `binarize_frame`
+    n_threads -- number of frames processed at the same time; if None, use all CPUs;
+            1 runs serially in the calling thread
+    labels -- if True, return labeled regions (as `label_frame`) instead of the binarized frames
+
+    Returns a (frames, height, width) array, np.bool_ or np.int32 if 'labels'.
+    Every frame is processed by itself, so the result does not depend on 'n_threads'.
+    """
+    fun = label_frame if labels else binarize_frame
+    out = np.empty(stack.shape, dtype=np.int32 if labels else np.bool_)
+
+    def process(t):
+        out[t] = fun(np.asarray(stack[t]), mask_size=mask_size)
+
+    if n_threads is None:
+        n_threads = os.cpu_count() or 1
+    n_threads = max(1, min(n_threads, len(out)))
+    if n_threads == 1:
+        for t in range(len(out)):
+            process(t)
+    else:
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            for _ in pool.map(process, range(len(out))):
+                pass
+    return out
+
+
+def tiled_threshold(img, mask_size=3, tile_size=2048, n_threads=None):
+    """`histogram_threshold` of the whole frame, computed tile by tile
+
+    The logarithmic standard deviation is never held for the whole frame; it is computed
+    again for every tile in each of three passes (range, histogram, width of the mode).
+    """
+    from ..tiling import tile_grid, _imap
+
+    s2 = mask_size // 2
+    height, width = img.shape
+    tiles = [core for core, _ in tile_grid(img.shape, tile_size, s2)]
+    if n_threads is None:
+        n_threads = os.cpu_count() or 1
+
+    def tile_std_log(core):
+        # Computed with a border of the window size, so the core has the values of the full frame
+        y0, y1, x0, x1 = core
+        py0, px0 = max(0, y0 - s2), max(0, x0 - s2)
+        tile = log_std(np.asarray(img[py0:min(height, y1 + s2), px0:min(width, x1 + s2)]), mask_size=mask_size)
+        return tile[y0-py0:y1-py0, x0-px0:x1-px0]
+
+    def value_range(core):
+        x = tile_std_log(core)
+        return x.min(), x.max()
+
+    ranges = list(_imap(value_range, tiles, n_threads))
+    hist_range = (min(r[0] for r in ranges), max(r[1] for r in ranges))
+    counts = sum(_imap(lambda core: np.histogram(tile_std_log(core), bins=200, range=hist_range)[0], tiles, n_threads))
+    edges = np.histogram_bin_edges([], bins=200, range=hist_range)
+    bins = (edges[:-1] + edges[1:]) / 2
+    hist_max = bins[np.argmax(counts)]
+
+    def moments(core):
+        # Shifted by the mode, which is close to the mean, to avoid cancellation
+        x = tile_std_log(core)
+        x = x[x <= hist_max] - hist_max
+        return x.size, x.sum(), (x * x).sum()
+    n, s_1, s_2 = np.sum(list(_imap(moments, tiles, n_threads)), axis=0)
+    sigma = np.sqrt(max(s_2 / n - (s_1 / n)**2, 0))
+
+    return hist_max + 3 * sigma
+
+
+def label_frame_tiled(img, mask_size=3, tile_size=2048, overlap=64, n_threads=None):
+    """`label_frame` of a large frame, segmented in overlapping tiles (see `tiling.segment_tiled`)
+
+    The threshold is taken from the whole frame, so away from the seams the cells are those of `label_frame`.
+    """
+    from ..tiling import segment_tiled
+
+    threshold = tiled_threshold(img, mask_size=mask_size, tile_size=tile_size, n_threads=n_threads)
+    return segment_tiled(img, lambda tile: label_frame(tile, mask_size=mask_size, threshold=threshold),
+                         tile_size=tile_size, overlap=overlap, n_threads=n_threads)
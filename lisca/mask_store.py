@@ -0,0 +1,248 @@
+"""Chunked, compressed storage of label masks.
+
+Masks are kept in an HDF5 dataset of shape (frames, height, width) with one
+chunk per frame, so any frame can be read without touching the others.
+Labels are stored as uint32 (more than 255 cells per frame do not merge),
+byte-shuffled before compression, so the mostly zero high bytes of sparse
+fields cost next to nothing on disk. The largest label of every frame is
+stored next to the masks, and frames are read back in the smallest dtype
+holding all labels. Frames are compressed with zlib in a thread pool and
+written as raw chunks in the shuffle + deflate format HDF5 reads natively.
+The dataset grows as frames are appended, so masks can be written while
+segmentation is still running.
+"""
+import os
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import h5py
+import numpy as np
+
+from .stacks import LazyStack, Mp4Stack
+
+DATASET = 'masks'
+MAX_LABEL = 'max_label'
+
+#Mask files of Track, by segmentation method
+MASK_FILES = {'th': 'cyto_masks_th', 'cellpose': 'cyto_masks'}
+
+
+def mask_path(path_out, method='th', ext='.h5'):
+    """Path of the mask file written by Track.segment with `method`."""
+    name = MASK_FILES['th'] if method == 'th' else MASK_FILES['cellpose']
+    return os.path.join(path_out, name + ext)
+
+
+def label_dtype(max_label):
+    """Smallest unsigned integer dtype holding labels up to `max_label`."""
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if max_label <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    raise OverflowError(f'Label {max_label} does not fit into uint32')
+
+
+def compact_labels(mask):
+    """`mask` in the smallest dtype holding its labels (not copied if it already has that dtype)."""
+    mask = np.asarray(mask)
+    return mask.astype(label_dtype(mask.max() if mask.size else 0), copy=False)
+
+
+def stack_labels(masks):
+    """Stack label frames into one array of the smallest dtype holding all of their labels."""
+    masks = [np.asarray(mask) for mask in masks]
+    max_label = max((mask.max() for mask in masks if mask.size), default=0)
+    return np.stack(masks).astype(label_dtype(max_label), copy=False)
+
+
+class MaskWriter:
+
+    def __init__(self, file, frame_shape, dtype='uint32', level=4, n_threads=4, swmr=False):
+        """
+        Append label frames to a new mask file.
+
+        Parameters
+        ----------
+        file : string
+            Output path. An existing file is overwritten.
+        frame_shape : tuple
+            (height, width) of the frames.
+        dtype : string, optional
+            Label dtype on disk, 'uint8', 'uint16' or 'uint32'. The default is 'uint32'.
+        level : int, optional
+            zlib compression level. The default is 4.
+        n_threads : int, optional
+            Number of threads compressing frames. The default is 4.
+        swmr : bool, optional
+            Open the file in single-writer/multiple-reader mode, so a MaskStore can read
+            the frames written so far while writing goes on. The default is False.
+        """
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in (np.uint8, np.uint16, np.uint32):
+            raise ValueError(f'Unsupported label dtype {self.dtype}')
+        self.frame_shape = tuple(frame_shape)
+        self.level = level
+
+        self.file = h5py.File(file, 'w', libver='latest')
+        self.ds = self.file.create_dataset(
+            DATASET, shape=(0,) + self.frame_shape, maxshape=(None,) + self.frame_shape,
+            chunks=(1,) + self.frame_shape, dtype=self.dtype, compression='gzip', compression_opts=level, shuffle=True)
+        self.max_label = self.file.create_dataset(MAX_LABEL, shape=(0,), maxshape=(None,), chunks=(4096,), dtype=self.dtype)
+        self.swmr = swmr
+        if swmr:
+            self.file.swmr_mode = True
+
+        self._pool = ThreadPoolExecutor(max_workers=n_threads)
+        self._pending = deque()
+        self.n_frames = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _compress(self, frame):
+        #Byte shuffle as HDF5's shuffle filter: all first bytes, then all second bytes, ...
+        raw = np.ascontiguousarray(frame, dtype=self.dtype).view(np.uint8).reshape(-1, self.dtype.itemsize)
+        return zlib.compress(np.ascontiguousarray(raw.T).tobytes(), self.level)
+
+    def _write_ready(self, wait=False):
+        #Chunks are written in frame order, as soon as the compression of the oldest frame is done
+        written = False
+        while self._pending and (wait or self._pending[0][2].done()):
+            t, max_label, future = self._pending.popleft()
+            if t >= self.ds.shape[0]:
+                self.ds.resize(t + 1, axis=0)
+                self.max_label.resize(t + 1, axis=0)
+            self.ds.id.write_direct_chunk((t, 0, 0), future.result())
+            self.max_label[t] = max_label
+            written = True
+        if wait or (written and self.swmr):
+            self.file.flush()
+
+    def write_frame(self, frame):
+        """Append one (height, width) label frame."""
+
+        if frame.shape != self.frame_shape:
+            raise ValueError(f'Frame has shape {frame.shape}, expected {self.frame_shape}')
+        max_label = frame.max() if frame.size else 0
+        if max_label > np.iinfo(self.dtype).max:
+            raise OverflowError(f'Label {max_label} does not fit into {self.dtype}')
+        self._pending.append((self.n_frames, max_label, self._pool.submit(self._compress, frame.copy())))
+        self.n_frames += 1
+        self._write_ready()
+
+    def write(self, frames):
+        """Append a (n, height, width) block of frames."""
+        for frame in frames:
+            self.write_frame(frame)
+
+    def flush(self):
+        """Write all frames appended so far to the file."""
+        self._write_ready(wait=True)
+
+    def close(self):
+        if self.file.id.valid:
+            try:
+                self.flush()
+            finally:
+                self._pool.shutdown()
+                self.file.close()
+
+
+class MaskStore(LazyStack):
+
+    def __init__(self, file, swmr=False):
+        """
+        Read-only, lazily indexed mask file written by MaskWriter.
+
+        `store[t]` decompresses a single frame; `store[t, y0:y1, x0:x1]` reads only that region.
+        Frames are returned in the smallest dtype holding the largest label of the file.
+        With swmr=True, `refresh()` picks up frames appended by a writer in SWMR mode.
+        """
+        self.file = h5py.File(file, 'r', libver='latest', swmr=swmr)
+        self.ds = self.file[DATASET]
+        self.channels, self.channel = ['labels'], 0
+        self._set_dtype()
+
+    def _set_dtype(self):
+        if MAX_LABEL in self.file:
+            max_labels = self.file[MAX_LABEL][:]
+            self.dtype = label_dtype(max_labels.max() if max_labels.size else 0)
+        else:
+            #Files written before the largest labels were stored
+            self.dtype = self.ds.dtype
+
+    def max_label(self, t):
+        """Largest label of frame t."""
+        if MAX_LABEL in self.file:
+            return int(self.file[MAX_LABEL][t])
+        return int(self[t].max())
+
+    @property
+    def shape(self):
+        return self.ds.shape
+
+    def refresh(self):
+        self.ds.refresh()
+        if MAX_LABEL in self.file:
+            self.file[MAX_LABEL].refresh()
+        self._set_dtype()
+
+    def _read(self, frames, roi=None):
+        y0, y1, x0, x1 = (0, self.shape[1], 0, self.shape[2]) if roi is None else roi
+        x = np.empty((len(frames), y1 - y0, x1 - x0), dtype=self.dtype)
+        for i, t in enumerate(frames):
+            if x[i].size:
+                self.ds.read_direct(x, source_sel=np.s_[int(t), y0:y1, x0:x1], dest_sel=np.s_[i])
+        return x
+
+    def _read_frame(self, t, out):
+        self.ds.read_direct(out, source_sel=np.s_[t])
+
+    def close(self):
+        self.file.close()
+
+
+def open_masks(path_out, method='th'):
+    """Open the masks of a Track run.
+
+    Returns the MaskStore if present, and falls back to a (lazily decoded) legacy mp4 mask movie.
+    """
+    file = mask_path(path_out, method)
+    if os.path.isfile(file):
+        return MaskStore(file)
+    mp4_file = mask_path(path_out, method, ext='.mp4')
+    if os.path.isfile(mp4_file):
+        return Mp4Stack(mp4_file, as_grey=True)
+    raise FileNotFoundError(f'No masks found at {file} or {mp4_file}')
+
+
+def mp4_to_store(mp4_file, out, dtype='uint16', chunk_size=16):
+    """Convert a lossless mp4 mask movie (e.g. cyto_masks_th.mp4) to a mask file."""
+
+    stack = Mp4Stack(mp4_file, as_grey=True)
+    with MaskWriter(out, stack.shape[1:], dtype=dtype) as writer:
+        for _, frames in stack.iter_chunks(chunk_size):
+            writer.write(frames)
+    stack.close()
+
+
+def store_to_mp4(file, out, rate=10, crf=0):
+    """Export a mask file as 8-bit lossless mp4, e.g. for viewing in a video player.
+
+    Labels above 255 do not fit into the movie and are wrapped around, so the export is only exact
+    if all labels are below 256.
+    """
+    from .video_writer import Mp4writer
+
+    store = MaskStore(file)
+    writer = Mp4writer(out, rate=rate, crf=crf, queue_size=8)
+    for _, frames in store.iter_chunks():
+        if frames.size and frames.max() > 255:
+            print(f'Labels above 255 in {os.path.basename(file)} are wrapped around in the mp4 export')
+        for frame in frames:
+            writer.write_frame(frame.astype('uint8'))
+    writer.close()
+    store.close()
@@ -0,0 +1,524 @@
+"""Shared, cached access to ND2 files.
+
+Opening an ND2 file makes nd2reader parse the chunk map and the full
+metadata block, which takes longer than reading a frame. The readers here
+are opened once per process and kept in a small LRU cache keyed by path,
+so the pipeline and the viewers can ask for frames repeatedly without
+re-parsing the file.
+
+Sizes, channel labels and the file offset of every image are also saved to
+a sidecar index next to the file (see `ND2Index`). Once it exists, opening
+a file and reading frames does not need nd2reader at all.
+"""
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+from nd2reader import ND2Reader
+
+#Layout forced by manual=True for files whose metadata reports wrong sizes
+MANUAL_NFOV, MANUAL_NFRAMES = 288, 179
+
+#Every ND2 chunk starts with (magic, relative data offset, data length)
+CHUNK_HEADER = struct.Struct('IIQ')
+CHUNK_MAGIC = 0xabeceda
+#Image groups start with an 8 byte timestamp before the interleaved pixels
+TIMESTAMP_BYTES = 8
+
+
+def open_reader(file, manual=False):
+    """Open a new (uncached) ND2Reader, applying the manual layout if requested."""
+
+    f = ND2Reader(file)
+    if manual:
+        f.sizes['v'] = MANUAL_NFOV
+        f.sizes['t'] = MANUAL_NFRAMES
+        f.metadata['fields_of_view'] = list(range(MANUAL_NFOV))
+    return f
+
+
+INDEX_VERSION = 1
+
+
+class ND2Index:
+
+    def __init__(self, sizes, channels, offsets, rel_offset, data_length, stamp=None):
+        """
+        Layout of an nd2 file: sizes, channel labels and the position of every image.
+
+        Parameters
+        ----------
+        sizes : dict
+            Sizes as reported by nd2reader ('x', 'y', 'c', 't', 'v', ...).
+        channels : list of string
+            Channel labels.
+        offsets : numpy array
+            (v, t) file offsets of the image chunks, -1 where an image is missing.
+        rel_offset, data_length : int
+            Layout of the image chunks, taken from the first chunk.
+        stamp : tuple, optional
+            (size, mtime_ns) of the file the index was built from.
+        """
+        self.sizes = dict(sizes)
+        self.channels = list(channels)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.rel_offset = int(rel_offset)
+        self.data_length = int(data_length)
+        self.stamp = None if stamp is None else tuple(stamp)
+        self.height, self.width = self.sizes['y'], self.sizes['x']
+
+    @property
+    def metadata(self):
+        """The subset of nd2reader's metadata held by the index."""
+        return {'height': self.height, 'width': self.width, 'channels': self.channels}
+
+    @classmethod
+    def from_reader(cls, f, stamp=None):
+        """Build the index from an open ND2Reader."""
+
+        n_fov = len(f.metadata['fields_of_view']) or 1
+        n_frames = f.sizes.get('t', 1)
+        label_map = f.parser._label_map
+        offsets = np.full((n_fov, n_frames), -1, dtype=np.int64)
+        for v in range(n_fov):
+            for t in range(n_frames):
+                try:
+                    offsets[v, t] = label_map.get_image_data_location(image_group_number(f, v, t))
+                except KeyError:
+                    continue
+
+        rel_offset, data_length = 0, 0
+        if (offsets >= 0).any():
+            f._fh.seek(int(offsets[offsets >= 0][0]))
+            _, rel_offset, data_length = CHUNK_HEADER.unpack(f._fh.read(CHUNK_HEADER.size))
+        sizes = {k: int(n) for k, n in f.sizes.items()}
+        return cls(sizes, f.metadata['channels'], offsets, rel_offset, data_length, stamp=stamp)
+
+    def save(self, path):
+        """Write the index to `path` (atomically, so readers never see a partial file)."""
+
+        meta = {'version': INDEX_VERSION, 'stamp': self.stamp, 'sizes': self.sizes, 'channels': self.channels,
+                'rel_offset': self.rel_offset, 'data_length': self.data_length}
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                np.savez(fh, offsets=self.offsets, meta=np.array(json.dumps(meta)))
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    @classmethod
+    def load(cls, path, stamp=None):
+        """Read an index, returning None if it is missing, unreadable or was built for another `stamp`."""
+
+        try:
+            with np.load(path) as data:
+                meta = json.loads(str(data['meta']))
+                offsets = data['offsets']
+        except (OSError, ValueError, KeyError):
+            return None
+        if meta.get('version') != INDEX_VERSION or (stamp is not None and tuple(meta['stamp']) != tuple(stamp)):
+            return None
+        return cls(meta['sizes'], meta['channels'], offsets, meta['rel_offset'], meta['data_length'], stamp=meta['stamp'])
+
+
+def index_paths(file, manual=False):
+    """Candidate locations of the index of `file`: next to the file, then in the user's cache directory."""
+
+    path = os.path.abspath(file)
+    name = os.path.basename(path) + ('.manual' if manual else '') + '.lisca-index.npz'
+    cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'lisca', 'nd2-index')
+    key = hashlib.sha1(path.encode()).hexdigest()[:16]
+    return [os.path.join(os.path.dirname(path), '.' + name), os.path.join(cache_dir, key + '-' + name)]
+
+
+def build_index(file, manual=False, stamp=None, save=True):
+    """Parse `file` with nd2reader and build its index, saving it to the first writable location."""
+
+    if stamp is None:
+        st = os.stat(file)
+        stamp = (st.st_size, st.st_mtime_ns)
+    f = open_reader(file, manual=manual)
+    try:
+        index = ND2Index.from_reader(f, stamp=stamp)
+    finally:
+        f.close()
+    if save:
+        save_index(index, file, manual)
+    return index
+
+
+def save_index(index, file, manual=False):
+    """Save the index of `file` to the first writable location of `index_paths`; return the path or None."""
+
+    for path in index_paths(file, manual):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            index.save(path)
+            return path
+        except OSError:
+            continue
+    return None
+
+
+def load_index(file, manual=False, stamp=None):
+    """Load the saved index of `file` if it matches the file's current size and mtime, else None."""
+
+    if stamp is None:
+        st = os.stat(file)
+        stamp = (st.st_size, st.st_mtime_ns)
+    for path in index_paths(file, manual):
+        index = ND2Index.load(path, stamp)
+        if index is not None:
+            return index
+    return None
+
+
+class _Entry:
+
+    def __init__(self, path, manual, stamp):
+        #The reader, the index and the raw file handle are opened on first use
+        self.path, self.manual, self.stamp = path, manual, stamp
+        self.lock = threading.RLock()
+        self._reader = None
+        self._index = None
+        self._fh = None
+
+    @property
+    def reader(self):
+        with self.lock:
+            if self._reader is None:
+                self._reader = open_reader(self.path, manual=self.manual)
+            return self._reader
+
+    @property
+    def index(self):
+        with self.lock:
+            if self._index is None:
+                self._index = load_index(self.path, self.manual, self.stamp)
+            if self._index is None:
+                if self._reader is not None:
+                    self._index = ND2Index.from_reader(self._reader, stamp=self.stamp)
+                    save_index(self._index, self.path, self.manual)
+                else:
+                    self._index = build_index(self.path, self.manual, self.stamp)
+            return self._index
+
+    @property
+    def fh(self):
+        with self.lock:
+            if self._fh is None:
+                self._fh = open(self.path, 'rb')
+            return self._fh
+
+    def close(self):
+        #Wait for a read in progress on another thread before closing the handles
+        with self.lock:
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+
+
+class ReaderCache:
+
+    def __init__(self, maxsize=8):
+        """
+        LRU cache of open ND2 readers.
+
+        Parameters
+        ----------
+        maxsize : int, optional
+            Maximum number of files kept open. The least recently used reader is closed when
+            a new file would exceed this number. The default is 8.
+        """
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, file):
+        return any(key[0] == os.path.abspath(file) for key in self._entries)
+
+    def entry(self, file, manual=False):
+        """Return the cache entry for `file`, opening the file if needed.
+
+        A cached reader is reopened if the file size or modification time changed since it was opened.
+        """
+        path = os.path.abspath(file)
+        st = os.stat(path)
+        stamp = (st.st_size, st.st_mtime_ns)
+        key = (path, manual)
+
+        evicted = []
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.stamp == stamp:
+                self._entries.move_to_end(key)
+                return entry
+            if entry is not None:
+                evicted.append(self._entries.pop(key))
+
+            entry = _Entry(path, manual, stamp)
+            self._entries[key] = entry
+            evicted += self._trim()
+
+        for old in evicted:
+            old.close()
+        return entry
+
+    def get(self, file, manual=False):
+        return self.entry(file, manual=manual).reader
+
+    def evict(self, file):
+        """Close and forget all readers for `file`."""
+        path = os.path.abspath(file)
+        with self._lock:
+            evicted = [self._entries.pop(key) for key in list(self._entries) if key[0] == path]
+        for old in evicted:
+            old.close()
+
+    def resize(self, maxsize):
+        """Change the number of readers kept open, closing the oldest ones if necessary."""
+        with self._lock:
+            self.maxsize = maxsize
+            evicted = self._trim()
+        for old in evicted:
+            old.close()
+
+    def clear(self):
+        with self._lock:
+            evicted = list(self._entries.values())
+            self._entries.clear()
+        for old in evicted:
+            old.close()
+
+    def _trim(self):
+        #Entries are closed by the caller after releasing the cache lock
+        evicted = []
+        while len(self._entries) > max(self.maxsize, 1):
+            evicted.append(self._entries.popitem(last=False)[1])
+        return evicted
+
+
+_cache = ReaderCache()
+
+
+def get_reader(file, manual=False):
+    """Return the shared ND2Reader for `file`.
+
+    The reader may be closed when it is evicted from the cache, so callers should not keep it
+    around; call get_reader again instead (it is cheap once the file is open).
+    """
+    return _cache.get(file, manual=manual)
+
+
+def get_index(file, manual=False):
+    """Return the ND2Index of `file`, from the sidecar index if it is up to date.
+
+    Sizes and channel labels are available from the index without parsing the file.
+    """
+    return _cache.entry(file, manual=manual).index
+
+
+@contextmanager
+def locked_reader(file, manual=False):
+    """Context manager yielding the shared reader for `file` while holding its lock.
+
+    nd2reader seeks and reads on a single file handle, so reads from several threads
+    must not interleave.
+    """
+    entry = _cache.entry(file, manual=manual)
+    with entry.lock:
+        yield entry.reader
+
+
+class ND2ReaderMixin:
+    """Provide `self.f`, the shared reader for `self.nd2file` (and `self.manual`), and its `self.index`.
+
+    The reader is looked up on every access, so an instance never holds on to a
+    handle that the cache has since closed.
+    """
+
+    @property
+    def f(self):
+        return get_reader(self.nd2file, manual=getattr(self, 'manual', False))
+
+    @property
+    def index(self):
+        return get_index(self.nd2file, manual=getattr(self, 'manual', False))
+
+
+def set_cache_size(maxsize):
+    _cache.resize(maxsize)
+
+
+def clear_cache():
+    _cache.clear()
+
+
+def image_group_number(f, v, t, z=0):
+    """Index of the image group holding all channels of (v, t, z), as numbered by nd2reader."""
+
+    z_length = len(f.metadata['z_levels']) or 1
+    n_fov = len(f.metadata['fields_of_view']) or 1
+    return t * n_fov * z_length + v * z_length + z
+
+
+def _coalesce(offsets, span, max_gap, max_read):
+    """Group sorted chunk offsets into runs that are read with a single call.
+
+    Chunks closer than `max_gap` bytes are merged, reading over the gap, as long as
+    the run stays within `max_read` bytes (a larger single chunk is still one run).
+    Yields (start, stop, members) with members the positions in `offsets`.
+    """
+    run = [0]
+    for i in range(1, len(offsets)):
+        if offsets[i] - (offsets[run[-1]] + span) <= max_gap and offsets[i] + span - offsets[run[0]] <= max_read:
+            run.append(i)
+        else:
+            yield offsets[run[0]], offsets[run[-1]] + span, run
+            run = [i]
+    yield offsets[run[0]], offsets[run[-1]] + span, run
+
+
+def _read_exact(fh, start, buffer):
+    """Fill `buffer` with the bytes of `fh` from `start` on; raise EOFError if the file ends first."""
+
+    view = memoryview(buffer).cast('B')
+    fh.seek(int(start))
+    n = fh.readinto(view)
+    if n != view.nbytes:
+        raise EOFError(f'{fh.name} is truncated: read {n} of {view.nbytes} bytes at offset {start}')
+
+
+def read_block(file, v, frames, c=None, out=None, manual=False, max_gap=1<<20, max_read=4<<20, roi=None):
+    """
+    Read a block of frames and channels of one field of view.
+
+    The file offsets of the whole selection are looked up in the index first. The chunks are then read in
+    file order, merging nearby chunks into single reads of at most `max_read` bytes, and the pixels are
+    copied from the read buffer straight into `out`. Chunks that hold only the requested channel are read
+    into `out` directly. With a region of interest only the rows it covers are read.
+
+    Parameters
+    ----------
+    file : string
+        Path to the nd2 file.
+    v : int
+        Field of view.
+    frames : int or array of int
+        Time indices to read, in the order they should appear in the output.
+    c : int or list of int, optional
+        Channel index, or list of channel indices. The default is None, which reads channel 0.
+    out : numpy array, optional
+        uint16 array to fill, of shape (len(frames), height, width) for a single channel or
+        (len(frames), len(c), height, width) for a list of channels.
+    manual : bool, optional
+        Use the manual FOV/frame layout, see `open_reader`.
+    max_gap : int, optional
+        Largest gap in bytes between two chunks that are still read in one call. The default is 1 MiB.
+    max_read : int, optional
+        Largest number of bytes read in one call when merging chunks, which bounds the read buffer.
+        The default is 4 MiB.
+    roi : tuple, optional
+        (y0, y1, x0, x1) region to read; height and width of `out` are those of the region.
+        The default is None, which reads full frames.
+
+    Returns
+    -------
+    out : numpy array
+        The frames. A scalar `frames` drops the frame axis.
+    """
+    single_frame = np.ndim(frames) == 0
+    frames = np.atleast_1d(np.asarray(frames, dtype=np.intp))
+    single_channel = c is None or np.ndim(c) == 0
+    channels = np.atleast_1d(np.asarray(0 if c is None else c, dtype=np.intp))
+
+    entry = _cache.entry(file, manual=manual)
+    with entry.lock:
+        index = entry.index
+        height, width = index.height, index.width
+        y0, y1, x0, x1 = (0, height, 0, width) if roi is None else roi
+        if not (0 <= y0 <= y1 <= height and 0 <= x0 <= x1 <= width):
+            raise ValueError(f'roi {roi} outside of the {height}x{width} frame')
+
+        shape = (frames.size, y1 - y0, x1 - x0) if single_channel else (frames.size, channels.size, y1 - y0, x1 - x0)
+        if out is None:
+            out = np.empty(shape, dtype='uint16')
+        elif out.shape != shape:
+            raise ValueError(f'out has shape {out.shape}, expected {shape}')
+        dest = out[:, np.newaxis] if single_channel else out
+
+        if frames.size == 0:
+            return out
+
+        offsets = index.offsets[v, frames]
+        if (offsets < 0).any():
+            raise IndexError(f'no image for fov {v}, frame {frames[offsets < 0][0]} in {file}')
+        order = np.argsort(offsets, kind='stable')
+
+        #The chunk layout is taken from the index and checked again for every chunk below
+        fh = entry.fh
+        rel_offset, data_length = index.rel_offset, index.data_length
+        span = CHUNK_HEADER.size + rel_offset + data_length
+        n_true_channels, padding = divmod(data_length - TIMESTAMP_BYTES, 2 * height * width)
+        row_bytes = 2 * width * n_true_channels
+        pixel_start = CHUNK_HEADER.size + rel_offset + TIMESTAMP_BYTES
+
+        #Read whole chunks, or only the rows of the roi; the header is then read on its own
+        full_rows = (y0, y1) == (0, height)
+        lo, hi = (0, span) if full_rows else (pixel_start + y0 * row_bytes, pixel_start + y1 * row_bytes)
+        #Chunks of single channel files hold the rows exactly as `out` does, so they are read straight into it
+        direct = n_true_channels == 1 and channels.size == 1 and (x0, x1) == (0, width) and out.dtype == np.dtype('<u2') and out.flags.c_contiguous
+        header = np.empty(CHUNK_HEADER.size, dtype=np.uint8)
+
+        def usual(magic, rel, length):
+            return magic == CHUNK_MAGIC and rel == rel_offset and length == data_length and not padding and channels.max() < n_true_channels
+
+        def from_reader(i):
+            #Unusual chunk (e.g. row padding in stitched files): let nd2reader handle it
+            for j, ch in enumerate(channels):
+                dest[i, j] = entry.reader.get_frame_2D(v=v, t=int(frames[i]), c=int(ch))[y0:y1, x0:x1]
+
+        if direct:
+            for i in order:
+                _read_exact(fh, offsets[i], header)
+                if usual(*CHUNK_HEADER.unpack(header)):
+                    _read_exact(fh, offsets[i] + pixel_start + y0 * row_bytes, dest[i, 0])
+                else:
+                    from_reader(i)
+        else:
+            scratch = np.empty(0, dtype=np.uint8)
+            for start, stop, run in _coalesce(offsets[order] + lo, hi - lo, max_gap, max_read):
+                if scratch.size < stop - start:
+                    scratch = np.empty(stop - start, dtype=np.uint8)
+                _read_exact(fh, start, scratch[:stop - start])
+
+                for i in order[run]:
+                    pos = int(offsets[i] + lo - start)
+                    if full_rows:
+                        magic, rel, length = CHUNK_HEADER.unpack_from(scratch, pos)
+                        pos += pixel_start
+                    else:
+                        _read_exact(fh, offsets[i], header)
+                        magic, rel, length = CHUNK_HEADER.unpack(header)
+                    if not usual(magic, rel, length):
+                        from_reader(i)
+                        continue
+                    pixels = scratch[pos:pos + (y1 - y0) * row_bytes].view('<u2').reshape(y1 - y0, width, n_true_channels)
+                    for j, ch in enumerate(channels):
+                        np.copyto(dest[i, j], pixels[:, x0:x1, ch], casting='unsafe')
+
+    return out[0] if single_frame else out
@@ -1,7 +1,6 @@
 from genericpath import isfile
 from skimage import io
 import sys
-from tifffile import TiffFile, imread
 from tqdm import tqdm
 sys.path.append('..')
 from . import functions
@@ -12,16 +11,22 @@ import os
 import pandas as pd
 import skvideo.io
 import json
-from nd2reader import ND2Reader
-from .segmentation import Segmentation
-from .video_writer import Mp4writer
+from . import nd2_io
+from . import stacks
+from . import util
+from . import mask_store
+from . import track_store
+from . import seg_cache
+from . import tiling
+from .mask_store import MaskWriter
+from .executor import run_pipelined
 from lisca import tracking
 from .img_op.background_correction import background_schwarzfischer
 
 
 class Track:
     
-    def __init__(self, path_out, data_path, bf_channel, fl_channels, fov, bf_file=None, nucleus_file=None, nd2_file=None, lanes_file=None, frame_indices=None, max_memory=None, dataset_id=None, image_id=None, ome_host='omero.physik.uni-muenchen.de', ome_user_name=None, ome_password=None, manual=False):
+    def __init__(self, path_out, data_path, bf_channel, fl_channels, fov, bf_file=None, nucleus_file=None, nd2_file=None, lanes_file=None, frame_indices=None, max_memory=None, dataset_id=None, image_id=None, ome_host='omero.physik.uni-muenchen.de', ome_user_name=None, ome_password=None, manual=False, single_pass=False):
         """
         A class to run full tracking part of the pipeline on one field of view. The class should contain the methods for the bf segmentation, nucleus tracking, and the rearranging of the nuclei with the bf contours. The final output should be a set of 3darrays (frame_number, nuclear_position, front, rear) each for one particle.
 
@@ -42,6 +47,11 @@ class Track:
         nd2_file : string, optional
             ND2file
         fov : int, field of view to read from nd2 file.
+        single_pass : bool, optional
+            Only for nd2 files. Decode the bf and fluorescence channels of every frame in one pass on first use and
+            serve all later reads (segmentation, tracking, export) from that block. The block is kept in memory
+            or, if larger than max_memory or half the available memory, in a temporary file in path_out/tmp.
+            The default is False.
             
 
         Returns
@@ -53,6 +63,7 @@ class Track:
         self.path_out = path_out
         self.metadata = {}
         self.df_path = os.path.join(self.path_out, 'tracking_data.csv')
+        self.tracks_path = track_store.tracks_path(self.path_out)
         self.clean_df_path = os.path.join(self.path_out, 'clean_tracking_data.csv')
         self.meta_path = os.path.join(self.path_out, 'metadata.json')
         self.max_memory=max_memory
@@ -64,6 +75,10 @@ class Track:
         self.manual=manual
         self.bf_channel=bf_channel
         self.fl_channels=[*fl_channels]
+        self.single_pass=single_pass
+        self.pass_channels=list(dict.fromkeys([bf_channel, *fl_channels]))
+        self._channel_block=None
+        self._stacks={}
 
         if dataset_id is not None:
 
@@ -85,45 +100,30 @@ class Track:
         elif nd2_file is not None:
 
             self.omero=False
-            #Read from full nd2 file
-            f = ND2Reader(os.path.join(data_path, nd2_file))
-            if manual:
-                self.nfov, self.nframes = 288, 179
-                f.sizes['v']=self.nfov
-                f.sizes['t']=self.nframes
-                self.n_images=self.nframes
-                f.metadata['fields_of_view']=list(range(self.nfov))
-            else:
-                self.nfov = f.sizes['v']
-                self.n_images = f.sizes['t']
-            
-            self.height, self.width = f.sizes['y'], f.sizes['x']
+            #Sizes and channel labels come from the sidecar index, so the file is only parsed once
+            index = nd2_io.get_index(os.path.join(data_path, nd2_file), manual=manual)
+            self.nfov = index.sizes['v']
+            self.channel_labels = index.channels
+
+            self.n_images, self.height, self.width = self.stack(bf_channel).shape
             self.frame_indices = np.arange(0, self.n_images)
-            self.channel_labels = f.metadata['channels']
             
 
-        elif bf_file.endswith('.mp4'):
-
-            self.omero=False
-
-            video = skvideo.io.FFmpegReader(os.path.join(data_path, bf_file))
-
-            self.n_images, self.height, self.width = video.getShape()[:3]
-
-        elif bf_file.endswith('.tif'):
+        else:
 
             self.omero=False
-
-            tif = TiffFile(os.path.join(data_path, bf_file))
-            self.height, self.width = tif.pages[0].shape
+            #Single channel mp4 or tif files: bf_file holds the bf channel, nucleus_file the fluorescence channels
+            self.bf_file = bf_file
+            self.nucleus_file = nucleus_file
+            self.channel_files = {c: nucleus_file for c in self.fl_channels}
+            self.channel_files[bf_channel] = bf_file
+            self.channel_labels = {c: os.path.splitext(os.path.basename(file))[0] for c, file in self.channel_files.items()}
+
+            self.n_images, self.height, self.width = self.stack(bf_channel).shape
             if frame_indices is None:
-                self.n_images = len(tif.pages)
-                self.height, self.width = tif.pages[0].shape
                 self.frame_indices = np.arange(0, self.n_images)
             else:
                 self.n_images = len(frame_indices)
-                self.height, self.width = tif.pages[0].shape
-                self.frame_indices=frame_indices
 
         if max_memory is None:
             self.max_stack = self.n_images
@@ -144,146 +144,243 @@ class Track:
                 channel=0
                 return self.conn.get_np(self.image_id, frames, channel)
 
-        if self.nd2_file is not None:
+        frames = 0 if frames is None else frames
 
-            return functions.read_nd2(os.path.join(self.data_path, self.nd2_file), self.fov, frames, c=c, manual=self.manual)
-            
+        if self.single_pass and self.nd2_file is not None and c in self.pass_channels:
+            block = self.read_channels()
+            return np.asarray(block[frames, self.pass_channels.index(c)])
 
-        if self.bf_file.endswith('.mp4'):
+        return self.stack(c)[frames]
 
-            if channel==0 or channel=='bf' or channel=='bf':
-                return functions.mp4_to_np(os.path.join(self.data_path, self.bf_file), frames=frames)
-            elif channel==1 or channel=='nucleus':
-                return functions.mp4_to_np(os.path.join(self.data_path, self.nucleus_file), frames=frames)
-        
-        if self.nucleus_file.endswith('.tif'):
+    def stack(self, c):
+        """Return channel `c` as a LazyStack ([t, y, x] indexing, pixels are read on access)."""
 
-            if channel==0 or channel=='bf' or channel=='bf':
-                    return imread(os.path.join(self.data_path, self.bf_file), key=frames)
-            if channel==1 or channel=='nucleus':
-                    return imread(os.path.join(self.data_path, self.nucleus_file), key=frames)
+        if c not in self._stacks:
+            if self.nd2_file is not None:
+                self._stacks[c] = stacks.ND2Stack(os.path.join(self.data_path, self.nd2_file), self.fov, c=c, manual=self.manual)
+            else:
+                #mp4 files are read as grey values, like mp4_to_np
+                self._stacks[c] = stacks.open_stack(os.path.join(self.data_path, self.channel_files[c]), as_grey=True)
+        return self._stacks[c]
+
+    def iter_frames(self, c, frames=None, read_ahead=2):
+        """Yield (frame index, frame) for channel `c`, reading ahead in the background, see `LazyStack.iter_frames`."""
+
+        if self.single_pass and self.nd2_file is not None and c in self.pass_channels:
+            block = self.read_channels()
+            idx = self.pass_channels.index(c)
+            for t in (range(self.n_images) if frames is None else frames):
+                yield int(t), block[t, idx]
+            return
+
+        yield from self.stack(c).iter_frames(frames, read_ahead=read_ahead)
+
+    def read_channels(self, chunk_size=16):
+        """Return the (n_images, channel, height, width) block of self.pass_channels, decoding it on first use.
+
+        Each nd2 image group holds all channels of one frame, so reading them together decodes every
+        group exactly once.
+        """
+        if self._channel_block is not None:
+            return self._channel_block
+
+        shape = (self.n_images, len(self.pass_channels), self.height, self.width)
+        nbytes = np.prod(shape, dtype=np.int64)*2
+        if (self.max_memory is not None and nbytes > self.max_memory) or nbytes > util.mem_avail()/2:
+            tmp_file = util.open_tempfile(os.path.join(self.path_out, 'tmp'))
+            block = np.memmap(tmp_file, mode='w+', shape=shape, dtype='uint16')
+        else:
+            block = np.empty(shape, dtype='uint16')
+
+        file = os.path.join(self.data_path, self.nd2_file)
+        print(f'Reading channels {self.pass_channels} in a single pass...')
+        for start in tqdm(range(0, self.n_images, chunk_size)):
+            frames = np.arange(start, min(start+chunk_size, self.n_images))
+            nd2_io.read_block(file, self.fov, frames, c=self.pass_channels, out=block[frames[0]:frames[-1]+1], manual=self.manual)
+
+        self._channel_block = block
+        return block
 
-    def segment(self, pretrained_model=None, flow_threshold=0.8, mask_threshold=-2, gpu=True, model_type='bf', diameter=29, verbose=False, method='th'):
+    def segment(self, pretrained_model=None, flow_threshold=0.8, mask_threshold=-2, gpu=True, model_type='bf', diameter=29, verbose=False, method='th', prefetch=2, n_threads=None, batch_size=8, cache=False, tile_size=None, overlap=64, roi_mask=None, roi_margin=16, noise_floor=None):
 
         
         self.metadata.update(locals())
         self.metadata.pop('self')
+        if roi_mask is not None and not isinstance(roi_mask, str):
+            self.metadata['roi_mask'] = 'array'
         with open(self.meta_path, "w") as outfile:
             json.dump(dict(self.metadata), outfile)
         
         
         
+        #With cache=True, masks of frames segmented before with the same parameters (e.g. before a crash) are taken
+        #from the on-disk segmentation cache in ~/.cache/lisca/segmentation, see seg_cache.get_cache
+        cache = seg_cache.get_cache() if cache else None
+
         if method=='th':
-            return self.th_segment()
+            return self.th_segment(prefetch=prefetch, n_threads=n_threads, batch_size=batch_size, cache=cache, tile_size=tile_size, overlap=overlap, roi_mask=roi_mask, roi_margin=roi_margin, noise_floor=noise_floor)
 
-        file=os.path.join(self.path_out, 'cyto_masks.mp4')
-        if os.path.isfile(file):
-            os.remove(file)
+        segmenter = Segmentation(gpu=gpu, pretrained_model=pretrained_model, model_type=model_type, diameter=diameter, flow_threshold=flow_threshold, mask_threshold=mask_threshold, n_threads=n_threads)
 
-        writer = Mp4writer(file)
-        
-        segmenter = Segmentation(gpu=gpu, pretrained_model=pretrained_model, model_type=model_type, diameter=diameter, flow_threshold=flow_threshold, mask_threshold=mask_threshold)
+        def segment_frame(image):
+            if tile_size is None:
+                return segmenter.segment_image(image, diameter, flow_threshold, mask_threshold)
+            #Large frames are segmented tile by tile
+            return segmenter.segment_tiled(image, tile_size=tile_size, overlap=overlap, n_threads=n_threads, diameter=diameter, flow_threshold=flow_threshold, mask_threshold=mask_threshold)
+
+        segment_batch = None
+        if tile_size is None:
+            segment_batch = lambda images: segmenter.segment_stack(images, batch_size=batch_size, diameter=diameter, flow_threshold=flow_threshold, mask_threshold=mask_threshold)
 
         print('Running segmentation with cellpose...')
-        for frame in tqdm(range(self.n_images)):
-            
-            image = self.read_image(self.bf_channel, frame)
-            mask = segmenter.segment_image(image, diameter=diameter, flow_threshold=flow_threshold, mask_threshold=mask_threshold)
-            writer.write_frame(mask)
-        
-        writer.close()
+        #Batches of frames are decoded and masks written in background threads while cellpose runs
+        self._segment_frames(method, segment_frame, segment_batch, batch_size=batch_size, prefetch=prefetch, n_threads=n_threads, cache=cache,
+            tile_size=tile_size, overlap=overlap, roi_mask=roi_mask, roi_margin=roi_margin, noise_floor=noise_floor,
+            model=segmenter.model, diameter=diameter, flow_threshold=flow_threshold, mask_threshold=mask_threshold)
 
         return
     
-    def th_segment(self):
+    def th_segment(self, prefetch=2, n_threads=None, batch_size=8, cache=None, tile_size=None, overlap=64, roi_mask=None, roi_margin=16, noise_floor=None):
 
         from .img_op import background_correction, coarse_binarize_phc
-        from skimage.measure import label
 
-        file = os.path.join(self.path_out, 'cyto_masks_th.mp4')
-        
-        if os.path.isfile(file):
-            os.remove(file)
+        #The frames of a batch are segmented in parallel, one frame per thread; large frames one at a time, one tile per thread
+        if n_threads is None:
+            n_threads = os.cpu_count() or 1
+
+        def segment_frame(image):
+            if tile_size is None:
+                return coarse_binarize_phc.label_frame(image)
+            return coarse_binarize_phc.label_frame_tiled(image, tile_size=tile_size, overlap=overlap, n_threads=n_threads)
+
+        segment_batch = None
+        if tile_size is None:
+            segment_batch = lambda images: coarse_binarize_phc.binarize_stack(np.asarray(images), n_threads=n_threads, labels=True)
 
-        writer = Mp4writer(os.path.join(self.path_out, 'cyto_masks_th.mp4'))
-        
         print('Running segmentation with thresholding...')
-        for frame in tqdm(range(self.n_images)):
-            
-            image = self.read_image(self.bf_channel, frame)
-            mask = coarse_binarize_phc.binarize_frame(image)
-            if mask.max()>255:
-                print('overflow in threshold segmentation')
-            mask = np.clip(label(mask, connectivity=1), a_max=255, a_min=0).astype('uint8')
-            #print(np.unique(mask))
-            #import matplotlib.pyplot as plt
-            #plt.imshow(mask)
-            #plt.show()
-            #sys.exit()
-            writer.write_frame(mask)
-        
-        writer.close()
+        self._segment_frames('th', segment_frame, segment_batch, batch_size=batch_size, prefetch=prefetch, n_threads=n_threads, cache=cache,
+            tile_size=tile_size, overlap=overlap, roi_mask=roi_mask, roi_margin=roi_margin, noise_floor=noise_floor,
+            mask_size=3)
 
         return
 
-    def track(self, track_memory=15, max_travel=30, min_frames=10, pixel_to_um=1, verbose=False, method='th'):
+    def _segment_frames(self, method, segment_frame, segment_batch=None, *, batch_size=8, prefetch=2, n_threads=None, cache=None, tile_size=None, overlap=64, roi_mask=None, roi_margin=16, noise_floor=None, model=None, **params):
+        """Segment all frames into the mask store of `method`, in batches, only inside `roi_mask` and skipping frames below `noise_floor`."""
+
+        boxes = None
+        if roi_mask is not None:
+            if isinstance(roi_mask, str):
+                roi_mask = np.load(roi_mask) if roi_mask.endswith('.npy') else io.imread(roi_mask)
+            #Only the bounding boxes of the region are segmented, so cropped frames are segmented one by one
+            boxes = tiling.roi_boxes(roi_mask, margin=roi_margin)
+            params.update(roi=seg_cache.frame_key(np.asarray(roi_mask) > 0, 'roi'), roi_margin=roi_margin)
+        if tile_size is not None:
+            params.update(tile_size=tile_size, overlap=overlap)
+        if noise_floor is not None:
+            params.update(noise_floor=noise_floor)
+        if boxes is not None or segment_batch is None:
+            batch_size = 1
+
+        def segment(images):
+            return tiling.segment_frames(images, segment_frame, segment_batch, boxes=boxes, noise_floor=noise_floor, n_threads=n_threads)
+
+        def compute(images):
+            if cache is None:
+                return segment(images)
+            return cache.segment(images, segment, method, model, **params)
+
+        def write(frames, masks):
+            for mask in masks:
+                writer.write_frame(mask)
+
+        batches = [list(range(i, min(i+batch_size, self.n_images))) for i in range(0, self.n_images, batch_size)]
+        #Masks go to a chunked label store with one compressed chunk per frame, closed even if a stage fails
+        with MaskWriter(mask_store.mask_path(self.path_out, method), (self.height, self.width)) as writer:
+            run_pipelined(batches,
+                read=lambda frames: self.read_image(self.bf_channel, frames),
+                compute=compute,
+                write=write,
+                depth=prefetch,
+                weight=len)
+
+    def track(self, track_memory=15, max_travel=30, min_frames=10, pixel_to_um=1, verbose=False, method='th', csv=False):
 
         ##Calculate centroids of each mask, then save dataframe with particle_id, positions with trackpy. Then link and obtain tracks. Then calculate fluorescence
+        ##The table goes to tracking_data.h5 (see track_store); csv=True also writes tracking_data.csv
         
-        if method=='th':
-            file=os.path.join(self.path_out, 'cyto_masks_th.mp4')
-        else:
-            file=os.path.join(self.path_out, 'cyto_masks.mp4')
-    
-        masks = skvideo.io.vread(file, as_grey=False)[:,:,:,0].copy()
+        #Masks and images are streamed frame by frame
+        masks = mask_store.open_masks(self.path_out, method)
 
         df = tracking.track(masks, track_memory=track_memory, max_travel=max_travel, min_frames=min_frames, pixel_to_um=1, verbose=False)
-        df.to_csv(self.df_path)
-        #df = pd.read_csv(self.df_path)
+        #Unique row ids, so the fluorescence columns can be aligned to the stored rows
+        df = df.reset_index(drop=True)
+        track_store.write_tracks(self.tracks_path, df)
+        #df = track_store.read_tracks(self.tracks_path)
     
         for fl_channel in self.fl_channels:
             label= self.channel_labels[fl_channel]
-            fl_image = self.read_image(c=fl_channel, frames=np.arange(self.n_images))
             print(f'Reading channel {label}..')
-            df = tracking.read_fluorescence(df, fl_image, masks, label)
-            
-            del fl_image
+            df = tracking.read_fluorescence(df, self.iter_frames(fl_channel), masks, label)
+            #Only the new column is written
+            track_store.append_column(self.tracks_path, label, df[label])
 
-        df.to_csv(self.df_path)
+        masks.close()
+        if csv:
+            df.to_csv(self.df_path)
 
         return
     
     
-    def save_to_pyama(self, fl_channel, method='th'):
+    def channel_stack(self, c):
+        """Channel `c` over self.frame_indices as a [t, y, x] array or LazyStack, without reading it into memory."""
 
-        from tifffile import imwrite
-        
-        if method=='th':
-            file=os.path.join(self.path_out, 'cyto_masks_th.mp4')
-        else:
-            file=os.path.join(self.path_out, 'cyto_masks_th.mp4')
+        if self.single_pass and self.nd2_file is not None and c in self.pass_channels:
+            return self.read_channels()[:, self.pass_channels.index(c)]
+        stack = self.stack(c)
+        if np.array_equal(self.frame_indices, np.arange(len(stack))):
+            return stack
+        return self.read_image(c, frames=self.frame_indices)
+
+    def save_to_pyama(self, fl_channel, method='th', compression=None, n_threads=None):
+        """
+        Export the background corrected fluorescence, the bright field and the segmentation as tif stacks.
+
+        The stacks are written page by page while they are read, so only a few frames are held in memory
+        (plus the background correction, which is kept in a temporary file when it exceeds 1 GB).
+
+        Parameters
+        ----------
+        fl_channel : int
+            Fluorescence channel to correct.
+        method : string, optional
+            Segmentation method whose masks are exported. The default is 'th'.
+        compression : string, optional
+            Compress the stacks, e.g. with 'zlib'. Compressed stacks are BigTIFF instead of ImageJ
+            hyperstacks. The default is None.
+        n_threads : int, optional
+            Number of threads compressing each page.
+        """
+        from .export import write_tiff
 
-        segmentation = (functions.mp4_to_np(file)>0).astype('uint8')
-        fl_image = self.read_image(c=fl_channel, frames=self.frame_indices)
-        bf = self.read_image(c=self.bf_channel, frames=self.frame_indices)
+        masks = mask_store.open_masks(self.path_out, method)
+        fl_image = self.channel_stack(fl_channel)
 
-        bg = background_schwarzfischer(fl_image, segmentation>0, mem_lim=1e9, memmap_dir=os.path.join(self.path_out, 'tmp'))
-        del fl_image
+        bg = background_schwarzfischer(fl_image, masks, mem_lim=1e9, memmap_dir=os.path.join(self.path_out, 'tmp'))
 
         ##Save background corrected image
-        n_frames, height, width = bg.shape
-        tiff_shape = (n_frames, 1, 1, height, width, 1)
         outfile = os.path.join(self.path_out, f'XY{self.fov}-bg_corr.tif')
-        imwrite(outfile, bg.reshape(tiff_shape), shape=tiff_shape, imagej=True)
+        write_tiff(outfile, bg, compression=compression, n_threads=n_threads)
+        del bg
         
         ##Save bright field channel tif
-        n_frames, height, width = bf.shape
-        tiff_shape = (n_frames, 1, 1, height, width, 1)
         outfile = os.path.join(self.path_out, f'XY{self.fov}-bf.tif')
-        imwrite(outfile, bf.reshape(tiff_shape), shape=tiff_shape, imagej=True)
+        write_tiff(outfile, self.channel_stack(self.bf_channel), compression=compression, n_threads=n_threads)
         
-        ##Save segmentation
-        np.savez_compressed(os.path.join(self.path_out, f'XY{self.fov}-bgcorr_segmented.npz'), segmentation)
+        ##Save segmentation, one binary page per frame
+        segmentation = ((t, (mask>0).astype('uint8')) for t, mask in masks.iter_frames())
+        outfile = os.path.join(self.path_out, f'XY{self.fov}-bgcorr_segmented.tif')
+        write_tiff(outfile, segmentation, shape=masks.shape, dtype='uint8', compression=compression, n_threads=n_threads)
+        masks.close()
 
         # if os.path.isdir(os.path.join(self.path_out, 'tmp')):
         #     os.rmdir(os.path.join(self.path_out, 'tmp'))
@@ -0,0 +1,259 @@
+"""Cache of segmentation results, keyed by content.
+
+A mask is stored under a hash of the raw frame bytes, the segmentation method,
+the model identity and all segmentation parameters, so the same frame segmented
+with the same settings is only computed once: by a rerun of Track.segment after
+a crash, or by a viewer slider returning to a previous value. Masks are kept in
+an in-memory LRU and, for callers that opt in, compressed in an on-disk LRU
+directory.
+"""
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+#Part of every key; bump when the stored masks of a method change
+VERSION = 2
+
+
+def default_directory():
+    return os.path.join(os.path.expanduser('~'), '.cache', 'lisca', 'segmentation')
+
+
+def model_identity(model):
+    """JSON-able identity of a model: its registry key, plus size and modification time of its weights file."""
+
+    if model is None:
+        return None
+    key = list(getattr(model, 'key', (str(model),)))
+    path = key[1] if len(key) > 1 else None
+    if path is not None and os.path.isfile(path):
+        st = os.stat(path)
+        key += [st.st_size, st.st_mtime_ns]
+    return key
+
+
+def frame_key(frame, method, model=None, **params):
+    """Hex digest identifying the segmentation of `frame` by `method` with `model` and `params`."""
+
+    frame = np.ascontiguousarray(frame)
+    h = hashlib.blake2b(digest_size=20)
+    h.update(json.dumps([VERSION, method, model_identity(model), str(frame.dtype), frame.shape,
+                         sorted(params.items())], default=str).encode())
+    h.update(memoryview(frame).cast('B'))
+    return h.hexdigest()
+
+
+class SegmentationCache:
+
+    def __init__(self, directory=None, max_memory=256<<20, max_disk=4<<30):
+        """
+        Two-level LRU cache of masks.
+
+        Parameters
+        ----------
+        directory : string, optional
+            Directory of the on-disk cache. The default is None, which uses ~/.cache/lisca/segmentation.
+        max_memory : int, optional
+            Maximum number of bytes of masks kept in memory. The default is 256 MiB.
+        max_disk : int, optional
+            Maximum number of bytes of (compressed) masks kept on disk; 0 disables the on-disk cache.
+            The default is 4 GiB.
+        """
+        self.directory = default_directory() if directory is None else directory
+        self.max_memory = max_memory
+        self.max_disk = max_disk
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._memory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.npz')
+
+    def get(self, key):
+        """Return a copy of the mask stored under `key`, or None."""
+
+        with self._lock:
+            mask = self._memory.get(key)
+            if mask is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return mask.copy()
+
+        path = self._path(key)
+        if self.max_disk > 0 and os.path.isfile(path):
+            try:
+                with np.load(path) as f:
+                    mask = f['mask']
+            except (OSError, ValueError, KeyError):
+                mask = None
+            if mask is not None:
+                #Reading a file marks it as recently used
+                os.utime(path)
+                self._remember(key, mask)
+                with self._lock:
+                    self.hits += 1
+                return mask.copy()
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, mask):
+        """Store `mask` under `key`, in memory and on disk."""
+
+        mask = np.array(mask)
+        self._remember(key, mask)
+        if self.max_disk > 0:
+            self._write(key, mask)
+
+    def _remember(self, key, mask):
+        if mask.nbytes > self.max_memory:
+            return
+        with self._lock:
+            old = self._memory.pop(key, None)
+            if old is not None:
+                self._memory_bytes -= old.nbytes
+            self._memory[key] = mask
+            self._memory_bytes += mask.nbytes
+            while self._memory_bytes > self.max_memory:
+                self._memory_bytes -= self._memory.popitem(last=False)[1].nbytes
+
+    def _write(self, key, mask):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        #Written to a temporary file first, so a crash never leaves a truncated mask behind
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez_compressed(f, mask=mask)
+        os.replace(tmp, path)
+        with self._lock:
+            if self._disk_bytes is not None:
+                self._disk_bytes += os.path.getsize(path)
+            trim = self._disk_bytes is None or self._disk_bytes > self.max_disk
+        if trim:
+            self._trim_disk()
+
+    def _files(self):
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith('.npz'):
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    files.append((st.st_mtime_ns, st.st_size, path))
+        return files
+
+    def _trim_disk(self):
+        """Delete the least recently used files until the on-disk cache fits into max_disk."""
+
+        files = sorted(self._files())
+        total = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if total <= self.max_disk:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        with self._lock:
+            self._disk_bytes = total
+
+    def resize(self, max_memory=None, max_disk=None):
+        """Change the size limits, dropping the least recently used masks if necessary."""
+
+        if max_memory is not None:
+            with self._lock:
+                self.max_memory = max_memory
+                while self._memory and self._memory_bytes > self.max_memory:
+                    self._memory_bytes -= self._memory.popitem(last=False)[1].nbytes
+        if max_disk is not None:
+            self.max_disk = max_disk
+            if os.path.isdir(self.directory):
+                self._trim_disk()
+
+    def clear(self, disk=False):
+        """Forget the masks held in memory, and with `disk`=True also delete the on-disk cache."""
+
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+        if disk:
+            for _, _, path in self._files():
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            with self._lock:
+                self._disk_bytes = 0
+
+    def segment(self, frames, segment, method, model=None, **params):
+        """
+        Segment `frames`, computing only the masks that are not cached.
+
+        Parameters
+        ----------
+        frames : array, LazyStack or list of 2D arrays
+            The frames.
+        segment : callable
+            segment(list of frames) returns their masks as a sequence, in order.
+        method : string
+            Segmentation method, e.g. 'th' or 'cellpose'.
+        model : optional
+            The model, identified through `model_identity`.
+        **params
+            All parameters that change the result.
+
+        Returns
+        -------
+        masks : list of np.ndarray
+            The masks, in the order of `frames`.
+        """
+        frames = [np.asarray(frames[t]) for t in range(len(frames))]
+        keys = [frame_key(frame, method, model, **params) for frame in frames]
+        masks = [self.get(key) for key in keys]
+        missing = [i for i, mask in enumerate(masks) if mask is None]
+        if missing:
+            computed = segment([frames[i] for i in missing])
+            for i, mask in zip(missing, computed):
+                self.put(keys[i], mask)
+                masks[i] = np.asarray(mask)
+        return masks
+
+
+_cache = SegmentationCache()
+_memory_cache = SegmentationCache(max_disk=0)
+
+
+def get_cache(disk=True):
+    """
+    Return a process-wide SegmentationCache.
+
+    With disk=True, masks are also kept on disk, in ~/.cache/lisca/segmentation (up to 4 GiB, see
+    `set_cache_limits`), and survive the process; only callers that opt in use it, e.g.
+    Track.segment(cache=True). With disk=False, masks are only kept in memory, e.g. for the viewers.
+    """
+    return _cache if disk else _memory_cache
+
+
+def set_cache_limits(max_memory=None, max_disk=None):
+    _cache.resize(max_memory=max_memory, max_disk=max_disk)
+    _memory_cache.resize(max_memory=max_memory)
+
+
+def clear_cache(disk=False):
+    _cache.clear(disk=disk)
+    _memory_cache.clear()
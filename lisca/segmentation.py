@@ -2,50 +2,271 @@ import sys
 import numpy as np
 import os
 import json
+import threading
+from functools import lru_cache
 from urllib import request
 from cellpose import models
 from cellpose.io import logger_setup 
 from tqdm import tqdm
 from .img_op import background_correction, coarse_binarize_phc
+from .mask_store import compact_labels, stack_labels
+
+
+def set_torch_threads(n_threads=None, n_interop_threads=None):
+    """
+    Set the number of threads torch uses on the CPU.
+
+    Parameters
+    ----------
+    n_threads : int, optional
+        Threads used inside an operation (torch.set_num_threads). The default is None, which keeps the current setting.
+    n_interop_threads : int, optional
+        Threads running independent operations (torch.set_num_interop_threads). Torch only accepts this before its
+        first parallel work, later calls are ignored. The default is None, which keeps the current setting.
+    """
+    if n_threads is None and n_interop_threads is None:
+        return
+    import torch
+
+    if n_threads is not None:
+        torch.set_num_threads(n_threads)
+    if n_interop_threads is not None:
+        try:
+            torch.set_num_interop_threads(n_interop_threads)
+        except RuntimeError:
+            print('torch interop threads can only be set before parallel work has started')
+
+
+MODELS_DIR = os.path.join(os.path.dirname(__file__), 'models')
+
+
+def model_path(pretrained_model):
+    """Path of a pretrained model, given by its name in models/models.json (downloading it if needed) or by its path."""
+
+    with open(os.path.join(MODELS_DIR, 'models.json'), 'r') as f:
+        dic = json.load(f)
+
+    if pretrained_model not in dic.keys():
+        return os.path.abspath(pretrained_model) if os.path.exists(pretrained_model) else pretrained_model
+
+    path_to_model = os.path.join(MODELS_DIR, dic[pretrained_model]['path'])
+    if not os.path.isfile(path_to_model):
+        url = dic[pretrained_model]['link']
+        print('Downloading model from Nextcloud...')
+        request.urlretrieve(url, path_to_model)
+    return path_to_model
+
+
+@lru_cache()
+def _device(gpu):
+    if gpu:
+        from cellpose import core
+        if core.use_gpu():
+            return 'gpu'
+    return 'cpu'
+
+
+class LoadedModel:
+    """A Cellpose model held by the registry, with the lock serializing its eval calls."""
+
+    def __init__(self, key, model):
+        self.key = key
+        self.model = model
+        self.lock = threading.Lock()
+
+    def eval(self, *args, **kwargs):
+        with self.lock:
+            return self.model.eval(*args, **kwargs)
+
+    def warm_up(self):
+        #A first inference builds the network's buffers, so the first real frame is not slower
+        image = np.random.default_rng(0).normal(100, 10, (64, 64)).astype(np.float32)
+        self.eval(image, diameter=30, channels=None, normalize=True)
+
+
+class ModelRegistry:
+
+    def __init__(self):
+        """
+        Loaded Cellpose models, shared by everything running in the process.
+
+        Models are keyed by (model name, path, device): loading the same model twice returns the
+        same instance. Next to it, a key can have one private instance for callers that must not wait
+        for the shared one. Models stay loaded until they are evicted.
+        """
+        self._models = {}
+        self._private = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._models)
+
+    def keys(self):
+        return list(self._models)
+
+    def get(self, pretrained_model=None, gpu=True, warm_up=True, shared=True):
+        """
+        Return the LoadedModel for `pretrained_model`, loading it if needed.
+
+        Parameters
+        ----------
+        pretrained_model : string, optional
+            Name in models/models.json or path of a model. The default is None, which loads the generalist 'cyto' model.
+        gpu : bool, optional
+            Use the GPU if one is available. The default is True.
+        warm_up : bool, optional
+            Run a small dummy inference after loading. The default is True.
+        shared : bool, optional
+            If False, return the private instance of the model, loading it if needed, so its eval calls do not
+            wait for those of the shared instance (e.g. a fast preview next to a long segmentation). All callers
+            asking for a private instance get the same one. The default is True.
+        """
+        device = _device(gpu)
+        if pretrained_model is None:
+            key = ('cyto', None, device)
+        else:
+            key = (pretrained_model, model_path(pretrained_model), device)
+
+        #Loading holds the lock, so a model requested from two threads is only loaded once
+        models = self._models if shared else self._private
+        with self._lock:
+            entry = models.get(key)
+            if entry is None:
+                entry = self._load(key, warm_up)
+                models[key] = entry
+        return entry
+
+    def _load(self, key, warm_up):
+        name, path, device = key
+        if path is None:
+            model = models.Cellpose(gpu=device == 'gpu', model_type=name)
+        else:
+            model = models.CellposeModel(gpu=device == 'gpu', pretrained_model=path)
+        entry = LoadedModel(key, model)
+        if warm_up:
+            entry.warm_up()
+        return entry
+
+    def evict(self, pretrained_model=None, gpu=None):
+        """
+        Forget loaded models so their memory can be freed.
+
+        Models matching `pretrained_model` (name or path; None matches all) and `gpu` (None matches both
+        devices) are removed. Segmentation objects still holding a model keep it alive.
+        """
+        device = None if gpu is None else _device(gpu)
+        with self._lock:
+            evicted = [key for key in dict.fromkeys([*self._models, *self._private])
+                       if (pretrained_model is None or pretrained_model in key[:2] or key[1] == os.path.abspath(pretrained_model))
+                       and (device is None or key[2] == device)]
+            for key in evicted:
+                self._models.pop(key, None)
+                self._private.pop(key, None)
+
+        if any(key[2] == 'gpu' for key in evicted):
+            import torch
+            torch.cuda.empty_cache()
+        return evicted
+
+    def clear(self):
+        return self.evict()
+
+
+_registry = ModelRegistry()
+
+
+def get_model(pretrained_model=None, gpu=True, warm_up=True, shared=True):
+    """Return the shared LoadedModel for `pretrained_model`, or the private one with shared=False (see ModelRegistry.get)."""
+    return _registry.get(pretrained_model, gpu=gpu, warm_up=warm_up, shared=shared)
+
+
+def evict_model(pretrained_model=None, gpu=None):
+    return _registry.evict(pretrained_model, gpu=gpu)
+
+
+def clear_models():
+    _registry.clear()
 
 
 class Segmentation:
 
-    def __init__(self, gpu=True, model_type='cyto', channels=None, diameter=None, flow_threshold=0.4, mask_threshold=0, pretrained_model=None, nucleus_bottom_percentile=0.05, nucleus_top_percentile=99.95, cyto_bottom_percentile=0.1, cyto_top_percentile=99.9, check_preprocessing=False, verbose=True):
+    def __init__(self, gpu=True, model_type='cyto', channels=None, diameter=None, flow_threshold=0.4, mask_threshold=0, pretrained_model=None, nucleus_bottom_percentile=0.05, nucleus_top_percentile=99.95, cyto_bottom_percentile=0.1, cyto_top_percentile=99.9, check_preprocessing=False, verbose=True, n_threads=None, n_interop_threads=None, shared_model=True):
 
         self.diameter=diameter
         self.flow_treshold=flow_threshold
+        self.flow_threshold=flow_threshold
         self.mask_threshold=mask_threshold
         self.verbose=verbose
 
-        if pretrained_model is None:
-            self.model = models.Cellpose(gpu=gpu, model_type='cyto')
-        
-        else:
-            path_to_models = os.path.join(os.path.dirname(__file__), 'models')
-            with open(os.path.join(path_to_models, 'models.json'), 'r') as f:
-                dic = json.load(f)
-                
-            if pretrained_model in dic.keys():
-                path_to_model = os.path.join(path_to_models, dic[pretrained_model]['path'])
-                if os.path.isfile(path_to_model):
-                    pretrained_model = path_to_model
-                else: 
-                    url = dic[pretrained_model]['link']
-                    print('Downloading model from Nextcloud...')
-                    request.urlretrieve(url, os.path.join(path_to_models, path_to_model))
-                    pretrained_model = os.path.join(path_to_models,dic[pretrained_model]['path'])
-
-            self.model = models.CellposeModel(gpu=gpu, pretrained_model=pretrained_model)
+        set_torch_threads(n_threads, n_interop_threads)
+
+        #Models are loaded once per process and shared, see ModelRegistry; shared_model=False uses the private instance
+        self.model = get_model(pretrained_model, gpu=gpu, shared=shared_model)
             
         
-    def segment_image(self, image, diameter=None, flow_threshold=None, mask_threshold=None):
+    def segment_image(self, image, diameter=None, flow_threshold=None, mask_threshold=None, cache=None):
 
         diameter=self.diameter if diameter is None else diameter
         flow_threshold=self.flow_threshold if flow_threshold is None else flow_threshold
         mask_threshold=self.mask_threshold if mask_threshold is None else mask_threshold
 
-        mask = self.model.eval(image, diameter=diameter, channels=None, flow_threshold=flow_threshold, cellprob_threshold=mask_threshold, normalize=True)[0].astype('uint8')
+        def segment(images):
+            return [compact_labels(self.model.eval(images[0], diameter=diameter, channels=None, flow_threshold=flow_threshold, cellprob_threshold=mask_threshold, normalize=True)[0])]
+
+        if cache is not None:
+            return cache.segment([image], segment, 'cellpose', self.model, diameter=diameter, flow_threshold=flow_threshold, mask_threshold=mask_threshold)[0]
+        mask = segment([image])[0]
 
 
         return mask
+
+    def segment_tiled(self, image, tile_size=2048, overlap=64, n_threads=None, diameter=None, flow_threshold=None, mask_threshold=None):
+        """
+        Segment a large frame in overlapping tiles, stitching the labels across the seams (see tiling.segment_tiled).
+
+        Each tile is normalized on its own. The overlap should be larger than a cell diameter.
+        """
+        from .tiling import segment_tiled
+
+        return segment_tiled(image, lambda tile: self.segment_image(tile, diameter, flow_threshold, mask_threshold),
+                             tile_size=tile_size, overlap=overlap, n_threads=n_threads)
+
+    def segment_stack(self, frames, batch_size=8, diameter=None, flow_threshold=None, mask_threshold=None, cache=None):
+        """
+        Segment a stack of frames, passing `batch_size` frames at a time to the model.
+
+        Parameters
+        ----------
+        frames : array, LazyStack or list of 2D arrays
+            The frames, all of the same shape.
+        batch_size : int, optional
+            Number of frames per model.eval call, also used as the batch size of the network. The default is 8.
+        diameter, flow_threshold, mask_threshold : optional
+            Like segment_image.
+        cache : SegmentationCache, optional
+            Only frames whose masks are not in the cache are segmented. The default is None, which segments all frames.
+
+        Returns
+        -------
+        masks : np.ndarray
+            (frames, height, width) masks, in the order of `frames`, in the smallest dtype holding all labels.
+        """
+        diameter=self.diameter if diameter is None else diameter
+        flow_threshold=self.flow_threshold if flow_threshold is None else flow_threshold
+        mask_threshold=self.mask_threshold if mask_threshold is None else mask_threshold
+
+        if cache is not None:
+            masks = cache.segment(frames, lambda missing: self.segment_stack(missing, batch_size, diameter, flow_threshold, mask_threshold),
+                                  'cellpose', self.model, diameter=diameter, flow_threshold=flow_threshold, mask_threshold=mask_threshold)
+            return stack_labels(masks) if masks else np.empty((0, 0, 0), dtype='uint8')
+
+        n_frames = len(frames)
+        masks = []
+        for start in range(0, n_frames, batch_size):
+            batch = [np.asarray(frames[t]) for t in range(start, min(start+batch_size, n_frames))]
+            batch_masks = self.model.eval(batch, batch_size=batch_size, diameter=diameter, channels=None, flow_threshold=flow_threshold, cellprob_threshold=mask_threshold, normalize=True)[0]
+            masks += [compact_labels(mask) for mask in batch_masks]
+
+        if not masks:
+            return np.empty((0, 0, 0), dtype='uint8')
+        return stack_labels(masks)
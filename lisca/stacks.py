@@ -0,0 +1,428 @@
+"""Lazy, sliceable image stacks.
+
+A `LazyStack` is one channel of a movie with `[t, y, x]` indexing like a
+numpy array, but pixels are only read for the frames (and the region) that
+are indexed. Shape, dtype and channel labels are known without reading any
+pixels. The same interface is provided for ND2, MP4 and TIFF files, so the
+pipeline and the viewers do not need to branch on the file type.
+"""
+import os
+import queue
+import threading
+
+import numpy as np
+
+from . import nd2_io
+
+
+class LazyStack:
+    """Base class; subclasses set `shape`, `dtype`, `channels`, `channel` and implement `_read`."""
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def ndim(self):
+        return 3
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape, dtype=np.int64)) * self.dtype.itemsize
+
+    @property
+    def label(self):
+        """Label of the channel this stack reads."""
+        return self.channels[self.channel]
+
+    def __repr__(self):
+        return f'{type(self).__name__}(shape={self.shape}, dtype={self.dtype}, channel={self.label!r})'
+
+    def _read(self, frames, roi=None):
+        """Read `frames` (1-D int array) cropped to `roi` (y0, y1, x0, x1) into a new (n, h, w) array."""
+        raise NotImplementedError
+
+    def __getitem__(self, key):
+
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            i = next(i for i, k in enumerate(key) if k is Ellipsis)
+            key = key[:i] + (slice(None),)*(3 - len(key) + 1) + key[i+1:]
+        if len(key) > 3:
+            raise IndexError(f'too many indices for {type(self).__name__}: {len(key)} given, 3 dimensions')
+        t_key, rest = key[0], key[1:] + (slice(None),)*(3 - len(key))
+
+        #Map the time index to the frames that have to be read and an index into what was read
+        if isinstance(t_key, slice):
+            frames = np.arange(len(self))[t_key]
+            local_t = slice(None)
+        else:
+            t_index = np.arange(len(self))[t_key]
+            frames, inverse = np.unique(t_index, return_inverse=True)
+            local_t = int(inverse.ravel()[0]) if np.ndim(t_index) == 0 else inverse.reshape(np.shape(t_index))
+
+        #Contiguous y/x slices are read as a region of interest, anything else is read in full
+        roi = None
+        if all(isinstance(k, slice) and (k.step is None or k.step > 0) for k in rest):
+            (y0, y1, ys), (x0, x1, xs) = [k.indices(n) for k, n in zip(rest, self.shape[1:])]
+            roi = (y0, max(y0, y1), x0, max(x0, x1))
+            rest = (slice(None, None, ys), slice(None, None, xs))
+
+        x = self._read(frames, roi)
+        return x[(local_t,) + tuple(rest)]
+
+    def __array__(self, dtype=None, copy=None):
+        x = self._read(np.arange(len(self)))
+        return x if dtype is None else x.astype(dtype, copy=False)
+
+    def iter_chunks(self, chunk_size=16, frames=None, roi=None):
+        """Iterate over the stack in blocks of at most `chunk_size` frames.
+
+        Yields (frame indices, (n, h, w) array) tuples.
+        """
+        frames = np.arange(len(self)) if frames is None else np.asarray(frames)
+        for start in range(0, frames.size, chunk_size):
+            chunk = frames[start:start+chunk_size]
+            yield chunk, self._read(chunk, roi)
+
+    def _read_frame(self, t, out):
+        """Read frame `t` into the (h, w) array `out`."""
+        out[...] = self._read(np.array([t]))[0]
+
+    def iter_frames(self, frames=None, read_ahead=2):
+        """Iterate over the stack one frame at a time, yielding (frame index, (h, w) array) tuples.
+
+        Up to `read_ahead` frames are read in a background thread while the caller works on the
+        current one. The yielded arrays are taken from a small pool of buffers that is reused, so
+        a frame is only valid until the next iteration step: copy it to keep it. Do not index the
+        stack from elsewhere while iterating.
+        """
+        frames = np.arange(len(self)) if frames is None else np.asarray(frames).ravel()
+        shape = self.shape[1:]
+
+        if read_ahead < 1:
+            buf = np.empty(shape, dtype=self.dtype)
+            for t in frames:
+                self._read_frame(int(t), buf)
+                yield int(t), buf
+            return
+
+        #read_ahead frames can wait in `ready` while the reader fills one buffer and the caller holds one
+        free, ready = queue.Queue(), queue.Queue(maxsize=read_ahead)
+        for _ in range(read_ahead + 2):
+            free.put(np.empty(shape, dtype=self.dtype))
+        stop = threading.Event()
+
+        def reader():
+            try:
+                for t in frames:
+                    buf = free.get()
+                    if stop.is_set():
+                        return
+                    self._read_frame(int(t), buf)
+                    ready.put((int(t), buf, None))
+            except Exception as e:
+                ready.put((None, None, e))
+
+        thread = threading.Thread(target=reader, daemon=True)
+        thread.start()
+        try:
+            for _ in range(frames.size):
+                t, buf, error = ready.get()
+                if error is not None:
+                    raise error
+                yield t, buf
+                free.put(buf)
+        finally:
+            #Unblock the reader if the caller stopped early
+            stop.set()
+            free.put(None)
+            while thread.is_alive():
+                try:
+                    ready.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            thread.join()
+
+
+def iter_frames(x, read_ahead=2):
+    """Yield (frame index, frame) from an array, a LazyStack or an iterable of (frame index, frame)."""
+
+    if isinstance(x, np.ndarray):
+        return enumerate(x)
+    if hasattr(x, 'iter_frames'):
+        return x.iter_frames(read_ahead=read_ahead)
+    return iter(x)
+
+
+class ND2Stack(LazyStack):
+
+    def __init__(self, file, fov, c=0, manual=False):
+        """
+        One channel of one field of view of an nd2 file.
+
+        Parameters
+        ----------
+        file : string
+            Path to the nd2 file.
+        fov : int
+            Field of view.
+        c : int, optional
+            Channel index. The default is 0.
+        manual : bool, optional
+            Use the manual FOV/frame layout, see `nd2_io.open_reader`.
+        """
+        self.file, self.fov, self.channel, self.manual = file, fov, c, manual
+        index = nd2_io.get_index(file, manual=manual)
+        self.shape = (index.sizes['t'], index.height, index.width)
+        self.dtype = np.dtype('uint16')
+        self.channels = list(index.channels)
+
+    def _read(self, frames, roi=None):
+        #Only the rows of the roi are read from the file
+        return nd2_io.read_block(self.file, self.fov, frames, c=self.channel, manual=self.manual, roi=roi)
+
+    def _read_frame(self, t, out):
+        nd2_io.read_block(self.file, self.fov, [t], c=self.channel, out=out[np.newaxis], manual=self.manual)
+
+
+class Mp4Cursor:
+
+    def __init__(self, file, as_grey=False, max_skip=32):
+        """
+        Random access to the frames of an mp4 movie through OpenCV.
+
+        Frames are decoded in order from the current position; a frame more than `max_skip` frames
+        ahead (or behind) the position is reached by seeking to the nearest keyframe instead of
+        decoding everything in between.
+
+        Parameters
+        ----------
+        file : string
+            Path to the movie.
+        as_grey : bool, optional
+            Return (h, w) grey frames instead of (h, w, 3) RGB frames. The default is False.
+        max_skip : int, optional
+            Largest forward gap that is decoded instead of seeked over. The default is 32.
+        """
+        import cv2
+
+        self.file, self.as_grey, self.max_skip = file, as_grey, max_skip
+        self.cap = cv2.VideoCapture(file)
+        if not self.cap.isOpened():
+            raise OSError(f'Could not open {file}')
+        self.n_frames = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.frame_shape = (self.height, self.width) if as_grey else (self.height, self.width, 3)
+        self.pos = 0
+
+    def read(self, t, out=None):
+        """Decode frame `t`, into `out` if given."""
+        import cv2
+
+        if not 0 <= t < self.n_frames:
+            raise IndexError(f'frame {t} out of range for {self.file}')
+        if t < self.pos or t - self.pos > self.max_skip:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, t)
+            self.pos = t
+        while self.pos < t:
+            #Skipped frames are decoded but not converted to BGR
+            self.cap.grab()
+            self.pos += 1
+        ok, frame = self.cap.read()
+        if not ok:
+            raise IndexError(f'could not decode frame {t} of {self.file}')
+        self.pos += 1
+        if out is None:
+            out = np.empty(self.frame_shape, dtype='uint8')
+        if self.as_grey:
+            cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=out)
+        else:
+            cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=out)
+        return out
+
+    def read_frames(self, frames, out=None):
+        """Decode `frames` (1-D int array) into an (n, h, w[, 3]) array, in file order."""
+
+        frames = np.asarray(frames, dtype=int).ravel()
+        if out is None:
+            out = np.empty((frames.size,) + self.frame_shape, dtype='uint8')
+        for i in np.argsort(frames, kind='stable'):
+            self.read(int(frames[i]), out=out[i])
+        return out
+
+    def close(self):
+        self.cap.release()
+
+
+def read_mp4(file, frames=None, as_grey=True, out=None, roi=None):
+    """Decode `frames` (int, slice or index array; all frames if None) of an mp4 movie.
+
+    Only the requested frames are decoded, seeking over long gaps. An int returns a single frame.
+    With roi=(y0, y1, x0, x1), each frame is cropped right after decoding, so the output only
+    holds the region.
+    """
+    cursor = Mp4Cursor(file, as_grey=as_grey)
+    try:
+        t_index = np.arange(cursor.n_frames)[slice(None) if frames is None else frames]
+        y0, y1, x0, x1 = (0, cursor.height, 0, cursor.width) if roi is None else roi
+        frame_shape = (y1 - y0, x1 - x0) + cursor.frame_shape[2:]
+        if out is None:
+            out = np.empty(np.shape(t_index) + frame_shape, dtype='uint8')
+        flat = out.reshape((-1,) + frame_shape)
+        t_flat = np.atleast_1d(t_index).ravel()
+
+        if roi is None:
+            cursor.read_frames(t_flat, out=flat)
+        else:
+            #The codec only decodes full frames: decode into one buffer and keep the region
+            buf = np.empty(cursor.frame_shape, dtype='uint8')
+            for i in np.argsort(t_flat, kind='stable'):
+                flat[i] = cursor.read(int(t_flat[i]), out=buf)[y0:y1, x0:x1]
+        return out
+    finally:
+        cursor.close()
+
+
+class Mp4Stack(LazyStack):
+
+    def __init__(self, file, c=0, as_grey=False):
+        """
+        One color channel of an mp4 movie, or its grey value with as_grey=True (e.g. for mask movies).
+
+        Reading forward from the last read frame continues decoding; frames further away are
+        reached by seeking, see `Mp4Cursor`.
+        """
+        self.file, self.channel = file, 0 if as_grey else c
+        self._cursor = Mp4Cursor(file, as_grey=as_grey)
+        self.shape = (self._cursor.n_frames, self._cursor.height, self._cursor.width)
+        self.dtype = np.dtype('uint8')
+        self.channels = [os.path.basename(file)] if as_grey else list('RGB')
+
+    def _read(self, frames, roi=None):
+        if roi is None and self._cursor.as_grey:
+            return self._cursor.read_frames(frames)
+        #Decode one full frame at a time, keeping only the channel and region
+        y0, y1, x0, x1 = (0, self.shape[1], 0, self.shape[2]) if roi is None else roi
+        x = np.empty((len(frames), y1 - y0, x1 - x0), dtype=self.dtype)
+        buf = np.empty(self._cursor.frame_shape, dtype='uint8')
+        for i in np.argsort(frames, kind='stable'):
+            frame = self._cursor.read(int(frames[i]), out=buf)
+            x[i] = frame[y0:y1, x0:x1] if self._cursor.as_grey else frame[y0:y1, x0:x1, self.channel]
+        return x
+
+    def _read_frame(self, t, out):
+        if self._cursor.as_grey:
+            self._cursor.read(t, out=out)
+        else:
+            out[...] = self._cursor.read(t)[..., self.channel]
+
+    def close(self):
+        self._cursor.close()
+
+
+def _as_slice(k):
+    """Turn a 1-D index array of consecutive frames into the equivalent slice."""
+    if isinstance(k, (list, np.ndarray)) and np.ndim(k) == 1 and len(k) > 1:
+        k_arr = np.asarray(k)
+        if k_arr.dtype.kind in 'iu' and k_arr[0] >= 0 and (np.diff(k_arr) == 1).all():
+            return slice(int(k_arr[0]), int(k_arr[-1]) + 1)
+    return k
+
+
+class TiffStack(LazyStack):
+
+    def __init__(self, file, memmap=True):
+        """
+        A TIFF stack, one frame per page (or per plane of an ImageJ hyperstack).
+
+        Uncompressed stacks stored contiguously (the default for tifffile and ImageJ exports) are
+        memory-mapped when memmap=True: indexing returns views into the file, so stacks larger than
+        the memory can be processed. Other files are read page by page. Frames are returned in native
+        byte order; those of big-endian files are copies.
+        """
+        from tifffile import TiffFile
+
+        self.file, self.channel = file, 0
+        self.tif = TiffFile(file)
+        series = self.tif.series[0]
+        self.dtype = np.dtype(series.dtype).newbyteorder('=')
+        self.channels = [os.path.basename(file)]
+
+        self.data = None
+        if memmap and len(self.tif.series) == 1 and series.dataoffset is not None and series.keyframe.samplesperpixel == 1:
+            n_frames = int(np.prod(series.shape[:-2], dtype=np.int64))
+            self.data = np.memmap(file, dtype=self.dtype.newbyteorder(self.tif.byteorder), mode='r',
+                                  offset=series.dataoffset, shape=(n_frames,) + series.shape[-2:])
+            self.shape = self.data.shape
+        else:
+            page = self.tif.pages[0]
+            self.shape = (len(self.tif.pages),) + page.shape[-2:]
+
+    @property
+    def is_memmap(self):
+        return self.data is not None
+
+    def __getitem__(self, key):
+        if self.data is None:
+            return super().__getitem__(key)
+        #Frame ranges given as arrays become slices, so the result is a view and not a copy
+        key = key if isinstance(key, tuple) else (key,)
+        x = self.data[(_as_slice(key[0]),) + key[1:]]
+        return x if x.dtype == self.dtype else x.astype(self.dtype)
+
+    def __array__(self, dtype=None, copy=None):
+        if self.data is None:
+            return super().__array__(dtype, copy)
+        dtype = self.dtype if dtype is None else dtype
+        return np.array(self.data, dtype=dtype) if copy else np.asarray(self.data, dtype=dtype)
+
+    def _read(self, frames, roi=None):
+        y0, y1, x0, x1 = (0, self.shape[1], 0, self.shape[2]) if roi is None else roi
+        if self.data is not None:
+            return np.array(self.data[frames, y0:y1, x0:x1], dtype=self.dtype)
+        x = np.empty((len(frames), y1 - y0, x1 - x0), dtype=self.dtype)
+        for i, t in enumerate(frames):
+            page = self.tif.pages[int(t)]
+            if roi is not None and page.is_contiguous and len(page.shape) == 2:
+                #Uncompressed page: read only the rows of the roi
+                offset = page.dataoffsets[0]
+                row_bytes = self.shape[2] * self.dtype.itemsize
+                fh = self.tif.filehandle
+                fh.seek(offset + y0 * row_bytes)
+                rows = np.frombuffer(fh.read((y1 - y0) * row_bytes), dtype=self.dtype.newbyteorder(self.tif.byteorder))
+                x[i] = rows.reshape(y1 - y0, self.shape[2])[:, x0:x1]
+            else:
+                x[i] = page.asarray()[y0:y1, x0:x1]
+        return x
+
+    def _read_frame(self, t, out):
+        out[...] = self.data[t] if self.data is not None else self.tif.pages[t].asarray()
+
+    def close(self):
+        #Views returned from a memory-mapped stack stay valid after closing
+        self.tif.close()
+
+
+class ND2StackMixin(nd2_io.ND2ReaderMixin):
+    """Provide `self.f` and `self.stack(v, c)` for classes with `self.nd2file` (and `self.manual`)."""
+
+    def stack(self, v, c=0):
+        return ND2Stack(self.nd2file, v, c=c, manual=getattr(self, 'manual', False))
+
+
+def open_stack(file, c=0, fov=0, manual=False, as_grey=False):
+    """Open `file` as a LazyStack, picking the backend from the file extension.
+
+    `c` and `fov` select the channel and field of view of nd2 files; `c` selects the color channel of mp4 files,
+    unless as_grey=True, which reads their grey value instead.
+    """
+    ext = os.path.splitext(file)[1].lower()
+    if ext == '.nd2':
+        return ND2Stack(file, fov, c=c, manual=manual)
+    if ext == '.mp4':
+        return Mp4Stack(file, c=c, as_grey=as_grey)
+    if ext in ('.tif', '.tiff'):
+        return TiffStack(file)
+    raise ValueError(f'Unsupported stack format: {file}')
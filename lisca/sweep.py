@@ -0,0 +1,225 @@
+"""Parameter sweeps over segmentation and tracking settings.
+
+`sweep` segments a sample of frames of one or more FOVs with every
+combination of a segmentation parameter grid, links the centroids with every
+combination of a tracking parameter grid, and returns one row of summary
+metrics per (FOV, segmentation, tracking) configuration. Jobs run in a
+process pool. Segmentation and centroids are computed once per segmentation
+configuration and reused for all tracking configurations. With cache=True,
+masks go through the on-disk segmentation cache, so a repeated sweep that
+only changes tracking parameters does not segment again.
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import itertools
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from . import seg_cache
+from . import stacks
+from . import tiling
+from . import tracking
+
+#Defaults of Track.segment and Track.track
+SEGMENTATION_DEFAULTS = {
+    'th': {'mask_size': 3},
+    'cellpose': {'diameter': 29, 'flow_threshold': 0.8, 'mask_threshold': -2},
+}
+TRACKING_DEFAULTS = {'track_memory': 15, 'max_travel': 30, 'min_frames': 10}
+
+
+def param_grid(grid, defaults=None):
+    """All combinations of a {name: list of values} grid, as a list of dicts completed with `defaults`."""
+
+    grid = dict(grid or {})
+    names = list(grid)
+    configs = []
+    for values in itertools.product(*[list(np.atleast_1d(grid[name])) for name in names]):
+        config = dict(defaults or {})
+        config.update({name: value.item() if isinstance(value, np.generic) else value for name, value in zip(names, values)})
+        configs.append(config)
+    return configs
+
+
+def segment_sample(file, fov, frames, method='th', params=None, channel=0, manual=False, model_options=None, cache=False):
+    """
+    Segment `frames` of one FOV and return their centroids (see tracking.get_centroids) and the runtime.
+
+    With cache=True, masks are taken from and stored in the on-disk segmentation cache (see seg_cache.get_cache),
+    with the same keys as Track.segment(cache=True).
+    """
+    params = dict(SEGMENTATION_DEFAULTS[method], **(params or {}))
+    t0 = time.perf_counter()
+    stack = stacks.open_stack(file, c=channel, fov=fov, manual=manual)
+    images = stack[np.asarray(frames)]
+    cache = seg_cache.get_cache() if cache else None
+
+    if method == 'th':
+        from .img_op import coarse_binarize_phc
+        segment_frame = lambda image: coarse_binarize_phc.label_frame(image, mask_size=params['mask_size'])
+        segment = lambda images: tiling.segment_frames(images, segment_frame, n_threads=1)
+        masks = segment(images) if cache is None else cache.segment(images, segment, 'th', **params)
+    else:
+        from .segmentation import Segmentation
+        segmenter = Segmentation(**(model_options or {}))
+        masks = segmenter.segment_stack(images, cache=cache, **params)
+
+    centroids = tracking.get_centroids(list(zip(frames, masks)))
+    return centroids, time.perf_counter() - t0
+
+
+def subnet_sizes(f, max_travel):
+    """
+    Sizes of the linking subnetworks between consecutive frames of a centroid table.
+
+    A subnetwork is a connected group of cells in two consecutive frames that are within `max_travel`
+    of each other; large subnetworks are ambiguous and slow to link.
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    from scipy.spatial import cKDTree
+
+    sizes = []
+    frames = f.groupby('frame')
+    ts = sorted(frames.groups)
+    for t0, t1 in zip(ts[:-1], ts[1:]):
+        a, b = frames.get_group(t0)[['y', 'x']].values, frames.get_group(t1)[['y', 'x']].values
+        pairs = cKDTree(a).query_ball_tree(cKDTree(b), np.round(max_travel))
+        rows = np.repeat(np.arange(len(a)), [len(p) for p in pairs])
+        cols = np.concatenate([np.asarray(p, dtype=int) for p in pairs]) + len(a) if rows.size else np.empty(0, dtype=int)
+        n = len(a) + len(b)
+        graph = coo_matrix((np.ones(rows.size), (rows, cols)), shape=(n, n))
+        _, labels = connected_components(graph, directed=False)
+        counts = np.bincount(labels)
+        sizes.append(counts[counts > 1])
+    return np.concatenate(sizes) if sizes else np.empty(0, dtype=int)
+
+
+def link_sample(centroids, params=None):
+    """Link centroids with tracking `params` and return summary metrics of the tracks."""
+
+    params = dict(TRACKING_DEFAULTS, **(params or {}))
+    t0 = time.perf_counter()
+    subnets = subnet_sizes(centroids, params['max_travel']) if len(centroids) else np.empty(0, dtype=int)
+
+    if len(centroids):
+        tracking.tp.quiet()
+        tracks = tracking.link(centroids.astype({'frame': int}), **params)
+    else:
+        tracks = centroids.assign(particle=pd.Series(dtype=int))
+    lengths = tracks.groupby('particle').size() if len(tracks) else pd.Series(dtype=int)
+
+    return {
+        'n_tracks': len(lengths),
+        'track_length_mean': lengths.mean() if len(lengths) else 0.,
+        'track_length_median': lengths.median() if len(lengths) else 0.,
+        'fraction_tracked': len(tracks) / len(centroids) if len(centroids) else 0.,
+        'subnet_size_mean': subnets.mean() if subnets.size else 0.,
+        'subnet_size_max': int(subnets.max()) if subnets.size else 0,
+        'link_runtime': time.perf_counter() - t0,
+    }
+
+
+def _init_worker(method, n_threads):
+    #Every worker gets its share of the CPUs, instead of torch using all of them in each process
+    if method == 'cellpose':
+        from .segmentation import set_torch_threads
+        set_torch_threads(n_threads)
+
+
+def _segment_job(file, fov, frames, method, params, channel, manual, model_options, cache):
+    centroids, runtime = segment_sample(file, fov, frames, method, params, channel, manual, model_options, cache)
+    counts = centroids.groupby('frame').size().reindex(frames, fill_value=0)
+    metrics = {'cells_per_frame': counts.mean(), 'cells_min': int(counts.min()), 'cells_max': int(counts.max()), 'seg_runtime': runtime}
+    return centroids, metrics
+
+
+def sweep(file, frames, fovs=(0,), seg_grid=None, track_grid=None, method='th', channel=0, manual=False, model_options=None, n_workers=None, cache=False):
+    """
+    Run segmentation and linking for every combination of the parameter grids.
+
+    Parameters
+    ----------
+    file : string
+        ND2 (or mp4/tif) file, opened with stacks.open_stack.
+    frames : list of int
+        Sample of frames to segment and link; linking works best on a contiguous range.
+    fovs : list of int, optional
+        FOVs to run on. The default is (0,).
+    seg_grid : dict, optional
+        {parameter: list of values} of the segmentation, e.g. {'diameter': [25, 29], 'flow_threshold': [0.6, 0.8]}
+        for Cellpose. Missing parameters take the defaults of Track.segment.
+    track_grid : dict, optional
+        {parameter: list of values} of 'track_memory', 'max_travel' and 'min_frames'. Missing parameters take
+        the defaults of Track.track.
+    method : string, optional
+        'th' or 'cellpose'. The default is 'th'.
+    channel : int, optional
+        Brightfield channel. The default is 0.
+    manual : bool, optional
+        Passed to the ND2 reader. The default is False.
+    model_options : dict, optional
+        Arguments of Segmentation for 'cellpose', e.g. {'pretrained_model': 'mdamb231', 'gpu': False}.
+    n_workers : int, optional
+        Number of worker processes. The default is None, which uses all CPUs; 1 runs everything in this
+        process (e.g. to share a GPU model). Workers are spawned and share the CPUs between their torch threads.
+    cache : bool, optional
+        Keep the masks in the on-disk segmentation cache in ~/.cache/lisca/segmentation, so later sweeps
+        (and Track.segment(cache=True)) with the same segmentation parameters reuse them. The default is False.
+
+    Returns
+    -------
+    results : pd.DataFrame
+        One row per (fov, segmentation, tracking) configuration with the parameters and metrics:
+        cells_per_frame, cells_min, cells_max, seg_runtime (seconds for the segmentation configuration),
+        n_tracks, track_length_mean, track_length_median, fraction_tracked, subnet_size_mean,
+        subnet_size_max and link_runtime.
+    """
+    frames = [int(t) for t in frames]
+    seg_configs = param_grid(seg_grid, SEGMENTATION_DEFAULTS[method])
+    track_configs = param_grid(track_grid, TRACKING_DEFAULTS)
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+
+    seg_jobs = [(fov, i) for fov in fovs for i in range(len(seg_configs))]
+    n_jobs = len(seg_jobs) * (1 + len(track_configs))
+    rows = []
+
+    def add_row(fov, i, j, seg_metrics, link_metrics):
+        rows.append({'fov': fov, 'method': method, **seg_configs[i], **track_configs[j], **seg_metrics, **link_metrics})
+
+    with tqdm(total=n_jobs, desc='Sweep') as pbar:
+        if n_workers == 1:
+            for fov, i in seg_jobs:
+                centroids, seg_metrics = _segment_job(file, fov, frames, method, seg_configs[i], channel, manual, model_options, cache)
+                pbar.update()
+                for j, config in enumerate(track_configs):
+                    add_row(fov, i, j, seg_metrics, link_sample(centroids, config))
+                    pbar.update()
+        else:
+            #Spawned, not forked: the caller may already run torch or OpenMP threads (e.g. in a notebook with a viewer)
+            n_threads = max(1, (os.cpu_count() or 1) // n_workers)
+            with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn'),
+                                     initializer=_init_worker, initargs=(method, n_threads)) as pool:
+                #The linking jobs of a segmentation configuration are submitted as soon as its centroids are ready
+                seg_futures = {pool.submit(_segment_job, file, fov, frames, method, seg_configs[i], channel, manual, model_options, cache): (fov, i)
+                               for fov, i in seg_jobs}
+                link_futures = {}
+                for future in as_completed(seg_futures):
+                    fov, i = seg_futures[future]
+                    centroids, seg_metrics = future.result()
+                    pbar.update()
+                    for j, config in enumerate(track_configs):
+                        link_futures[pool.submit(link_sample, centroids, config)] = (fov, i, j, seg_metrics)
+                for future in as_completed(link_futures):
+                    fov, i, j, seg_metrics = link_futures[future]
+                    add_row(fov, i, j, seg_metrics, future.result())
+                    pbar.update()
+
+    results = pd.DataFrame(rows)
+    sort_by = ['fov'] + list(seg_configs[0]) + list(track_configs[0])
+    return results.sort_values(sort_by, kind='stable').reset_index(drop=True) if len(results) else results
@@ -0,0 +1,295 @@
+"""Tiled segmentation of very large frames.
+
+A frame is split into a grid of tiles. Each tile is segmented together with a
+margin of `overlap` pixels on every side, so cells near a tile border are seen
+whole, but only the labels of the tile's core are kept. Labels of a cell that
+crosses a seam are joined by overlap voting: in the margin of a tile, every
+label is compared with the labels already stitched from the cores of its
+neighbors, and two labels that are each other's best match are merged.
+Only `n_threads` tiles (plus margins) are processed at a time, so the peak
+memory is bounded by the tile size, not the frame size.
+
+When cells can only occur inside a known region, e.g. the micropatterned
+lanes of `functions.get_lane_mask`, `segment_masked` segments only crops
+around the occupied parts of that region and leaves the rest of the frame
+empty. Tiles or crops whose pixel variance is below a noise floor are
+skipped in both modes.
+"""
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.ndimage as smg
+
+from .mask_store import compact_labels
+
+
+def tile_grid(shape, tile_size=2048, overlap=64):
+    """
+    Split a (height, width) frame into tiles.
+
+    Returns a list of (core, padded) tuples in raster order, each a (y0, y1, x0, x1) region.
+    The cores are about `tile_size` large and cover the frame without overlapping; the padded
+    regions extend the cores by `overlap` pixels on every side, within the frame.
+    """
+    height, width = shape
+    y_edges = np.linspace(0, height, max(1, -(-height // tile_size)) + 1).astype(int)
+    x_edges = np.linspace(0, width, max(1, -(-width // tile_size)) + 1).astype(int)
+    tiles = []
+    for y0, y1 in zip(y_edges[:-1], y_edges[1:]):
+        for x0, x1 in zip(x_edges[:-1], x_edges[1:]):
+            core = (int(y0), int(y1), int(x0), int(x1))
+            padded = (max(0, y0 - overlap), min(height, y1 + overlap), max(0, x0 - overlap), min(width, x1 + overlap))
+            tiles.append((core, tuple(int(v) for v in padded)))
+    return tiles
+
+
+def _intersect(a, b):
+    y0, y1, x0, x1 = max(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), min(a[3], b[3])
+    return (y0, y1, x0, x1) if y0 < y1 and x0 < x1 else None
+
+
+def _imap(fun, items, n_threads):
+    """Like ThreadPoolExecutor.map, in order, but with at most 2*n_threads results waiting."""
+
+    if n_threads == 1:
+        for item in items:
+            yield fun(item)
+        return
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(fun, item))
+            if len(pending) >= 2 * n_threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _votes(tile_labels, canvas, regions):
+    """Merge map {tile label: canvas label} of mutual best overlaps within `regions` (pairs of tile and frame slices)."""
+
+    pairs = []
+    for tile_sl, frame_sl in regions:
+        a, b = tile_labels[tile_sl].ravel(), canvas[frame_sl].ravel()
+        both = (a > 0) & (b > 0)
+        pairs.append((a[both].astype(np.int64) << 32) | b[both].astype(np.int64))
+    pairs = np.concatenate(pairs) if pairs else np.empty(0, dtype=np.int64)
+    if pairs.size == 0:
+        return {}
+
+    keys, counts = np.unique(pairs, return_counts=True)
+    a, b = keys >> 32, keys & 0xffffffff
+    #Best canvas label of every tile label, and best tile label of every canvas label
+    order = np.lexsort((-counts, a))
+    best_b = dict(zip(a[order][::-1], b[order][::-1]))
+    order = np.lexsort((-counts, b))
+    best_a = dict(zip(b[order][::-1], a[order][::-1]))
+    return {int(la): int(lb) for la, lb in best_b.items() if best_a[lb] == la}
+
+
+def _segment_crop(crop, segment, noise_floor=None):
+    if noise_floor is not None and crop.var() < noise_floor:
+        return np.zeros(crop.shape, dtype=np.uint8)
+    return np.asarray(segment(crop))
+
+
+def segment_tiled(frame, segment, tile_size=2048, overlap=64, n_threads=None, noise_floor=None):
+    """
+    Segment a large frame tile by tile, stitching the labels across the seams.
+
+    Parameters
+    ----------
+    frame : array
+        (height, width) frame; may be a memmap, only the tiles are read.
+    segment : callable
+        segment(tile) returns the labels of a (h, w) tile as an integer array (0 is background).
+        Called from several threads.
+    tile_size : int, optional
+        Side length of the tile cores. The default is 2048.
+    overlap : int, optional
+        Margin segmented around each core. Cells smaller than the margin that touch a seam are
+        seen whole by both tiles. The default is 64.
+    n_threads : int, optional
+        Number of tiles segmented at the same time. The default is None, which uses all CPUs.
+    noise_floor : float, optional
+        Tiles whose pixel variance is below this value are not segmented (no cells). The default
+        is None, which segments all tiles.
+
+    Returns
+    -------
+    labels : np.ndarray
+        (height, width) labels, in the smallest dtype holding them. Away from the seams, the cells
+        are those `segment` finds in the full frame.
+    """
+    if n_threads is None:
+        n_threads = os.cpu_count() or 1
+    tiles = tile_grid(frame.shape, tile_size, overlap)
+    canvas = np.zeros(frame.shape, dtype=np.uint32)
+    next_id = 1
+
+    def run(tile):
+        y0, y1, x0, x1 = tile[1]
+        return _segment_crop(np.asarray(frame[y0:y1, x0:x1]), segment, noise_floor)
+
+    for i, tile_labels in enumerate(_imap(run, tiles, max(1, n_threads))):
+        core, padded = tiles[i]
+        py0, _, px0, _ = padded
+
+        #The margin overlaps the cores of earlier tiles, which are already on the canvas
+        regions = []
+        for earlier, _ in tiles[:i]:
+            r = _intersect(padded, earlier)
+            if r is not None:
+                regions.append((np.s_[r[0]-py0:r[1]-py0, r[2]-px0:r[3]-px0], np.s_[r[0]:r[1], r[2]:r[3]]))
+        merged = _votes(tile_labels, canvas, regions)
+
+        y0, y1, x0, x1 = core
+        core_labels = tile_labels[y0-py0:y1-py0, x0-px0:x1-px0]
+        ids = np.unique(core_labels)
+        ids = ids[ids > 0]
+        lookup = np.zeros(int(tile_labels.max()) + 1 if tile_labels.size else 1, dtype=np.uint32)
+        for label in ids:
+            if int(label) in merged:
+                lookup[label] = merged[int(label)]
+            else:
+                lookup[label] = next_id
+                next_id += 1
+        canvas[y0:y1, x0:x1] = lookup[core_labels]
+
+    return compact_labels(canvas)
+
+
+def roi_boxes(roi_mask, margin=16):
+    """
+    Bounding boxes of the occupied parts of a region-of-interest mask.
+
+    Parameters
+    ----------
+    roi_mask : array
+        (height, width) mask; nonzero where cells can occur (e.g. a lane mask).
+    margin : int, optional
+        Pixels added around the region, so cells at its edge are segmented whole. The default is 16.
+
+    Returns
+    -------
+    boxes : list of (y0, y1, x0, x1)
+        Non-overlapping boxes covering the region plus margin, in raster order. Boxes that would
+        overlap are merged.
+    """
+    roi = np.asarray(roi_mask) > 0
+    if margin > 0:
+        roi = smg.binary_dilation(roi, iterations=margin)
+    boxes = [(sl[0].start, sl[0].stop, sl[1].start, sl[1].stop) for sl in smg.find_objects(smg.label(roi)[0])]
+
+    #Merge overlapping boxes until none overlap
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                if _intersect(boxes[i], boxes[j]) is not None:
+                    a, b = boxes[i], boxes.pop(j)
+                    boxes[i] = (min(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), max(a[3], b[3]))
+                    merged = True
+                    break
+            if merged:
+                break
+    return sorted(boxes)
+
+
+def segment_masked(frame, segment, roi_mask=None, boxes=None, margin=16, n_threads=None, noise_floor=None):
+    """
+    Segment only the parts of a frame where cells can occur.
+
+    Parameters
+    ----------
+    frame : array
+        (height, width) frame; may be a memmap, only the crops are read.
+    segment : callable
+        segment(crop) returns the labels of a (h, w) crop as an integer array (0 is background).
+        Called from several threads. May itself be tiled (see `segment_tiled`).
+    roi_mask : array, optional
+        (height, width) mask, nonzero where cells can occur. Not needed if `boxes` is given.
+    boxes : list of (y0, y1, x0, x1), optional
+        Crops to segment, from `roi_boxes`; pass them to avoid recomputing them for every frame.
+    margin : int, optional
+        Like `roi_boxes`. The default is 16.
+    n_threads : int, optional
+        Number of crops segmented at the same time. The default is None, which uses all CPUs.
+    noise_floor : float, optional
+        Crops whose pixel variance is below this value are not segmented. The default is None.
+
+    Returns
+    -------
+    labels : np.ndarray
+        (height, width) labels of the crops, pasted back into the frame, 0 everywhere else; in
+        the smallest dtype holding them.
+    """
+    if boxes is None:
+        boxes = roi_boxes(roi_mask, margin=margin)
+    if n_threads is None:
+        n_threads = os.cpu_count() or 1
+
+    canvas = np.zeros(frame.shape, dtype=np.uint32)
+    next_id = 1
+
+    def run(box):
+        y0, y1, x0, x1 = box
+        return _segment_crop(np.asarray(frame[y0:y1, x0:x1]), segment, noise_floor)
+
+    for (y0, y1, x0, x1), labels in zip(boxes, _imap(run, boxes, max(1, n_threads))):
+        #Labels of every crop are shifted past those of the crops before
+        ids, inverse = np.unique(labels, return_inverse=True)
+        new_ids = np.where(ids > 0, next_id + np.arange(ids.size) - (ids[0] == 0), 0).astype(np.uint32)
+        canvas[y0:y1, x0:x1] = new_ids[inverse.reshape(labels.shape)]
+        next_id += int((ids > 0).sum())
+
+    return compact_labels(canvas)
+
+
+def segment_frames(frames, segment_frame, segment_batch=None, boxes=None, noise_floor=None, n_threads=None):
+    """
+    Segment a batch of frames, skipping empty frames and regions.
+
+    Parameters
+    ----------
+    frames : array, LazyStack or list of 2D arrays
+        The frames.
+    segment_frame : callable
+        segment_frame(image) returns the labels of a frame, or of a crop if `boxes` are given.
+    segment_batch : callable, optional
+        segment_batch(list of frames) returns their labels; used instead of `segment_frame`
+        for whole frames, e.g. to run frames in parallel.
+    boxes : list of (y0, y1, x0, x1), optional
+        Only segment these crops of every frame (see `roi_boxes` and `segment_masked`).
+    noise_floor : float, optional
+        Frames, and crops, whose pixel variance is below this value get no cells.
+    n_threads : int, optional
+        Number of crops segmented at the same time.
+
+    Returns
+    -------
+    masks : list of np.ndarray
+        Labels of every frame, in the smallest dtype holding them.
+    """
+    frames = [np.asarray(frames[t]) for t in range(len(frames))]
+    masks = [None] * len(frames)
+    todo = []
+    for i, frame in enumerate(frames):
+        if noise_floor is not None and frame.var() < noise_floor:
+            masks[i] = np.zeros(frame.shape, dtype=np.uint8)
+        else:
+            todo.append(i)
+
+    if boxes is not None:
+        for i in todo:
+            masks[i] = segment_masked(frames[i], segment_frame, boxes=boxes, n_threads=n_threads, noise_floor=noise_floor)
+    elif segment_batch is not None and todo:
+        for i, mask in zip(todo, segment_batch([frames[i] for i in todo])):
+            masks[i] = compact_labels(mask)
+    else:
+        for i in todo:
+            masks[i] = compact_labels(segment_frame(frames[i]))
+    return masks
@@ -0,0 +1,178 @@
+"""Columnar storage of tracking tables.
+
+A table is kept in an HDF5 file with one chunked, compressed dataset per
+column, rows sorted by frame. Two indexes are stored next to the columns:
+the first row of every frame, and the rows of every particle. Single columns,
+frames or particles can be read without touching the rest of the file, and
+new columns (e.g. a fluorescence channel) are added without rewriting it.
+"""
+import os
+
+import h5py
+import numpy as np
+import pandas as pd
+
+TRACKS_FILE = 'tracking_data'
+COLUMNS = 'columns'
+INDEX = 'index'
+
+
+def tracks_path(path_out, ext='.h5'):
+    """Path of the tracking table written by Track.track."""
+    return os.path.join(path_out, TRACKS_FILE + ext)
+
+
+def _create_column(group, name, values, chunk_rows, level):
+    values = np.asarray(values)
+    if values.dtype.kind in 'OU':
+        values = values.astype(object)
+        dtype = h5py.string_dtype()
+    else:
+        dtype = values.dtype
+    kwargs = {}
+    if values.size:
+        kwargs = dict(chunks=(min(values.size, chunk_rows),), compression='gzip', compression_opts=level, shuffle=True)
+    group.create_dataset(name, data=values, dtype=dtype, **kwargs)
+
+
+def write_tracks(file, df, chunk_rows=1<<16, level=4):
+    """
+    Write a tracking table to `file`, replacing an existing file.
+
+    Parameters
+    ----------
+    file : string
+        Output path.
+    df : pd.DataFrame
+        Table with at least a 'frame' column; a 'particle' column gets a per-particle index.
+        A unique index is stored as the row ids, otherwise (e.g. trackpy's frame index) the
+        row positions are.
+    chunk_rows : int, optional
+        Rows per chunk. The default is 65536.
+    level : int, optional
+        gzip compression level. The default is 4.
+    """
+    #Sorted by the column values: trackpy's output also has an index named 'frame'
+    rows = df.index.values if df.index.is_unique else np.arange(len(df))
+    order = np.argsort(df['frame'].values, kind='stable')
+    df, rows = df.iloc[order], rows[order]
+    with h5py.File(file, 'w') as f:
+        columns = f.create_group(COLUMNS)
+        for name in df.columns:
+            _create_column(columns, str(name), df[name].values, chunk_rows, level)
+        f.attrs['columns'] = [str(name) for name in df.columns]
+
+        index = f.create_group(INDEX)
+        _create_column(index, 'row', rows, chunk_rows, level)
+        frames = df['frame'].values.astype(np.int64)
+        n_frames = int(frames.max()) + 1 if frames.size else 0
+        index['frame_start'] = np.searchsorted(frames, np.arange(n_frames + 1))
+
+        if 'particle' in df:
+            particles = df['particle'].values
+            order = np.argsort(particles, kind='stable')
+            ids, starts = np.unique(particles[order], return_index=True)
+            index['particle_ids'] = ids
+            index['particle_start'] = np.append(starts, order.size)
+            index['particle_rows'] = order
+
+
+def _rows(f, frames=None, particles=None):
+    """Sorted rows of the selected frames and particles, or None for all rows."""
+
+    rows = None
+    if frames is not None:
+        frame_start = f[INDEX]['frame_start'][:]
+        frames = np.unique(np.atleast_1d(frames))
+        frames = frames[(frames >= 0) & (frames < frame_start.size - 1)]
+        rows = np.concatenate([np.arange(frame_start[t], frame_start[t+1]) for t in frames] or [np.empty(0, dtype=np.int64)])
+    if particles is not None:
+        if 'particle_ids' not in f[INDEX]:
+            raise KeyError(f'{f.filename} has no particle index')
+        ids, starts = f[INDEX]['particle_ids'][:], f[INDEX]['particle_start'][:]
+        pos = np.searchsorted(ids, np.atleast_1d(particles))
+        pos = pos[(pos < ids.size) & (ids[np.minimum(pos, ids.size - 1)] == np.atleast_1d(particles))]
+        particle_rows = f[INDEX]['particle_rows']
+        selected = np.concatenate([particle_rows[starts[i]:starts[i+1]] for i in pos] or [np.empty(0, dtype=np.int64)])
+        rows = selected if rows is None else np.intersect1d(rows, selected)
+    return None if rows is None else np.unique(rows)
+
+
+def _read(ds, rows):
+    if rows is None:
+        return ds[:]
+    if rows.size == 0:
+        return ds[:0]
+    if rows[-1] - rows[0] + 1 == rows.size:
+        #Contiguous rows, e.g. a range of frames, are read as one slice
+        return ds[int(rows[0]):int(rows[-1]) + 1]
+    return ds[rows]
+
+
+def read_tracks(file, columns=None, frames=None, particles=None):
+    """
+    Read a tracking table, or a part of it.
+
+    Parameters
+    ----------
+    file : string
+        Path to a table written by write_tracks.
+    columns : list of string, optional
+        Columns to read. The default is None, which reads all columns.
+    frames : int or list of int, optional
+        Only read the rows of these frames, using the frame index.
+    particles : int or list of int, optional
+        Only read the rows of these particles, using the particle index.
+
+    Returns
+    -------
+    df : pd.DataFrame
+        The rows, sorted by frame, with the index of the table that was written.
+    """
+    with h5py.File(file, 'r') as f:
+        names = list(f.attrs['columns']) if columns is None else list(columns)
+        rows = _rows(f, frames, particles)
+        data = {}
+        for name in names:
+            values = _read(f[COLUMNS][name], rows)
+            if h5py.check_string_dtype(f[COLUMNS][name].dtype) is not None:
+                values = values.astype(str).astype(object)
+            data[name] = values
+        index = _read(f[INDEX]['row'], rows)
+    return pd.DataFrame(data, index=index, columns=names)
+
+
+def append_column(file, name, values, chunk_rows=1<<16, level=4):
+    """
+    Add column `name` to a table, or replace it, without rewriting the other columns.
+
+    `values` is either a pd.Series, aligned to the rows through its index (the row ids stored by
+    write_tracks), or an array in the row order of the file (sorted by frame).
+    """
+    with h5py.File(file, 'a') as f:
+        if isinstance(values, pd.Series):
+            if not values.index.is_unique:
+                raise ValueError(f'Column {name} has a non-unique index and cannot be aligned to the rows')
+            values = values.reindex(f[INDEX]['row'][:]).values
+        values = np.asarray(values)
+        if values.shape != (f[INDEX]['row'].shape[0],):
+            raise ValueError(f'Column {name} has {values.size} values, the table has {f[INDEX]["row"].shape[0]} rows')
+        names = list(f.attrs['columns'])
+        if name in f[COLUMNS]:
+            del f[COLUMNS][name]
+        else:
+            names.append(name)
+        _create_column(f[COLUMNS], name, values, chunk_rows, level)
+        f.attrs['columns'] = names
+
+
+def load_tracks(path_out, columns=None):
+    """Read the tracking table of a Track run, falling back to the legacy tracking_data.csv."""
+
+    file = tracks_path(path_out)
+    if os.path.isfile(file):
+        return read_tracks(file, columns=columns)
+    csv_file = tracks_path(path_out, ext='.csv')
+    if os.path.isfile(csv_file):
+        return pd.read_csv(csv_file, usecols=columns)
+    raise FileNotFoundError(f'No tracking data found at {file} or {csv_file}')
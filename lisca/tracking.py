@@ -7,35 +7,63 @@ from tqdm import tqdm
 #from skimage.segmentation import find_boundaries
 import pandas as pd
 
+from .stacks import iter_frames
+
 
 def get_centroids(masks):
+    """
+    Centroids and areas of all labels, frame by frame.
 
-    nframes = masks.shape[0]
-    ids=np.unique(masks)
-    ids = ids[ids!=0]
-    
-    dfs = []  # List to collect DataFrames
+    masks can be a (t, h, w) array, a LazyStack or a stream of (frame index, mask) tuples,
+    so only one frame has to be in memory at a time.
+    """
+
+    dtypes = {'frame': np.int64, 'x': np.float64, 'y': np.float64, 'cyto_locator': np.int64, 'area': np.int64}
+    n_frames = len(masks) if hasattr(masks, '__len__') else None
+    columns = {name: np.empty(0, dtype=dtype) for name, dtype in dtypes.items()}
+    n_rows = 0
+    #Row and column index of every pixel, as bincount weights; built once per frame shape
+    coordinates = {}
     print('Computing centroids')
-    for frame in tqdm(range(nframes)):
-        for identifier in ids:
-            mask = masks[frame]
-            count = np.sum(mask==identifier)
-            if count==0:
-                continue
-            points =  np.argwhere(mask==identifier)
-            y = points[:,0].sum()/count
-            x = points[:, 1].sum()/count
-            
-            data = {
-            'frame':[frame],
-            'x':[x], 'y':[y], 'cyto_locator': identifier,
-            'area': count}
-
-            new_df = pd.DataFrame.from_dict(data)
-            dfs.append(new_df)
-
-    # Concatenate all DataFrames at once
-    df = pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame(columns=['frame', 'x', 'y', 'cyto_locator', 'area'])
+    for i, (frame, mask) in enumerate(tqdm(iter_frames(masks), total=n_frames)):
+        mask = np.asarray(mask)
+        if mask.shape not in coordinates:
+            height, width = mask.shape
+            coordinates[mask.shape] = (np.repeat(np.arange(height, dtype=np.float64), width), np.tile(np.arange(width, dtype=np.float64), height))
+        y, x = coordinates[mask.shape]
+        labels = mask.ravel()
+        n = int(labels.max()) + 1 if labels.size else 1
+        if n > labels.size:
+            #Sparse label values: count the labels present instead of all values up to the maximum
+            ids, labels = np.unique(labels, return_inverse=True)
+            n = ids.size
+        else:
+            ids = np.arange(n)
+
+        #Pixel count and coordinate sums of all labels in one pass each
+        count = np.bincount(labels, minlength=n)
+        sum_y = np.bincount(labels, weights=y, minlength=n)
+        sum_x = np.bincount(labels, weights=x, minlength=n)
+
+        present = (count > 0) & (ids != 0)
+        count = count[present]
+        rows = slice(n_rows, n_rows + count.size)
+        if rows.stop > columns['frame'].size:
+            #Sized for all frames at the cell count so far, so the columns are usually allocated once
+            capacity = max(rows.stop, 2 * columns['frame'].size)
+            if n_frames is not None:
+                capacity = max(capacity, rows.stop * n_frames // (i + 1) * 5 // 4)
+            for name, values in columns.items():
+                columns[name] = np.empty(capacity, dtype=values.dtype)
+                columns[name][:n_rows] = values[:n_rows]
+        columns['frame'][rows] = frame
+        np.divide(sum_x[present], count, out=columns['x'][rows])
+        np.divide(sum_y[present], count, out=columns['y'][rows])
+        columns['cyto_locator'][rows] = ids[present]
+        columns['area'][rows] = count
+        n_rows = rows.stop
+
+    df = pd.DataFrame({name: values[:n_rows] for name, values in columns.items()})
     return df
 
 def track(masks, track_memory=15, max_travel=5, min_frames=10, pixel_to_um=1, verbose=False):
@@ -79,30 +107,45 @@ def track(masks, track_memory=15, max_travel=5, min_frames=10, pixel_to_um=1, ve
     print('Tracking')
     if verbose:
         print('Tracking')
-    t = tp.link(f, max_travel, memory=track_memory)
-
-    t = tp.filter_stubs(t, min_frames)
+    t = link(f, track_memory=track_memory, max_travel=max_travel, min_frames=min_frames)
 
     if verbose:
         print('Tracking of nuclei completed.')
 
     return t
 
+def link(f, track_memory=15, max_travel=5, min_frames=10):
+    """Link a table of centroids (see get_centroids) into tracks and drop tracks shorter than min_frames."""
+
+    t = tp.link(f, np.round(max_travel), memory=track_memory)
+
+    t = tp.filter_stubs(t, min_frames)
+
+    return t
+
 def read_fluorescence(df, fl_image, masks, label):
+    """
+    Add the total fluorescence inside the mask of every tracked cell as column `label`.
 
-    ids=np.unique(df.particle)
-    df[label]=np.zeros(len(df))
-    
-    for identifier in tqdm(ids):
-        dfp = df[df.particle==identifier]
-        frames = dfp.frame.values
-        cyto_locator = dfp.cyto_locator.values
-        bin_masks=masks[frames]==cyto_locator[:,np.newaxis, np.newaxis]
-        fluorescence = (fl_image[frames]*bin_masks).sum(axis=(1,2))
-        #print(fluorescence.shape, len(df.loc[(df.particle==identifier), label]))
-        df.loc[(df.particle==identifier), label]=fluorescence
+    fl_image and masks can be (t, h, w) arrays, LazyStacks or streams of (frame index, frame)
+    tuples; they are read together one frame at a time.
+    """
+
+    values = np.zeros(len(df))
+    #trackpy output is indexed by frame as well, so group the rows by the column values
+    rows = pd.Series(np.arange(len(df))).groupby(df['frame'].values).indices
+    cyto_locator = df.cyto_locator.values.astype(np.intp)
+
+    for (frame, fl), (mask_frame, mask) in tqdm(zip(iter_frames(fl_image), iter_frames(masks)), total=len(masks) if hasattr(masks, '__len__') else None):
+        if frame != mask_frame:
+            raise ValueError(f'Fluorescence frame {frame} does not match mask frame {mask_frame}')
+        idx = rows.get(frame)
+        if idx is None:
+            continue
+        #Sum of the fluorescence under each label of this frame
+        sums = np.bincount(mask.ravel(), weights=fl.ravel(), minlength=cyto_locator[idx].max()+1)
+        values[idx] = sums[cyto_locator[idx]]
+
+    df[label] = values
         
     return df
-
-    
-
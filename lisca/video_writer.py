@@ -3,10 +3,43 @@ numpy.float = float
 numpy.int = int
 numpy.bool = bool
 import skvideo.io
+import numpy as np
+import os
+import queue
+import subprocess
+import tempfile
+import threading
+
+_CLOSE = object()
+
+
+class EncoderError(IOError):
+    """ffmpeg failed while encoding a movie."""
+
 
 class Mp4writer:
 
-    def __init__(self, out, outputdict=None, rate=10, crf=0, vf=None):
+    def __init__(self, out, outputdict=None, rate=10, crf=0, vf=None, queue_size=0):
+        """
+        Encode frames to an mp4 movie with ffmpeg.
+
+        Parameters
+        ----------
+        out : string
+            Output path.
+        outputdict : dict, optional
+            ffmpeg output options. The default is lossless h.264 at `rate` frames per second.
+        rate : int, optional
+            Frame rate. The default is 10.
+        crf : int, optional
+            Constant rate factor, 0 is lossless. The default is 0.
+        vf : string, optional
+            ffmpeg video filter.
+        queue_size : int, optional
+            If larger than 0, write_frame returns immediately and a worker thread feeds ffmpeg. At most
+            queue_size frames wait for the encoder; write_frame blocks while the queue is full. The default
+            is 0, which writes synchronously.
+        """
 
         if outputdict is None:
             outputdict={
@@ -18,20 +51,128 @@ class Mp4writer:
             }
 
         if vf is not None:
-            outputdict['vf']=vf
-
-        self.writer = skvideo.io.FFmpegWriter(out, 
-            inputdict={
-        '-r': str(rate)
-        #other options see https://trac.ffmpeg.org/wiki/Encode/H.264
-        },
-            outputdict=outputdict)
-
-    def write_frame(self, frame):
-        
-        self.writer.writeFrame(frame)
-    
+            outputdict['-vf']=vf
+
+        self.out = out
+        self.rate = rate
+        self.outputdict = outputdict
+        self.frame_shape = None
+        self.frame_dtype = None
+        self.proc = None
+        self.n_frames = 0
+        self._error = None
+
+        self.queue_size = queue_size
+        if queue_size > 0:
+            self._queue = queue.Queue(maxsize=queue_size)
+            self._worker = threading.Thread(target=self._work, daemon=True)
+            self._worker.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _start(self, shape):
+        #ffmpeg is started on the first frame, when the frame size is known
+        if len(shape) == 2 or (len(shape) == 3 and shape[2] == 3):
+            pix_fmts = {np.uint8: ('gray', 'rgb24'), np.uint16: ('gray16le', 'rgb48le')}[self.frame_dtype.type]
+            pix_fmt = pix_fmts[len(shape) - 2]
+        else:
+            raise ValueError(f'Frames must be (height, width) or (height, width, 3), got {shape}')
+        self.frame_shape = shape
+        cmd = [os.path.join(skvideo.getFFmpegPath(), 'ffmpeg'), '-y', '-f', 'rawvideo', '-pix_fmt', pix_fmt,
+               '-s', f'{shape[1]}x{shape[0]}', '-r', str(self.rate), '-i', '-']
+        for key, value in self.outputdict.items():
+            cmd += [key, value]
+        cmd.append(self.out)
+        self._stderr = tempfile.TemporaryFile()
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=self._stderr)
+
+    def _encoder_error(self, message):
+        self._stderr.seek(0)
+        log = self._stderr.read().decode(errors='replace').strip().splitlines()[-10:]
+        return EncoderError(f'{message} ({os.path.basename(self.out)})\n' + '\n'.join(log))
+
+    def _write(self, frame):
+        if self.proc is None:
+            self._start(frame.shape)
+        elif frame.shape != self.frame_shape:
+            raise ValueError(f'Frame has shape {frame.shape}, the movie has {self.frame_shape}')
+        try:
+            #Contiguous frames go to the pipe as they are, without a copy
+            self.proc.stdin.write(memoryview(frame).cast('B'))
+        except (BrokenPipeError, OSError):
+            raise self._encoder_error('ffmpeg stopped accepting frames')
+        self.n_frames += 1
+
+    def _work(self):
+        while True:
+            frame = self._queue.get()
+            try:
+                if frame is _CLOSE:
+                    return
+                if self._error is None:
+                    self._write(frame)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _check(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def write_frame(self, frame, copy=True):
+        """
+        Append a (height, width) grey or (height, width, 3) RGB frame.
+
+        The first frame sets the bit depth of the movie: uint16 frames are encoded with 16 bits per
+        sample (gray16le or rgb48le; libx264 keeps the upper 10 bits), all other frames with 8 bits.
+        Later frames are clipped to the range of that depth. With a queue, the frame is copied unless it
+        was converted or copy=False is passed, in which case it must not be changed until it is written.
+        """
+        frame = np.asarray(frame)
+        if self.frame_dtype is None:
+            self.frame_dtype = np.dtype('<u2') if frame.dtype == np.uint16 else np.dtype(np.uint8)
+        if frame.dtype != self.frame_dtype:
+            frame = np.clip(frame, 0, np.iinfo(self.frame_dtype).max).astype(self.frame_dtype)
+        elif not frame.flags.c_contiguous:
+            frame = np.ascontiguousarray(frame)
+        elif copy and self.queue_size > 0:
+            frame = frame.copy()
+
+        if self.queue_size > 0:
+            self._check()
+            self._queue.put(frame)
+        else:
+            self._write(frame)
+
+    def flush(self):
+        """Wait until all queued frames are passed to ffmpeg, raising any error of the encoder."""
+        if self.queue_size > 0:
+            self._queue.join()
+        self._check()
+
     def close(self):
+        """Finish the movie, raising any error of the encoder, or EncoderError if ffmpeg failed."""
+        if self.queue_size > 0 and self._worker.is_alive():
+            self._queue.put(_CLOSE)
+            self._worker.join()
+        error, self._error = self._error, None
 
-        self.writer.close()
+        if self.proc is not None:
+            proc, self.proc = self.proc, None
+            try:
+                proc.stdin.close()
+            except OSError:
+                pass
+            returncode = proc.wait()
+            if error is None and returncode != 0:
+                error = self._encoder_error(f'ffmpeg exited with code {returncode}')
+            self._stderr.close()
 
+        if error is not None:
+            raise error
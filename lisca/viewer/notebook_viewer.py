@@ -2,7 +2,6 @@ from urllib import request
 import ipywidgets as widgets
 import matplotlib.pyplot as plt
 #import mpl_interactions.ipyplot as iplt
-from nd2reader import ND2Reader
 import pandas as pd
 from IPython.display import display
 import sqlite3
@@ -16,7 +15,11 @@ except:
 import sys
 sys.path.append('/home/m/Miguel.Atienza/celltracker')
 from .. import functions
+from .. import nd2_io
 from .. import tracking
+from .. import seg_cache
+from .. import mask_store
+from .. import track_store
 from tqdm import tqdm
 from collections.abc import Iterable
 import trackpy as tp
@@ -28,24 +31,19 @@ from skimage.io import imread
 from .. import cp
 import matplotlib.collections as collections
 
-class StackViewer:
+class StackViewer(nd2_io.ND2ReaderMixin):
     
     def __init__(self, nd2file, manual=False):
         
                
-        self.f = ND2Reader(nd2file)
+        self.nd2file=nd2file
+        self.manual=manual
         self.image = self.f.get_frame_2D()
         self.dtype= self.image.dtype
         self.h, self.w = self.image.shape
         self.pixelbits = 8*int(self.image.nbytes/(self.h*self.w))
   
-        if not manual:
-            self.nfov, self.nframes = self.f.sizes['v'], self.f.sizes['t']
-        else:
-            self.nfov, self.nframes = 288, 179
-            self.f.sizes['v']=self.nfov
-            self.f.sizes['t']=self.nframes
-            self.f.metadata['fields_of_view']=list(range(self.nfov))
+        self.nfov, self.nframes = self.f.sizes['v'], self.f.sizes['t']
         
         #Widgets
         t_max = self.f.sizes['t']-1
@@ -104,7 +102,7 @@ class LaneViewer:
     def __init__(self, nd2_file, df=None):
 
         self.v = 0
-        f = ND2Reader(nd2_file)
+        f = nd2_io.get_reader(nd2_file)
         
         self.lanes = np.array([f.get_frame_2D(v=v) for v in range(f.sizes['v'])])
         axes = f.axes
@@ -197,20 +195,15 @@ class LaneViewer:
 
 
         
-class TpViewer:
+class TpViewer(nd2_io.ND2ReaderMixin):
     
     def __init__(self, nd2file, manual=False):
         
         self.link_dfs = {}
         
-        self.f = ND2Reader(nd2file)
-        if not manual:
-            self.nfov, self.nframes = self.f.sizes['v'], self.f.sizes['t']
-        else:
-            self.nfov, self.nframes = 288, 179
-            self.f.sizes['v']=self.nfov
-            self.f.sizes['t']=self.nframes
-            self.f.metadata['fields_of_view']=list(range(self.nfov))
+        self.nd2file=nd2file
+        self.manual=manual
+        self.nfov, self.nframes = self.f.sizes['v'], self.f.sizes['t']
         
         #Widgets
         t_max = self.f.sizes['t']-1
@@ -328,22 +321,16 @@ class TpViewer:
         self.update(self.t.value, self.c.value, self.v.value, self.clip.value, self.min_mass.value, self.diameter.value, self.min_frames.value, self.max_travel.value)
         
 
-class CellposeViewer:
+class CellposeViewer(nd2_io.ND2ReaderMixin):
     
     def __init__(self, nd2file, manual=False):
         
         
         self.link_dfs = {}
         
-        self.f = ND2Reader(nd2file)
-        
-        if not manual:
-            self.nfov, self.nframes = self.f.sizes['v'], self.f.sizes['t']
-        else:
-            self.nfov, self.nframes = 288, 179
-            self.f.sizes['v']=self.nfov
-            self.f.sizes['t']=self.nframes
-            self.f.metadata['fields_of_view']=list(range(self.nfov))
+        self.nd2file=nd2file
+        self.manual=manual
+        self.nfov, self.nframes = self.f.sizes['v'], self.f.sizes['t']
         
         channels = self.f.metadata['channels']
 
@@ -427,26 +414,10 @@ class CellposeViewer:
         plt.ion()
     
     def init_cellpose(self, pretrained_model='mdamb231', model='cyto', gpu=True):
-        
-        if pretrained_model is None:
-            self.model = models.Cellpose(gpu=gpu, model_type='cyto')
 
-        else:
-            path_to_models = os.path.join('/home/m/Miguel.Atienza/celltracker/celltracker/', 'models')
-            with open(os.path.join(path_to_models, 'models.json'), 'r') as f:
-                dic = json.load(f)
-
-            if pretrained_model in dic.keys():
-                path_to_model = os.path.join(path_to_models, dic[pretrained_model]['path'])
-                if os.path.isfile(path_to_model):
-                    pretrained_model = path_to_model
-                else: 
-                    url = dic[pretrained_model]['link']
-                    print('Downloading model from Nextcloud...')
-                    request.urlretrieve(url, os.path.join(path_to_models, path_to_model))
-                    pretrained_model = os.path.join(path_to_models,dic[pretrained_model]['path'])
-
-            self.model = models.CellposeModel(gpu=gpu, pretrained_model=pretrained_model)
+        #The model is shared with the pipeline and other viewers in this kernel
+        from ..segmentation import get_model
+        self.model = get_model(pretrained_model, gpu=gpu)
 
     def update(self, t, v, cclip, nclip, flow_threshold, diameter, mask_threshold, max_travel):      
         
@@ -492,8 +463,9 @@ class CellposeViewer:
         
         image = np.stack((cyto, nucleus), axis=1)
         
-        mask = self.model.eval(
-            image, diameter=diameter, channels=[1,2], flow_threshold=flow_threshold, mask_threshold=mask_threshold, normalize=normalize, verbose=verbose)[0].astype('uint8')
+        segment = lambda images: [mask_store.compact_labels(self.model.eval(
+            images[0], diameter=diameter, channels=[1,2], flow_threshold=flow_threshold, mask_threshold=mask_threshold, normalize=normalize, verbose=verbose)[0])]
+        mask = seg_cache.get_cache(disk=False).segment([image], segment, 'cellpose', self.model, channels=[1,2], diameter=diameter, flow_threshold=flow_threshold, mask_threshold=mask_threshold, normalize=normalize)[0]
         
         
         bin_mask = np.zeros(mask.shape, dtype='bool')
@@ -533,7 +505,7 @@ class CellposeViewer:
         return image
         
 
-class ResultsViewer:
+class ResultsViewer(nd2_io.ND2ReaderMixin):
     
     def __init__(self, nd2file, outpath, db_path = '/project/ag-moonraedler/MAtienza/database/onedcellmigration.db', path_to_patterns=None, manual=False):
         
@@ -541,16 +513,7 @@ class ResultsViewer:
         self.cyto_locator=None
         self.path_to_patterns=path_to_patterns
         self.nd2file=nd2file
-        self.f = ND2Reader(nd2file)
-
-        if not manual:
-            self.nfov, self.nframes = self.f.sizes['v'], self.f.sizes['t']
-        else:
-            self.nfov, self.nframes = 288, 179
-            self.f.sizes['v']=self.nfov
-            self.f.sizes['t']=self.nframes
-            self.f.metadata['fields_of_view']=list(range(self.nfov))
-
+        self.manual=manual
         self.nfov, self.nframes = self.f.sizes['v'], self.f.sizes['t']
         
         self.outpath=outpath
@@ -789,12 +752,13 @@ class ResultsViewer:
 
             conn.close()
         
-        elif not os.path.isfile(os.path.join(self.outpath, f'XY{fov}/cyto_masks.mp4')):
+        elif not any(os.path.isfile(mask_store.mask_path(os.path.join(self.outpath, f'XY{fov}'), 'cellpose', ext)) for ext in ('.h5', '.mp4')):
 
             print('No data available for this fov')
         else:
 
-            self.df = pd.read_csv(f'{self.outpath}/XY{fov}/tracking_data.csv')
+            #Reads tracking_data.h5, or the csv written by older versions
+            self.df = track_store.load_tracks(os.path.join(self.outpath, f'XY{fov}'))
             self.df['particle_id']=self.df.particle
 
             if self.masks_available:
@@ -809,12 +773,11 @@ class ResultsViewer:
 
     def load_masks(self, outpath, fov):
         
-        path_to_mask = os.path.join(outpath, f'XY{fov}/cyto_masks.mp4')
-        
-        if os.path.isfile(path_to_mask):
-            self.masks = functions.mp4_to_np(path_to_mask)
+        #Wide label file, or the legacy 8-bit mp4
+        try:
+            self.masks = mask_store.open_masks(os.path.join(outpath, f'XY{fov}'), 'cellpose')
             self.masks_available=True
-        else:
+        except FileNotFoundError:
             print('No masks available')
             self.masks_available=False
         return      
@@ -899,7 +862,7 @@ class ResultsViewer:
         for boundary in t_[np.clip(np.array(segments).flatten().astype(int), 0, t_.size-1)]:
             self.ax2.axvline(boundary, color='green')
 
-        self.cyto_locator = np.zeros(self.masks.shape[0], dtype='uint8')
+        self.cyto_locator = np.zeros(self.masks.shape[0], dtype=self.masks.dtype)
         
         self.cyto_locator[self.dfp.frame]=self.masks[self.dfp.frame, np.round(self.dfp.y).astype(int), np.round(self.dfp.x).astype(int)]
         
@@ -4,45 +4,47 @@ import ipywidgets as widgets
 import matplotlib.pyplot as plt
 from lisca.segmentation import Segmentation
 import numpy as np
-from nd2reader import ND2Reader
 import pandas as pd
 from IPython.display import display
 import os
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from lisca import functions
+from lisca import stacks
+from lisca import mask_store
+from lisca import track_store
+from lisca import seg_cache
 import sqlite3
 from skimage.morphology import binary_erosion
 from skimage.segmentation import find_boundaries
 
-class StackViewer:
+class StackViewer(stacks.ND2StackMixin):
     
     def __init__(self, nd2file, manual=False):
         
                
-        self.f = ND2Reader(nd2file)
-        self.image = self.f.get_frame_2D()
+        self.nd2file=nd2file
+        self.manual=manual
+        self.image = self.stack(0)[0]
         self.dtype= self.image.dtype
         self.h, self.w = self.image.shape
         self.pixelbits = 8*int(self.image.nbytes/(self.h*self.w))
   
-        if not manual:
-            self.nfov, self.nframes = self.f.sizes['v'], self.f.sizes['t']
-        else:
-            self.nfov, self.nframes = 288, 179
-            self.f.sizes['v']=self.nfov
-            self.f.sizes['t']=self.nframes
-            self.f.metadata['fields_of_view']=list(range(self.nfov))
+        self.nfov, self.nframes = self.index.sizes['v'], self.index.sizes['t']
         
         #Widgets
-        t_max = self.f.sizes['t']-1
+        t_max = self.index.sizes['t']-1
         self.t = widgets.IntSlider(min=0,max=t_max, step=1, description="t", continuous_update=True)
 
-        if 'c' in self.f.sizes:
-            c_max = self.f.sizes['c']-1
+        if 'c' in self.index.sizes:
+            c_max = self.index.sizes['c']-1
         else:
             c_max=0
         self.c = widgets.IntSlider(min=0,max=c_max, step=1, description="c", continuous_update=True)
 
-        v_max = self.f.sizes['v']-1
+        v_max = self.index.sizes['v']-1
         self.v = widgets.IntSlider(min=0,max=v_max, step=1, description="v", continuous_update=False)
         
         clip_max=2**(self.pixelbits)*0.6
@@ -76,7 +78,7 @@ class StackViewer:
     def update(self, t, c, v, clip):
 
         vmin, vmax = clip
-        image = self.f.get_frame_2D(v=v,c=c,t=t)
+        image = self.stack(v, c)[t]
                
         self.im.set_data(image)
         #lanes = g.get_frame_2D(v=v)
@@ -84,27 +86,40 @@ class StackViewer:
         #self.fig.canvas.draw()
 
 
-class CellposeViewer:
+class CellposeViewer(stacks.ND2StackMixin):
     
-    def __init__(self, nd2file, channel, manual=False):
+    def __init__(self, nd2file, channel, manual=False, preview=True, preview_scale=0.5, max_results=64):
+        """
+        Tune Cellpose parameters on the frames of an ND2 file.
+
+        With preview=True, a change of t, v or the segmentation sliders first shows the segmentation of a
+        downsampled frame (by `preview_scale`) and refines it to full resolution in a background thread;
+        a refinement that is outdated by another slider change is cancelled, or dropped if it already runs.
+        The preview uses its own model instance, so it never waits for a refinement. Refined masks are
+        drawn from the figure's timer, in the GUI thread. The last `max_results` full resolution results
+        are kept per (t, v, parameters), so going back to them is instant.
+        """
         
-        self.f = ND2Reader(nd2file)
-        
-        if not manual:
-            self.nfov, self.nframes = self.f.sizes['v'], self.f.sizes['t']
-        else:
-            self.nfov, self.nframes = 288, 179
-            self.f.sizes['v']=self.nfov
-            self.f.sizes['t']=self.nframes
-            self.f.metadata['fields_of_view']=list(range(self.nfov))
+        self.nd2file=nd2file
+        self.manual=manual
+        self.preview=preview
+        self.preview_scale=preview_scale
+        self.max_results=max_results
+        self._results = OrderedDict()
+        self._results_lock = threading.Lock()
+        self._key = None
+        self._bf = None
+        self._generation = 0
+        self._pending = []
+        self.nfov, self.nframes = self.index.sizes['v'], self.index.sizes['t']
         
         self.channel=channel
         #Widgets
         
-        t_max = self.f.sizes['t']-1
+        t_max = self.index.sizes['t']-1
         self.t = widgets.IntSlider(min=0,max=t_max, step=1, description="t", continuous_update=False)
 
-        v_max = self.f.sizes['v']-1
+        v_max = self.index.sizes['v']-1
         self.v = widgets.IntSlider(min=0,max=v_max, step=1, description="v", continuous_update=False)
         
         self.cclip = widgets.FloatRangeSlider(min=0,max=2**16, step=1, value=[50,8000], description="clip cyto", continuous_update=False, width='200px')
@@ -116,7 +131,7 @@ class CellposeViewer:
         self.mask_threshold = widgets.FloatSlider(min=-3,max=3, step=0.1, value=0, description="mask_threshold", continuous_update=False)
         
     
-        image = self.f.get_frame_2D(v=0,c=self.channel,t=0)
+        image = self.stack(0, self.channel)[0]
         
         ##Initialize the figure
         plt.ioff()
@@ -129,12 +144,18 @@ class CellposeViewer:
 
         self.segmenter = Segmentation(pretrained_model='mdamb231')
         #self.segmenter = Segmentation(pretrained_model=None)
-        self.mask = self.segmenter.segment_image(image, self.diameter.value, self.flow_threshold.value, self.mask_threshold.value)
-
-        self.flow_threshold_value = self.flow_threshold.value
-        self.diameter_value = self.diameter.value
-        self.mask_threshold_value = self.mask_threshold.value
-        self.t_value=0
+        if preview:
+            #The registry's private instance of the model, shared by the previews of all viewers
+            self.preview_segmenter = Segmentation(pretrained_model='mdamb231', shared_model=False)
+            self._refiner = ThreadPoolExecutor(max_workers=1)
+            #The worker thread ends when the figure is closed, or when the viewer is dropped
+            weakref.finalize(self, self._refiner.shutdown, wait=False, cancel_futures=True)
+            self.fig.canvas.mpl_connect('close_event', self.close)
+            #Finished refinements are picked up in the GUI thread; matplotlib must not be called from the worker
+            self._timer = self.fig.canvas.new_timer(interval=100)
+            self._timer.add_callback(self._poll)
+        #The first frame is segmented by the first call of update
+        self.mask = np.zeros(image.shape, dtype='uint8')
 
         #Organize layout and display
         out = widgets.interactive_output(self.update, {'t': self.t, 'v': self.v, 'cclip': self.cclip, 'flow_threshold': self.flow_threshold, 'diameter': self.diameter, 'mask_threshold': self.mask_threshold})
@@ -154,27 +175,98 @@ class CellposeViewer:
 
     def update(self, t, v, cclip, flow_threshold, diameter, mask_threshold):      
         
-        bf = self.f.get_frame_2D(v=v, t=t, c=self.channel)
-
-        recompute = (flow_threshold!=self.flow_threshold_value) or (
-        diameter!=self.diameter_value) or (
-        mask_threshold!= self.mask_threshold_value) or(
-        t!=self.t_value)
-
-        if recompute:
-            print('recomputing')
-            self.mask = self.segmenter.segment_image(bf, diameter, flow_threshold, mask_threshold)
+        bf = self.stack(v, self.channel)[t]
+        self._bf = bf
+
+        key = (t, v, flow_threshold, diameter, mask_threshold)
+        if key != self._key:
+            #Refinements for older slider values are outdated now
+            self._key = key
+            self._generation += 1
+            for _, future in self._pending:
+                future.cancel()
+
+            mask = self.result(key)
+            if mask is not None:
+                self.mask = mask
+            elif self.preview:
+                print('previewing')
+                self.mask = self.preview_mask(bf, diameter, flow_threshold, mask_threshold)
+                self._pending.append((self._generation, self._refiner.submit(self._refine, self._generation, key, bf)))
+                self._timer.start()
+            else:
+                print('recomputing')
+                self.mask = self.segment(key, bf)
             
         image = self.get_contours_image(bf, self.mask, cclip)
 
         self.im.set_data(image)
 
-        self.flow_threshold_value = flow_threshold
-        self.diameter_value = diameter
-        self.mask_threshold_value = mask_threshold
-        self.t_value=t
-
         return
+
+    def segment(self, key, bf):
+        """Full resolution segmentation of `bf` with the parameters of `key`, remembered per (t, v, parameters)."""
+
+        t, v, flow_threshold, diameter, mask_threshold = key
+        #Frames seen before with the same parameters are also served from the segmentation cache
+        mask = self.segmenter.segment_image(bf, diameter, flow_threshold, mask_threshold, cache=seg_cache.get_cache(disk=False))
+        with self._results_lock:
+            self._results[key] = mask
+            while len(self._results) > self.max_results:
+                self._results.popitem(last=False)
+        return mask
+
+    def result(self, key):
+        """The remembered full resolution mask of `key`, or None."""
+        with self._results_lock:
+            mask = self._results.get(key)
+            if mask is not None:
+                self._results.move_to_end(key)
+            return mask
+
+    def preview_mask(self, bf, diameter, flow_threshold, mask_threshold):
+        """Segmentation of `bf` downsampled by self.preview_scale, scaled back to the size of `bf`."""
+        import cv2
+
+        h, w = bf.shape
+        scale = self.preview_scale
+        small = cv2.resize(np.asarray(bf, dtype=np.float32), (max(1, round(w*scale)), max(1, round(h*scale))), interpolation=cv2.INTER_AREA)
+        labels = self.preview_segmenter.segment_image(small, diameter*scale, flow_threshold, mask_threshold)
+
+        #Nearest neighbor upscaling keeps the labels
+        rows = np.minimum(np.arange(h) * labels.shape[0] // h, labels.shape[0] - 1)
+        cols = np.minimum(np.arange(w) * labels.shape[1] // w, labels.shape[1] - 1)
+        return labels[rows[:, None], cols]
+
+    def _refine(self, generation, key, bf):
+        #Runs in the background thread; requests outdated before they start are skipped
+        if generation != self._generation:
+            return None
+        return self.segment(key, bf)
+
+    def close(self, event=None):
+        """Stop the background refinement: pending refinements are cancelled and the worker thread ends."""
+        if self.preview:
+            self._timer.stop()
+            self._generation += 1
+            self._pending = []
+            self._refiner.shutdown(wait=False, cancel_futures=True)
+
+    def _poll(self):
+        #Runs in the GUI thread, from the figure's timer, while refinements are pending
+        pending = []
+        for generation, future in self._pending:
+            if not future.done():
+                pending.append((generation, future))
+            elif generation == self._generation and not future.cancelled() and future.exception() is None:
+                mask = future.result()
+                if mask is not None:
+                    self.mask = mask
+                    self.im.set_data(self.get_contours_image(self._bf, mask, self.cclip.value))
+                    self.fig.canvas.draw_idle()
+        self._pending = pending
+        if not pending:
+            self._timer.stop()
    
         
     def get_contours_image(self, bf, mask, clip):
@@ -205,44 +297,32 @@ class CellposeViewer:
         return image
 
 
-class ResultsViewer:
+class ResultsViewer(stacks.ND2StackMixin):
     
     def __init__(self, nd2file, outpath, db_path = '/project/ag-moonraedler/MAtienza/database/onedcellmigration.db', manual=False, method='th'):
         
         self.link_dfs = {}
         self.cyto_locator=None
         self.nd2file=nd2file
-        self.f = ND2Reader(nd2file)
-        self.method='th'
-        if method=='th':
-            self.masks_file = 'cyto_masks_th.mp4'
-        else:
-            self.masks_file = 'cyto_masks.mp4'
+        self.manual=manual
+        self.method=method
 
-        if not manual:
-            self.nfov, self.nframes = self.f.sizes['v'], self.f.sizes['t']
-        else:
-            self.nfov, self.nframes = 288, 179
-            self.f.sizes['v']=self.nfov
-            self.f.sizes['t']=self.nframes
-            self.f.metadata['fields_of_view']=list(range(self.nfov))
-
-        self.nfov, self.nframes = self.f.sizes['v'], self.f.sizes['t']
+        self.nfov, self.nframes = self.index.sizes['v'], self.index.sizes['t']
         
         self.outpath=outpath
         self.db_path=db_path
         
-        t_max = self.f.sizes['t']-1
+        t_max = self.index.sizes['t']-1
         self.t = widgets.IntSlider(min=0,max=t_max, step=1, description="t", continuous_update=True)
 
-        if 'c' in self.f.sizes:
-            c_max = self.f.sizes['c']-1
+        if 'c' in self.index.sizes:
+            c_max = self.index.sizes['c']-1
         else:
             c_max=0
         
         self.c = widgets.IntSlider(min=0,max=c_max, step=1, description="c", value=0, continuous_update=True)
 
-        v_max = self.f.sizes['v']-1
+        v_max = self.index.sizes['v']-1
         self.v = widgets.IntSlider(min=0,max=v_max, step=1, description="v", continuous_update=False)
         
         self.clip = widgets.IntRangeSlider(min=0,max=int(2**16 -1), step=1, value=[0,50000], description="clip", continuous_update=True, width='200px')
@@ -264,7 +344,7 @@ class ResultsViewer:
         icon='')
         
         vmin, vmax = self.clip.value
-        cyto = self.f.get_frame_2D(v=self.v.value,c=self.c.value,t=self.t.value)
+        cyto = self.stack(self.v.value, self.c.value)[self.t.value]
         cyto = np.clip(cyto, vmin, vmax).astype('float32')
         cyto = (255*(cyto-vmin)/(vmax-vmin)).astype('uint8')
 
@@ -366,7 +446,7 @@ class ResultsViewer:
     def update_image(self, t, v, clip):
         
         vmin, vmax = clip
-        cyto = self.f.get_frame_2D(v=self.v.value,c=self.c.value,t=self.t.value)
+        cyto = self.stack(self.v.value, self.c.value)[self.t.value]
         cyto = np.clip(cyto, vmin, vmax).astype('float32')
         cyto = (255*(cyto-vmin)/(vmax-vmin)).astype('uint8')
 
@@ -449,13 +529,14 @@ class ResultsViewer:
 
             conn.close()
         
-        elif not os.path.isfile(os.path.join(self.outpath, f'XY{fov}/{self.masks_file}')):
+        elif not any(os.path.isfile(mask_store.mask_path(os.path.join(self.outpath, f'XY{fov}'), self.method, ext)) for ext in ('.h5', '.mp4')):
 
             print('No data available for this fov')
         
         else:
 
-            self.df = pd.read_csv(f'{self.outpath}/XY{fov}/tracking_data.csv')
+            #Reads tracking_data.h5, or the csv written by older versions
+            self.df = track_store.load_tracks(os.path.join(self.outpath, f'XY{fov}'))
 
             if self.masks_available:
                 
@@ -466,12 +547,12 @@ class ResultsViewer:
 
     def load_masks(self, outpath, fov):
         
-        path_to_mask = os.path.join(outpath, f'XY{fov}/{self.masks_file}')
-        print(path_to_mask)
-        if os.path.isfile(path_to_mask):
-            self.masks = functions.mp4_to_np(path_to_mask)
+        try:
+            #Lazy: frames are only decoded when displayed. Falls back to legacy mp4 masks
+            self.masks = mask_store.open_masks(os.path.join(outpath, f'XY{fov}'), self.method)
             self.masks_available=True
-        else:
+        except FileNotFoundError as e:
+            print(e)
             print('No masks available')
             self.masks_available=False
         return      
@@ -503,7 +584,7 @@ class ResultsViewer:
             fluorescence = self.dfp[fl_channel]
             self.ax2.plot(self.dfp.frame, fluorescence, label=fl_channel)
         self.ax2.legend()
-        self.ax2.set_title(self.f.metadata['channels'][self.c.value])
+        self.ax2.set_title(self.index.channels[self.c.value])
         self.ax2.set_xlabel('Frame')
         #self.ax2.plot(self.dfp.frame, self.dfp.front, color='red')
         #self.ax2.plot(self.dfp.frame, self.dfp.rear, color='red')
@@ -518,7 +599,7 @@ class ResultsViewer:
         tax.set_xlabel('Time in minutes')
         self.tmarker=self.ax2.axvline(self.t.value, color='black', lw=1)
 
-        self.cyto_locator = np.zeros(self.masks.shape[0], dtype='uint8')
+        self.cyto_locator = np.zeros(self.masks.shape[0], dtype=self.masks.dtype)
         
         self.cyto_locator[self.dfp.frame]=self.masks[self.dfp.frame, np.round(self.dfp.y).astype(int), np.round(self.dfp.x).astype(int)]
         
@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+
+
+def moving_cells(n_frames=12, height=96, width=96, n_cells=4, size=8, step=1, seed=0):
+    """Label masks of square cells moving `step` pixels per frame, and a fluorescence stack.
+
+    Cell i has label i+1 and fluorescence 10*(i+1) per pixel, so its total fluorescence is 10*(i+1)*size**2.
+    """
+    rng = np.random.default_rng(seed)
+    starts = rng.permutation(np.arange(n_cells)) * (height - size - step * n_frames) // max(1, n_cells - 1)
+    masks = np.zeros((n_frames, height, width), dtype=np.uint16)
+    for t in range(n_frames):
+        for i in range(n_cells):
+            y = int(starts[i])
+            x = 4 + i * (width - 8) // n_cells + t * step
+            masks[t, y:y+size, x:x+size] = i + 1
+    fl = (masks * 10).astype(np.float64)
+    return masks, fl
+
+
+@pytest.fixture
+def cells():
+    return moving_cells()
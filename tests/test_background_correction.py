@@ -0,0 +1,16 @@
+import numpy as np
+
+from lisca.img_op.background_correction import background_schwarzfischer
+
+
+def test_background_schwarzfischer(cells):
+    masks, fl = cells
+    rng = np.random.default_rng(0)
+    #Cells at 50, 100, 150 and 200 above a flat, noisy background of 200
+    images = (200 + rng.normal(0, 3, masks.shape) + 5 * fl).astype(np.uint16)
+    corrected = background_schwarzfischer(images, masks > 0)
+
+    assert corrected.shape == images.shape
+    assert abs(corrected[masks == 0].mean()) < 1
+    for i in range(1, 5):
+        assert abs(corrected[masks == i].mean() - 50 * i) < 2
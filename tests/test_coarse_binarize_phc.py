@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from lisca.img_op import coarse_binarize_phc as cb
+
+
+@pytest.fixture
+def frames(cells):
+    masks, _ = cells
+    rng = np.random.default_rng(1)
+    #Textured cells on a flat, slightly noisy background, like phase contrast
+    images = 1000 + rng.normal(0, 2, masks.shape) + (masks > 0) * rng.normal(0, 60, masks.shape)
+    return images.astype(np.uint16)[:4], masks[:4]
+
+
+@pytest.mark.parametrize('size', [3, 5])
+@pytest.mark.parametrize('reflect', [False, True])
+def test_window_variance_matches_generic_filter(frames, size, reflect):
+    img = frames[0][0][:40, :50]
+    expected = cb.generic_filter(img, cb.window_std, size=size, reflect=reflect)
+    np.testing.assert_allclose(cb.window_variance(img, size=size, reflect=reflect), expected, rtol=1e-9, atol=1e-6)
+    np.testing.assert_allclose(cb.window_variance(img.astype(np.float32), size=size, reflect=reflect), expected, rtol=1e-4, atol=1e-2)
+
+
+def test_window_variance_rejects_even_size(frames):
+    with pytest.raises(ValueError):
+        cb.window_variance(frames[0][0], size=4)
+
+
+def test_binarize_stack_threads(frames):
+    images, masks = frames
+    serial = cb.binarize_stack(images, n_threads=1, labels=True)
+    threaded = cb.binarize_stack(images, n_threads=3, labels=True)
+    np.testing.assert_array_equal(serial, threaded)
+    for t in range(len(images)):
+        np.testing.assert_array_equal(serial[t], cb.label_frame(images[t]))
+    #Most of every cell is found
+    for t in range(len(images)):
+        for i in range(1, masks.max() + 1):
+            assert (serial[t][masks[t] == i] > 0).mean() > 0.5
+
+
+def test_label_frame_tiled_matches_full_frame(frames):
+    image = frames[0][0]
+    full = cb.label_frame(image)
+    tiled = cb.label_frame_tiled(image, tile_size=40, overlap=12, n_threads=2)
+    #Same partition of the frame, possibly with other label values
+    pairs = np.unique(np.stack([full.ravel(), tiled.ravel()]), axis=1)
+    assert len(np.unique(pairs[0])) == len(np.unique(pairs[1])) == pairs.shape[1]
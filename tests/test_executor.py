@@ -0,0 +1,70 @@
+import threading
+import time
+
+import pytest
+
+from lisca import executor
+from lisca.executor import run_pipelined
+
+
+def test_results_are_written_in_order():
+    written = []
+    stats = run_pipelined(range(20), read=lambda t: t * 10, compute=lambda x: x + 1,
+                          write=lambda t, y: written.append((t, y)), depth=3)
+    assert written == [(t, t * 10 + 1) for t in range(20)]
+    assert set(stats) == {'read', 'compute', 'write'}
+
+
+def test_compute_runs_in_calling_thread():
+    threads = set()
+    run_pipelined(range(5), read=lambda t: t, compute=lambda x: threads.add(threading.get_ident()),
+                  write=lambda t, y: None)
+    assert threads == {threading.get_ident()}
+
+
+def test_stages_overlap():
+    def slow(x):
+        time.sleep(0.05)
+        return x
+
+    t0 = time.perf_counter()
+    run_pipelined(range(8), read=slow, compute=slow, write=lambda t, y: slow(y))
+    #Serially the three stages would take 8 * 3 * 0.05 = 1.2 s
+    assert time.perf_counter() - t0 < 0.9
+
+
+def test_empty():
+    written = []
+    run_pipelined([], read=lambda t: t, compute=lambda x: x, write=lambda t, y: written.append(t))
+    assert written == []
+
+
+@pytest.mark.parametrize('stage', ['read', 'compute', 'write'])
+def test_errors_are_raised(stage):
+    def fail(x, *args):
+        if x == 3:
+            raise RuntimeError(stage)
+        return x
+
+    funs = {'read': lambda t: t, 'compute': lambda x: x, 'write': lambda t, y: None}
+    funs[stage] = fail
+    #The error must surface without the other stages hanging on a full queue
+    with pytest.raises(RuntimeError, match=stage):
+        run_pipelined(range(50), depth=1, **funs)
+
+
+def test_weight_counts_frames_of_batches(monkeypatch):
+    #Every timed call takes one second, with a clock per thread
+    clocks = threading.local()
+
+    def perf_counter():
+        clocks.t = getattr(clocks, 't', -1) + 1
+        return clocks.t
+    monkeypatch.setattr(executor.time, 'perf_counter', perf_counter)
+    batches = [[0, 1, 2], [3, 4, 5], [6]]
+    written = []
+    stats = run_pipelined(batches, read=lambda frames: frames, compute=lambda x: x,
+                          write=lambda frames, y: written.extend(y), weight=len)
+    assert written == list(range(7))
+    #Frames, not batches, per second
+    assert stats == {'read': 7 / 3, 'compute': 7 / 3, 'write': 7 / 3}
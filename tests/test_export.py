@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+tifffile = pytest.importorskip('tifffile')
+from lisca.export import write_tiff
+from lisca.stacks import TiffStack
+
+
+@pytest.fixture
+def stack(cells):
+    _, fl = cells
+    return fl.astype(np.uint16)
+
+
+def test_imagej_round_trip(tmp_path, stack):
+    file = str(tmp_path / 'x.tif')
+    write_tiff(file, stack)
+    with tifffile.TiffFile(file) as tif:
+        assert tif.is_imagej
+    s = TiffStack(file)
+    assert s.is_memmap
+    assert s.shape == stack.shape and s.dtype == np.uint16
+    np.testing.assert_array_equal(np.asarray(s), stack)
+    s.close()
+
+
+def test_lazy_stack_and_dtype(tmp_path, stack):
+    src = str(tmp_path / 'src.tif')
+    write_tiff(src, stack)
+    s = TiffStack(src)
+    file = str(tmp_path / 'x.tif')
+    write_tiff(file, s, dtype=np.float32)
+    s.close()
+    np.testing.assert_array_equal(tifffile.imread(file), stack.astype(np.float32))
+
+
+def test_compressed(tmp_path, stack):
+    file = str(tmp_path / 'x.tif')
+    write_tiff(file, stack, compression='zlib', n_threads=2)
+    with tifffile.TiffFile(file) as tif:
+        assert tif.is_bigtiff
+        assert len(tif.pages) == len(stack)
+    np.testing.assert_array_equal(tifffile.imread(file), stack)
+
+
+def test_stream(tmp_path, stack):
+    file = str(tmp_path / 'x.tif')
+    #Frames yielded from one reused buffer must still all be written
+    def frames():
+        buffer = np.empty(stack.shape[1:], dtype=stack.dtype)
+        for t, frame in enumerate(stack):
+            buffer[:] = frame
+            yield t, buffer
+    write_tiff(file, frames(), shape=stack.shape, dtype=stack.dtype)
+    np.testing.assert_array_equal(tifffile.imread(file), stack)
+
+
+def test_shape_mismatch(tmp_path, stack):
+    with pytest.raises(ValueError):
+        write_tiff(str(tmp_path / 'x.tif'), enumerate(stack), shape=(len(stack), 10, 10), dtype=stack.dtype)
@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('h5py')
+from lisca import mask_store
+from lisca.mask_store import MaskStore, MaskWriter
+
+
+def test_round_trip(tmp_path, cells):
+    masks, _ = cells
+    file = str(tmp_path / 'masks.h5')
+    with MaskWriter(file, masks.shape[1:], n_threads=3) as writer:
+        writer.write(masks[:5])
+        for frame in masks[5:]:
+            writer.write_frame(frame)
+    assert writer.n_frames == len(masks)
+
+    store = MaskStore(file)
+    assert store.shape == masks.shape
+    #Frames come back in the smallest dtype holding the labels
+    assert store.dtype == np.uint8
+    np.testing.assert_array_equal(np.asarray(store), masks)
+    np.testing.assert_array_equal(store[[7, 2]], masks[[7, 2]])
+    np.testing.assert_array_equal(store[3, 10:40, 5:60], masks[3, 10:40, 5:60])
+    assert [store.max_label(t) for t in range(len(masks))] == [4] * len(masks)
+    seen = []
+    for t, frame in store.iter_frames():
+        np.testing.assert_array_equal(frame, masks[t])
+        seen.append(t)
+    assert seen == list(range(len(masks)))
+    store.close()
+
+
+def test_labels_above_255(tmp_path):
+    rng = np.random.default_rng(0)
+    masks = rng.integers(0, 7000, size=(3, 40, 50), dtype=np.uint32)
+    file = str(tmp_path / 'masks.h5')
+    with MaskWriter(file, masks.shape[1:]) as writer:
+        writer.write(masks)
+
+    store = MaskStore(file)
+    assert store.dtype == np.uint16
+    np.testing.assert_array_equal(np.asarray(store), masks)
+    store.close()
+
+
+def test_writer_checks(tmp_path):
+    file = str(tmp_path / 'masks.h5')
+    with pytest.raises(ValueError):
+        MaskWriter(file, (8, 8), dtype='int16')
+    with MaskWriter(file, (8, 8), dtype='uint8') as writer:
+        with pytest.raises(ValueError):
+            writer.write_frame(np.zeros((8, 9), dtype=np.uint8))
+        with pytest.raises(OverflowError):
+            writer.write_frame(np.full((8, 8), 300, dtype=np.uint16))
+
+
+def test_writer_closes_on_error(tmp_path, cells):
+    masks, _ = cells
+    file = str(tmp_path / 'masks.h5')
+    with pytest.raises(RuntimeError):
+        with MaskWriter(file, masks.shape[1:]) as writer:
+            writer.write(masks[:3])
+            raise RuntimeError
+    #The frames written before the error are on disk and the file can be opened again
+    store = MaskStore(file)
+    np.testing.assert_array_equal(np.asarray(store), masks[:3])
+    store.close()
+
+
+def test_swmr_reader_sees_appended_frames(tmp_path, cells):
+    masks, _ = cells
+    file = str(tmp_path / 'masks.h5')
+    writer = MaskWriter(file, masks.shape[1:], swmr=True)
+    writer.write(masks[:3])
+    writer.flush()
+
+    store = MaskStore(file, swmr=True)
+    assert len(store) == 3
+    writer.write(masks[3:6])
+    writer.flush()
+    store.refresh()
+    assert len(store) == 6
+    np.testing.assert_array_equal(store[5], masks[5])
+    store.close()
+    writer.close()
+
+
+def test_labels_helpers():
+    assert mask_store.label_dtype(255) == np.uint8
+    assert mask_store.label_dtype(256) == np.uint16
+    assert mask_store.label_dtype(70000) == np.uint32
+    with pytest.raises(OverflowError):
+        mask_store.label_dtype(2**32)
+
+    assert mask_store.compact_labels(np.array([[0, 300]], dtype=np.int64)).dtype == np.uint16
+    stacked = mask_store.stack_labels([np.array([[1]], dtype=np.int32), np.array([[999]], dtype=np.int32)])
+    assert stacked.dtype == np.uint16 and stacked.shape == (2, 1, 1)
+
+
+def test_open_masks(tmp_path, cells):
+    masks, _ = cells
+    with pytest.raises(FileNotFoundError):
+        mask_store.open_masks(str(tmp_path), 'th')
+    with MaskWriter(mask_store.mask_path(str(tmp_path), 'cellpose'), masks.shape[1:]) as writer:
+        writer.write(masks)
+    store = mask_store.open_masks(str(tmp_path), 'cellpose')
+    np.testing.assert_array_equal(store[0], masks[0])
+    store.close()
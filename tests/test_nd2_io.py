@@ -0,0 +1,135 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('nd2reader')
+from benchmarks.synthetic_nd2 import write_synthetic_nd2
+from lisca import nd2_io
+
+
+@pytest.fixture
+def nd2(tmp_path, monkeypatch):
+    #The fallback index location is under the home directory
+    monkeypatch.setenv('HOME', str(tmp_path / 'home'))
+    file = str(tmp_path / 'x.nd2')
+    data = write_synthetic_nd2(file, n_fov=3, n_frames=5, n_channels=2, height=24, width=32)
+    nd2_io.clear_cache()
+    yield file, data
+    nd2_io.clear_cache()
+
+
+def sidecar(file):
+    return nd2_io.index_paths(file)[0]
+
+
+def test_get_index_saves_sidecar(nd2):
+    file, data = nd2
+    index = nd2_io.get_index(file)
+
+    assert (index.sizes['v'], index.sizes['t'], index.height, index.width) == (3, 5, 24, 32)
+    assert index.channels == ['C0', 'C1']
+    assert (index.offsets >= 0).all()
+    assert os.path.isfile(sidecar(file))
+
+    loaded = nd2_io.load_index(file)
+    np.testing.assert_array_equal(loaded.offsets, index.offsets)
+    assert loaded.sizes == index.sizes
+
+
+def test_index_from_open_reader_saves_sidecar(nd2):
+    file, _ = nd2
+    entry = nd2_io._cache.entry(file)
+    entry.reader
+    entry.index
+    assert os.path.isfile(sidecar(file))
+
+
+def test_stale_index_is_rebuilt(nd2):
+    file, _ = nd2
+    nd2_io.get_index(file)
+    st = os.stat(file)
+    os.utime(file, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+    assert nd2_io.load_index(file) is None
+    nd2_io.clear_cache()
+    assert nd2_io.get_index(file).stamp == (st.st_size, st.st_mtime_ns + 10**9)
+    assert nd2_io.load_index(file) is not None
+
+
+def test_index_falls_back_to_cache_directory(nd2, monkeypatch):
+    file, _ = nd2
+    real_save = nd2_io.ND2Index.save
+
+    def save(self, path):
+        if path == sidecar(file):
+            raise PermissionError(path)
+        real_save(self, path)
+    monkeypatch.setattr(nd2_io.ND2Index, 'save', save)
+
+    nd2_io.get_index(file)
+    assert not os.path.isfile(sidecar(file))
+    assert os.path.isfile(nd2_io.index_paths(file)[1])
+
+
+def test_get_reader_is_shared(nd2):
+    file, data = nd2
+    f = nd2_io.get_reader(file)
+    assert nd2_io.get_reader(file) is f
+    np.testing.assert_array_equal(f.get_frame_2D(v=1, t=2, c=1), data[2, 1, 1])
+
+
+def test_read_block(nd2):
+    file, data = nd2
+    frames = np.array([4, 0, 2])
+    block = nd2_io.read_block(file, 1, frames, c=[1, 0])
+    np.testing.assert_array_equal(block, data[frames, 1][:, [1, 0]])
+
+    single = nd2_io.read_block(file, 2, frames, c=1, roi=(3, 17, 5, 30))
+    np.testing.assert_array_equal(single, data[frames, 2, 1, 3:17, 5:30])
+    np.testing.assert_array_equal(nd2_io.read_block(file, 2, 3, c=1), data[3, 2, 1])
+
+    #One read per chunk still gives the same block
+    np.testing.assert_array_equal(nd2_io.read_block(file, 1, frames, c=[1, 0], max_read=1), block)
+
+
+def test_read_block_single_channel(tmp_path):
+    file = str(tmp_path / 'one.nd2')
+    data = write_synthetic_nd2(file, n_fov=2, n_frames=4, n_channels=1, height=24, width=32)
+    frames = np.array([3, 1, 2])
+    np.testing.assert_array_equal(nd2_io.read_block(file, 1, frames), data[frames, 1, 0])
+    out = np.zeros((3, 1, 24, 32), dtype=np.uint16)
+    nd2_io.read_block(file, 0, frames, c=[0], out=out)
+    np.testing.assert_array_equal(out, data[frames, 0])
+    np.testing.assert_array_equal(nd2_io.read_block(file, 0, 2, roi=(5, 20, 0, 32)), data[2, 0, 0, 5:20])
+    np.testing.assert_array_equal(nd2_io.read_block(file, 0, frames, roi=(5, 20, 3, 9)), data[frames, 0, 0, 5:20, 3:9])
+
+
+def test_read_block_short_read(nd2):
+    file, _ = nd2
+    #An offset past the end of the file, as left by a truncated file
+    nd2_io.get_index(file).offsets[1, 0] = os.path.getsize(file) - 4
+    with pytest.raises(EOFError):
+        nd2_io.read_block(file, 1, [0, 1])
+
+
+def test_reader_cache_reopens_changed_file(nd2):
+    file, _ = nd2
+    entry = nd2_io._cache.entry(file)
+    assert nd2_io._cache.entry(file) is entry
+    st = os.stat(file)
+    os.utime(file, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert nd2_io._cache.entry(file) is not entry
+
+
+def test_reader_cache_size(nd2, tmp_path):
+    file, _ = nd2
+    other = str(tmp_path / 'y.nd2')
+    write_synthetic_nd2(other, n_fov=1, n_frames=2, n_channels=1, height=8, width=8)
+    nd2_io.set_cache_size(1)
+    try:
+        nd2_io.get_reader(file)
+        nd2_io.get_reader(other)
+        assert len(nd2_io._cache) == 1 and other in nd2_io._cache and file not in nd2_io._cache
+    finally:
+        nd2_io.set_cache_size(8)
@@ -0,0 +1,65 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('nd2reader')
+pytest.importorskip('cellpose')
+from benchmarks.synthetic_nd2 import write_synthetic_nd2
+from conftest import moving_cells
+from lisca import mask_store, nd2_io, seg_cache, track_store
+from lisca.pipeline import Track
+
+
+@pytest.fixture
+def track(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path / 'home'))
+    data = write_synthetic_nd2(str(tmp_path / 'x.nd2'), n_fov=2, n_frames=12, n_channels=2, height=96, width=96)
+    path_out = str(tmp_path / 'out')
+    os.makedirs(path_out)
+    nd2_io.clear_cache()
+    yield Track(path_out, str(tmp_path), 0, [1], 1, nd2_file='x.nd2'), data
+    nd2_io.clear_cache()
+
+
+def test_track_end_to_end(track):
+    track, data = track
+    masks, _ = moving_cells(n_frames=12, height=96, width=96)
+    with mask_store.MaskWriter(mask_store.mask_path(track.path_out, 'th'), masks.shape[1:]) as writer:
+        writer.write(masks)
+
+    track.track(max_travel=5, min_frames=5, csv=True)
+
+    df = track_store.load_tracks(track.path_out)
+    label = track.channel_labels[1]
+    assert df['particle'].nunique() == 4
+    assert len(df) == 4 * 12
+    fl = data[:, 1, 1].astype(np.float64)
+    expected = [fl[t][masks[t] == c].sum() for t, c in zip(df['frame'], df['cyto_locator'])]
+    np.testing.assert_allclose(df[label].values, expected)
+    assert os.path.isfile(track.df_path)
+
+
+def test_track_th_segment(track):
+    track, _ = track
+    cache = seg_cache.get_cache()
+    lookups = cache.hits + cache.misses
+    track.segment(method='th')
+    masks = mask_store.open_masks(track.path_out, 'th')
+    assert masks.shape == (12, 96, 96)
+    masks.close()
+    #The segmentation cache is opt-in
+    assert cache.hits + cache.misses == lookups
+
+
+def test_track_th_segment_cached(track, tmp_path, monkeypatch):
+    track, _ = track
+    cache = seg_cache.SegmentationCache(directory=str(tmp_path / 'cache'))
+    monkeypatch.setattr(seg_cache, '_cache', cache)
+    track.segment(method='th', cache=True, batch_size=5)
+    first = np.asarray(mask_store.open_masks(track.path_out, 'th'))
+    assert cache.misses == 12
+
+    track.segment(method='th', cache=True)
+    np.testing.assert_array_equal(np.asarray(mask_store.open_masks(track.path_out, 'th')), first)
+    assert cache.hits == 12
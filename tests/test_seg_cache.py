@@ -0,0 +1,94 @@
+import os
+
+import numpy as np
+import pytest
+
+from lisca import seg_cache
+from lisca.seg_cache import SegmentationCache, frame_key
+
+
+@pytest.fixture
+def frames():
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 4096, size=(4, 16, 16), dtype=np.uint16)
+
+
+class Counter:
+    """Segmentation that labels pixels above the mean and counts the frames it segments."""
+
+    def __init__(self):
+        self.n = 0
+
+    def __call__(self, images):
+        self.n += len(images)
+        return [(image > image.mean()).astype(np.uint8) for image in images]
+
+
+def test_frame_key(frames):
+    key = frame_key(frames[0], 'th', mask_size=3)
+    assert key == frame_key(frames[0].copy(), 'th', mask_size=3)
+    assert key != frame_key(frames[1], 'th', mask_size=3)
+    assert key != frame_key(frames[0], 'th', mask_size=5)
+    assert key != frame_key(frames[0], 'cellpose', mask_size=3)
+    assert key != frame_key(frames[0].astype(np.int32), 'th', mask_size=3)
+
+
+def test_segment_computes_missing_masks(tmp_path, frames):
+    cache = SegmentationCache(directory=str(tmp_path))
+    segment = Counter()
+    first = cache.segment(frames[:2], segment, 'th', mask_size=3)
+    assert segment.n == 2
+
+    masks = cache.segment(frames, segment, 'th', mask_size=3)
+    assert segment.n == 4
+    assert (cache.hits, cache.misses) == (2, 4)
+    for mask, expected in zip(masks, segment(frames)):
+        np.testing.assert_array_equal(mask, expected)
+    np.testing.assert_array_equal(masks[0], first[0])
+
+    #Masks are returned as copies
+    masks[0][:] = 7
+    assert cache.segment(frames[:1], segment, 'th', mask_size=3)[0].max() <= 1
+
+
+def test_disk_cache_persists(tmp_path, frames):
+    segment = Counter()
+    SegmentationCache(directory=str(tmp_path)).segment(frames, segment, 'th')
+    cache = SegmentationCache(directory=str(tmp_path))
+    cache.segment(frames, segment, 'th')
+    assert segment.n == 4
+    assert cache.hits == 4
+
+    cache.clear(disk=True)
+    cache.segment(frames, segment, 'th')
+    assert segment.n == 8
+
+
+def test_memory_only(tmp_path, frames):
+    cache = SegmentationCache(directory=str(tmp_path / 'cache'), max_disk=0)
+    cache.segment(frames, Counter(), 'th')
+    assert len(cache) == 4
+    assert not os.path.exists(tmp_path / 'cache')
+    assert seg_cache.get_cache(disk=False).max_disk == 0
+
+
+def test_memory_limit(tmp_path, frames):
+    mask_bytes = frames[0].size
+    cache = SegmentationCache(directory=str(tmp_path), max_memory=2 * mask_bytes, max_disk=0)
+    segment = Counter()
+    cache.segment(frames, segment, 'th')
+    assert len(cache) == 2
+    #The two most recent masks are kept
+    cache.segment(frames[2:], segment, 'th')
+    assert segment.n == 4
+    cache.resize(max_memory=mask_bytes)
+    assert len(cache) == 1
+
+
+def test_disk_limit(tmp_path, frames):
+    cache = SegmentationCache(directory=str(tmp_path), max_disk=1 << 20)
+    cache.segment(frames, Counter(), 'th')
+    sizes = sorted(size for _, size, _ in cache._files())
+    assert len(sizes) == 4
+    cache.resize(max_disk=sum(sizes[:2]))
+    assert len(cache._files()) <= 2
@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+
+tifffile = pytest.importorskip('tifffile')
+from lisca import stacks
+
+
+@pytest.fixture
+def data():
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 4096, size=(6, 20, 30), dtype=np.uint16)
+
+
+@pytest.mark.parametrize('byteorder', ['<', '>'])
+def test_tiff_memmap(tmp_path, data, byteorder):
+    file = str(tmp_path / 'x.tif')
+    tifffile.imwrite(file, data, byteorder=byteorder)
+    stack = stacks.open_stack(file)
+
+    assert stack.is_memmap
+    assert stack.shape == data.shape
+    assert stack.dtype == np.dtype(np.uint16) and stack.dtype.isnative
+    for x in (stack[2], stack[1:4], stack[[0, 5]], stack[:, 3:9, 4:10], np.asarray(stack)):
+        assert x.dtype.isnative
+    np.testing.assert_array_equal(stack[1:4], data[1:4])
+    np.testing.assert_array_equal(stack[[5, 0]], data[[5, 0]])
+    np.testing.assert_array_equal(stack[:, 3:9, 4:10], data[:, 3:9, 4:10])
+    np.testing.assert_array_equal(np.asarray(stack), data)
+    stack.close()
+
+
+@pytest.mark.parametrize('byteorder', ['<', '>'])
+def test_tiff_pages(tmp_path, data, byteorder):
+    file = str(tmp_path / 'x.tif')
+    #Compressed pages cannot be memory-mapped
+    tifffile.imwrite(file, data, byteorder=byteorder, compression='zlib')
+    stack = stacks.open_stack(file)
+
+    assert not stack.is_memmap
+    assert stack.dtype.isnative
+    np.testing.assert_array_equal(stack[[4, 1]], data[[4, 1]])
+    np.testing.assert_array_equal(stack[2, 5:10, 1:7], data[2, 5:10, 1:7])
+    np.testing.assert_array_equal(np.stack([frame.copy() for _, frame in stack.iter_frames()]), data)
+    stack.close()
+
+
+def test_iter_frames(tmp_path, data):
+    file = str(tmp_path / 'x.tif')
+    tifffile.imwrite(file, data)
+    stack = stacks.open_stack(file)
+    #Frames are read ahead into reused buffers, so they are only valid during their iteration step
+    seen = []
+    for t, frame in stack.iter_frames([3, 1, 4, 0, 5, 2]):
+        np.testing.assert_array_equal(frame, data[t])
+        seen.append(t)
+    assert seen == [3, 1, 4, 0, 5, 2]
+    assert [t for t, _ in stacks.iter_frames(data)] == list(range(len(data)))
+
+
+def test_nd2_stack(tmp_path):
+    pytest.importorskip('nd2reader')
+    from benchmarks.synthetic_nd2 import write_synthetic_nd2
+
+    file = str(tmp_path / 'x.nd2')
+    data = write_synthetic_nd2(file, n_fov=2, n_frames=5, n_channels=2, height=24, width=32)
+    stack = stacks.open_stack(file, c=1, fov=1)
+    assert stack.shape == (5, 24, 32)
+    np.testing.assert_array_equal(stack[[4, 1]], data[[4, 1], 1, 1])
+    np.testing.assert_array_equal(stack[2, 5:9], data[2, 1, 1, 5:9])
+
+
+def test_mp4_channel_and_grey(tmp_path):
+    cv2 = pytest.importorskip('cv2')
+    file = str(tmp_path / 'x.mp4')
+    writer = cv2.VideoWriter(file, cv2.VideoWriter_fourcc(*'mp4v'), 5, (64, 48))
+    for _ in range(4):
+        #BGR: blue 200, green 50, red 0
+        frame = np.zeros((48, 64, 3), dtype=np.uint8)
+        frame[..., 0], frame[..., 1] = 200, 50
+        writer.write(frame)
+    writer.release()
+
+    grey = stacks.open_stack(file, as_grey=True)
+    assert grey.shape == (4, 48, 64)
+    expected = 0.114 * 200 + 0.587 * 50
+    assert abs(float(grey[1].mean()) - expected) < 3
+    assert float(stacks.open_stack(file, c=0)[1].mean()) < 3
+    assert abs(float(stacks.open_stack(file, c=2)[1].mean()) - 200) < 3
+    #Decoding seeks to and returns only the requested frames
+    np.testing.assert_array_equal(grey[[3, 0]], np.stack([grey[3], grey[0]]))
@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+tifffile = pytest.importorskip('tifffile')
+from conftest import moving_cells
+from lisca import sweep, tracking
+
+
+@pytest.fixture
+def centroids(cells):
+    masks, _ = cells
+    return tracking.get_centroids(list(enumerate(masks)))
+
+
+@pytest.fixture
+def tif(tmp_path):
+    masks, _ = moving_cells(n_frames=8, height=96, width=128, n_cells=4, size=12, step=2)
+    rng = np.random.default_rng(1)
+    #Textured cells on a flat background, like phase contrast
+    images = 1000 + rng.normal(0, 2, masks.shape) + (masks > 0) * rng.normal(0, 60, masks.shape)
+    file = str(tmp_path / 'x.tif')
+    tifffile.imwrite(file, images.astype(np.uint16), imagej=True)
+    return file
+
+
+def test_param_grid():
+    configs = sweep.param_grid({'a': [1, 2], 'b': np.array([3, 4])}, {'a': 0, 'c': 5})
+    assert configs == [{'a': 1, 'c': 5, 'b': 3}, {'a': 1, 'c': 5, 'b': 4}, {'a': 2, 'c': 5, 'b': 3}, {'a': 2, 'c': 5, 'b': 4}]
+    assert all(type(config['b']) is int for config in configs)
+    assert sweep.param_grid(None, {'a': 0}) == [{'a': 0}]
+
+
+def test_subnet_sizes(centroids):
+    #Cells move 1 pixel per frame and are far apart
+    sizes = sweep.subnet_sizes(centroids, max_travel=5)
+    assert len(sizes) == 4 * 11 and (sizes == 2).all()
+    #With a large search radius, all cells of two frames are one subnetwork
+    sizes = sweep.subnet_sizes(centroids, max_travel=200)
+    assert len(sizes) == 11 and (sizes == 8).all()
+
+
+def test_link_sample(centroids):
+    metrics = sweep.link_sample(centroids, {'max_travel': 5, 'min_frames': 5})
+    assert metrics['n_tracks'] == 4
+    assert metrics['track_length_mean'] == 12
+    assert metrics['fraction_tracked'] == 1
+    assert metrics['subnet_size_max'] == 2
+
+    empty = sweep.link_sample(centroids.iloc[:0])
+    assert empty['n_tracks'] == 0 and empty['fraction_tracked'] == 0
+
+
+def test_sweep(tif):
+    kwargs = dict(frames=range(8), seg_grid={'mask_size': [3, 5]}, track_grid={'max_travel': [10, 20], 'min_frames': [4]})
+    results = sweep.sweep(tif, n_workers=1, **kwargs)
+    assert len(results) == 4
+    assert results[['mask_size', 'max_travel']].values.tolist() == [[3, 10], [3, 20], [5, 10], [5, 20]]
+    assert (results['cells_per_frame'] == 4).all()
+    assert (results['n_tracks'] == 4).all()
+
+    #Runs in a process pool give the same results
+    pooled = sweep.sweep(tif, n_workers=2, **kwargs)
+    columns = [c for c in results if not c.endswith('runtime')]
+    pd.testing.assert_frame_equal(pooled[columns], results[columns])
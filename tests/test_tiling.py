@@ -0,0 +1,107 @@
+import numpy as np
+import pytest
+import scipy.ndimage as smg
+
+from lisca import tiling
+
+
+def label(image):
+    return smg.label(image > 0)[0]
+
+
+def same_partition(a, b):
+    pairs = np.unique(np.stack([a.ravel(), b.ravel()]), axis=1)
+    return len(np.unique(pairs[0])) == len(np.unique(pairs[1])) == pairs.shape[1]
+
+
+@pytest.fixture
+def frame():
+    #Separate 10x10 cells every 23 pixels, so many of them straddle the 64 pixel tile seams
+    frame = np.zeros((200, 300))
+    for y in range(3, 190, 23):
+        for x in range(5, 290, 23):
+            frame[y:y+10, x:x+10] = 1
+    return frame
+
+
+@pytest.mark.parametrize('shape', [(100, 100), (200, 300), (257, 63)])
+def test_tile_grid_covers_frame(shape):
+    tiles = tiling.tile_grid(shape, tile_size=64, overlap=8)
+    cover = np.zeros(shape, dtype=int)
+    for (y0, y1, x0, x1), (py0, py1, px0, px1) in tiles:
+        cover[y0:y1, x0:x1] += 1
+        assert py0 == max(0, y0 - 8) and py1 == min(shape[0], y1 + 8)
+        assert px0 == max(0, x0 - 8) and px1 == min(shape[1], x1 + 8)
+    assert (cover == 1).all()
+
+
+@pytest.mark.parametrize('n_threads', [1, 3])
+def test_segment_tiled_matches_full_frame(frame, n_threads):
+    full = label(frame)
+    tiled = tiling.segment_tiled(frame, label, tile_size=64, overlap=16, n_threads=n_threads)
+    assert tiled.shape == frame.shape
+    #Cells crossing the seams are joined back into one label
+    assert same_partition(full, tiled)
+
+
+def test_segment_tiled_noise_floor(frame):
+    calls = []
+
+    def segment(tile):
+        calls.append(tile.shape)
+        return label(tile)
+
+    empty = np.zeros_like(frame)
+    assert not tiling.segment_tiled(empty, segment, tile_size=64, overlap=16, noise_floor=1e-6).any()
+    assert calls == []
+
+
+def test_roi_boxes():
+    roi = np.zeros((100, 120), dtype=bool)
+    roi[10:20, 10:110] = True
+    roi[60:70, 10:110] = True
+    assert tiling.roi_boxes(roi, margin=0) == [(10, 20, 10, 110), (60, 70, 10, 110)]
+    assert tiling.roi_boxes(roi, margin=5) == [(5, 25, 5, 115), (55, 75, 5, 115)]
+    #Boxes that would overlap are merged
+    assert tiling.roi_boxes(roi, margin=25) == [(0, 95, 0, 120)]
+
+
+def test_segment_masked(frame):
+    roi = np.zeros(frame.shape, dtype=bool)
+    roi[3:13] = True
+    roi[95:105] = True
+    calls = []
+
+    def segment(crop):
+        calls.append(crop.shape)
+        return label(crop)
+
+    labels = tiling.segment_masked(frame, segment, roi_mask=roi, margin=2, n_threads=2)
+    full = label(frame)
+    inside = (full > 0) & smg.binary_dilation(roi, iterations=2)
+    #Cells in the lanes are found with unique labels, nothing is found outside
+    assert same_partition(full * inside, labels)
+    assert len(calls) == 2
+
+
+def test_segment_frames(frame):
+    frames = np.stack([frame, np.zeros_like(frame), frame])
+    batches = []
+
+    def segment_batch(images):
+        batches.append(len(images))
+        return [label(image) for image in images]
+
+    masks = tiling.segment_frames(frames, label, segment_batch=segment_batch, noise_floor=1e-6)
+    #The empty frame is skipped
+    assert batches == [2]
+    assert not masks[1].any()
+    np.testing.assert_array_equal(masks[0], label(frame))
+    np.testing.assert_array_equal(masks[2], label(frame))
+
+    roi = np.zeros(frame.shape, dtype=bool)
+    roi[:, :150] = True
+    boxes = tiling.roi_boxes(roi, margin=0)
+    masks = tiling.segment_frames(frames, label, boxes=boxes)
+    assert not masks[0][:, 150:].any()
+    assert same_partition(masks[0][:, :150], label(frame[:, :150]))
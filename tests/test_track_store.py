@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('h5py')
+from lisca import track_store, tracking
+
+
+@pytest.fixture
+def tracks(cells):
+    masks, fl = cells
+    return tracking.track(masks, max_travel=5, min_frames=5), masks, fl
+
+
+def test_write_track_output(tmp_path, tracks):
+    df, _, _ = tracks
+    file = str(tmp_path / 'tracks.h5')
+    #trackpy's output is indexed by frame, which is also a column
+    track_store.write_tracks(file, df)
+
+    out = track_store.read_tracks(file)
+    assert list(out.columns) == list(df.columns)
+    assert out.index.is_unique
+    assert (np.diff(out['frame'].values) >= 0).all()
+    pd.testing.assert_frame_equal(out.reset_index(drop=True), df.reset_index(drop=True), check_dtype=False)
+
+
+def test_append_fluorescence_like_track(tmp_path, tracks):
+    df, masks, fl = tracks
+    file = str(tmp_path / 'tracks.h5')
+    df = df.reset_index(drop=True)
+    #Shuffle the rows so alignment through the index is needed
+    df = df.sample(frac=1, random_state=0)
+    track_store.write_tracks(file, df)
+    df = tracking.read_fluorescence(df, fl, masks, 'fl')
+    track_store.append_column(file, 'fl', df['fl'])
+
+    out = track_store.read_tracks(file)
+    np.testing.assert_allclose(out['fl'].values, 10 * 64 * out['cyto_locator'].values)
+    pd.testing.assert_series_equal(out['fl'], df['fl'].loc[out.index])
+
+
+def test_append_column_checks(tmp_path, tracks):
+    df, _, _ = tracks
+    file = str(tmp_path / 'tracks.h5')
+    track_store.write_tracks(file, df)
+
+    with pytest.raises(ValueError):
+        track_store.append_column(file, 'a', pd.Series(np.ones(len(df)), index=df.index))
+    with pytest.raises(ValueError):
+        track_store.append_column(file, 'a', np.ones(len(df) + 1))
+
+    track_store.append_column(file, 'a', np.arange(len(df)))
+    track_store.append_column(file, 'a', np.arange(len(df)) * 2)
+    out = track_store.read_tracks(file, columns=['a'])
+    np.testing.assert_array_equal(out['a'].values, np.arange(len(df)) * 2)
+    assert track_store.read_tracks(file).columns[-1] == 'a'
+
+
+def test_read_frames_and_particles(tmp_path, tracks):
+    df, _, _ = tracks
+    df = df.reset_index(drop=True)
+    file = str(tmp_path / 'tracks.h5')
+    track_store.write_tracks(file, df)
+
+    out = track_store.read_tracks(file, frames=[2, 3])
+    pd.testing.assert_frame_equal(out, df[df['frame'].isin([2, 3])], check_dtype=False)
+
+    particle = int(df['particle'].iloc[0])
+    out = track_store.read_tracks(file, columns=['frame', 'particle'], particles=particle, frames=range(4))
+    assert (out['particle'] == particle).all()
+    assert list(out['frame']) == [0, 1, 2, 3]
+
+    assert len(track_store.read_tracks(file, frames=[100])) == 0
+
+
+def test_load_tracks_falls_back_to_csv(tmp_path, tracks):
+    df, _, _ = tracks
+    df = df.reset_index(drop=True)
+    with pytest.raises(FileNotFoundError):
+        track_store.load_tracks(str(tmp_path))
+    df.to_csv(track_store.tracks_path(str(tmp_path), ext='.csv'))
+    assert len(track_store.load_tracks(str(tmp_path), columns=['frame', 'x'])) == len(df)
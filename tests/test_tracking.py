@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+
+from lisca import tracking
+
+
+def test_get_centroids(cells):
+    masks, _ = cells
+    df = tracking.get_centroids(masks)
+
+    assert list(df.columns) == ['frame', 'x', 'y', 'cyto_locator', 'area']
+    assert len(df) == masks.shape[0] * 4
+    assert (df['area'] == 64).all()
+    row = df[(df['frame'] == 3) & (df['cyto_locator'] == 2)].iloc[0]
+    ys, xs = np.nonzero(masks[3] == 2)
+    assert np.isclose(row['x'], xs.mean()) and np.isclose(row['y'], ys.mean())
+
+
+def test_get_centroids_stream_and_sparse_labels(cells):
+    masks, _ = cells
+    sparse = masks.astype(np.uint32)
+    sparse[sparse > 0] += 100000
+    df = tracking.get_centroids(list(zip(range(5, 5 + len(masks)), sparse)))
+
+    assert df['frame'].min() == 5
+    assert sorted(df['cyto_locator'].unique()) == [100001, 100002, 100003, 100004]
+
+
+def test_get_centroids_growing_cell_count():
+    #Frame t holds t+1 cells, so the columns outgrow their first allocation; a generator has no length
+    masks = np.zeros((30, 64, 64), dtype=np.uint16)
+    for t in range(len(masks)):
+        for i in range(t + 1):
+            masks[t, 2 * (i // 8) * 4:2 * (i // 8) * 4 + 3, (i % 8) * 8:(i % 8) * 8 + 3] = i + 1
+    for stream in (masks, ((t, m) for t, m in enumerate(masks))):
+        df = tracking.get_centroids(stream)
+        assert len(df) == 30 * 31 // 2
+        assert df.groupby('frame').size().tolist() == list(range(1, 31))
+        assert (df['area'] == 9).all()
+
+
+def test_get_centroids_empty():
+    df = tracking.get_centroids(np.zeros((2, 8, 8), dtype=np.uint8))
+    assert len(df) == 0
+    assert list(df.columns) == ['frame', 'x', 'y', 'cyto_locator', 'area']
+
+
+def test_track_links_moving_cells(cells):
+    masks, _ = cells
+    df = tracking.track(masks, max_travel=5, min_frames=5)
+
+    assert df['particle'].nunique() == 4
+    assert df.groupby('particle')['cyto_locator'].nunique().eq(1).all()
+
+
+def test_read_fluorescence_on_track_output(cells):
+    masks, fl = cells
+    df = tracking.track(masks, max_travel=5, min_frames=5)
+    #trackpy indexes its output by frame
+    assert df.index.name == 'frame'
+
+    df = tracking.read_fluorescence(df, fl, masks, 'fl')
+
+    expected = 10 * df['cyto_locator'].values * 64
+    np.testing.assert_allclose(df['fl'].values, expected)
+
+
+def test_read_fluorescence_streams(cells):
+    masks, fl = cells
+    df = tracking.track(masks, max_travel=5, min_frames=5)
+    frames = range(len(masks))
+    df = tracking.read_fluorescence(df, zip(frames, fl), list(zip(frames, masks)), 'fl')
+    assert isinstance(df, pd.DataFrame)
+    np.testing.assert_allclose(df['fl'].values, 10 * df['cyto_locator'].values * 64)
@@ -0,0 +1,79 @@
+import os
+import subprocess
+
+import numpy as np
+import pytest
+
+skvideo = pytest.importorskip('skvideo')
+from lisca.video_writer import Mp4writer, EncoderError
+
+pytestmark = pytest.mark.skipif(not skvideo._HAS_FFMPEG, reason='ffmpeg not found')
+
+
+def decode(file, pix_fmt, shape, dtype):
+    """Decode a movie with ffmpeg into a (t, *shape) array."""
+    ffmpeg = os.path.join(skvideo.getFFmpegPath(), 'ffmpeg')
+    raw = subprocess.run([ffmpeg, '-i', file, '-f', 'rawvideo', '-pix_fmt', pix_fmt, '-'],
+                         capture_output=True, check=True).stdout
+    return np.frombuffer(raw, dtype=dtype).reshape((-1,) + shape)
+
+
+def frames(dtype, n=5, height=32, width=48, high=255):
+    rng = np.random.default_rng(0)
+    #Smooth ramps compress well and survive the encoder's chroma handling
+    ramp = np.linspace(0, high, width)[np.newaxis, :] * np.ones((height, 1))
+    return np.stack([(ramp * (0.5 + 0.1 * t) + rng.uniform(0, high / 100)).astype(dtype) for t in range(n)])
+
+
+@pytest.mark.parametrize('queue_size', [0, 4])
+def test_uint8_round_trip(tmp_path, queue_size):
+    x = frames(np.uint8)
+    out = str(tmp_path / 'x.mp4')
+    with Mp4writer(out, queue_size=queue_size) as writer:
+        for frame in x:
+            writer.write_frame(frame)
+    assert writer.n_frames == len(x)
+
+    y = decode(out, 'gray', x.shape[1:], np.uint8)
+    assert y.shape == x.shape
+    assert np.abs(y.astype(int) - x).max() <= 1
+
+
+def test_uint16_round_trip(tmp_path):
+    x = frames(np.uint16, high=40000)
+    out = str(tmp_path / 'x.mp4')
+    with Mp4writer(out, queue_size=2) as writer:
+        for frame in x:
+            writer.write_frame(frame)
+
+    y = decode(out, 'gray16le', x.shape[1:], '<u2')
+    assert y.shape == x.shape
+    #Values above 255 are kept, with the precision of libx264's 10 bits
+    assert y.max() > 30000
+    assert np.abs(y.astype(int) - x).max() <= 2 * 2**6
+
+
+def test_float_frames_are_clipped_to_8_bit(tmp_path):
+    x = frames(np.float64, high=400)
+    out = str(tmp_path / 'x.mp4')
+    with Mp4writer(out) as writer:
+        for frame in x:
+            writer.write_frame(frame)
+    y = decode(out, 'gray', x.shape[1:], np.uint8)
+    assert np.abs(y.astype(int) - np.clip(x, 0, 255).astype(np.uint8)).max() <= 1
+
+
+def test_frame_shape_must_not_change(tmp_path):
+    writer = Mp4writer(str(tmp_path / 'x.mp4'))
+    writer.write_frame(np.zeros((16, 16), dtype=np.uint8))
+    with pytest.raises(ValueError):
+        writer.write_frame(np.zeros((16, 32), dtype=np.uint8))
+    writer.close()
+
+
+def test_encoder_error(tmp_path):
+    writer = Mp4writer(str(tmp_path / 'missing' / 'x.mp4'))
+    with pytest.raises(EncoderError):
+        for _ in range(50):
+            writer.write_frame(np.zeros((16, 16), dtype=np.uint8))
+        writer.close()